@@ -1,14 +1,40 @@
 # app.py
 
+import mimetypes
 import os
-from datetime import datetime
-from functools import wraps
-from flask import Flask, render_template, request, redirect, url_for, flash, abort
+import sqlite3
+import time
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from functools import lru_cache, wraps
+
+import click
+from flask import (Flask, Request, render_template, request, redirect, url_for, flash, abort, make_response,
+                   jsonify, send_file, send_from_directory)
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
-from sqlalchemy.orm import joinedload
+from sqlalchemy import bindparam, case, event, func, insert, inspect, literal, select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import InterfaceError, OperationalError, TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import aliased, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.exc import StaleDataError
+
+from assignment import AutoAssigner
+from attachments import AttachmentStore, AttachmentTooLarge
+from caches import OrganizationNameCache, RoleCache
+from outbox import OutboxDispatcher
+from assets import OUTPUT_DIR as ASSET_OUTPUT_DIR, AssetManifest, build_assets
+from profiling import RequestProfiler
+from ratelimit import LoginThrottle, create_backend
+from resilience import CircuitBreaker, CircuitOpen, StaleCache
+from rollups import RESOLVED_STATUSES, UNASSIGNED, dense_series, rebuild_organization, refresh_window
+from sharding import (DEFAULT_SHARD, RoutingSession, ShardDirectory, ShardEntry, ShardMap,
+                      copy_global_rows, copy_organization, parse_shard_urls, purge_organization, use_shard)
+from similarity import SimilarTicketIndex
+from sqlcache import CompiledCacheStats
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'a_default_fallback_secret_key')
@@ -30,19 +56,114 @@ else:
 app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# --- シャーディングの設定 ---
+# 例: SHARD_DATABASE_URLS="shard1=postgresql://...,shard2=postgresql://..."
+# 新しく作成した組織を置くシャード (既定のデータベースは 'default')
+app.config['NEW_ORGANIZATION_SHARD'] = os.environ.get('NEW_ORGANIZATION_SHARD', DEFAULT_SHARD)
+# 組織→シャードの対応をキャッシュする秒数。移行時の切り替えはこの秒数だけ待って反映させる
+app.config['SHARD_DIRECTORY_TTL'] = float(os.environ.get('SHARD_DIRECTORY_TTL', 5))
+shard_map = ShardMap(parse_shard_urls(os.environ.get('SHARD_DATABASE_URLS')))
+app.extensions['shard_map'] = shard_map
+
 # --- Flask-Loginの設定 ---
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+# --- ログイン試行のスロットリング ---
+# 複数ワーカーで状態を共有する場合は LOGIN_THROTTLE_STORAGE_URL=redis://... を指定する
+login_throttle = LoginThrottle(backend=create_backend(os.environ.get('LOGIN_THROTTLE_STORAGE_URL')))
+
+# --- 静的アセット (flask build-assets でビルドしたCSS) ---
+# ファイル名に内容のハッシュを含むため、ブラウザには1年間キャッシュさせる
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+asset_manifest = AssetManifest(os.environ.get('ASSET_OUTPUT_DIR', ASSET_OUTPUT_DIR))
+
+# --- チケットの添付ファイル ---
+# 本体は ATTACHMENT_DIR に内容のハッシュで保存する (複数ワーカー・サーバーでは共有のボリュームにする)
+attachment_store = AttachmentStore(
+    os.environ.get('ATTACHMENT_DIR', os.path.join(app.instance_path, 'attachments')),
+    max_size=int(os.environ.get('ATTACHMENT_MAX_SIZE', 25 * 1024 * 1024)),
+)
+# 1 にすると、ダウンロードの本体の送信を X-Sendfile ヘッダーでフロントのWebサーバーに任せる
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+
+class AttachmentRequest(Request):
+    """添付ファイルのアップロードでは、ファイルをメモリを経由せずに添付ファイルの一時ファイルへ書く"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # 他のエンドポイントへ送られたファイルは添付ファイルのサイズの上限や保存先と関係なく、通常どおり扱う
+        if self.endpoint != 'upload_attachments':
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        return attachment_store.open_upload()
+
+
+app.request_class = AttachmentRequest
+
+@app.errorhandler(AttachmentTooLarge)
+def attachment_too_large(error):
+    """upload_attachments の外でフォームを解析して上限を超えた場合 (フォームの解析時に送出されるため)"""
+    return f"添付ファイルは1件あたり{error.max_size // (1024 * 1024)}MBまでです。", 413
+
+
+# --- リクエストのプロファイリング (既定では無効) ---
+# 例: PROFILE_SAMPLE_RATE=0.001 (0.1%のリクエスト), PROFILE_ENDPOINTS=index
+# 管理者は X-Profile-Request: 1 ヘッダーを付けたリクエストをプロファイルできる
+request_profiler = RequestProfiler(
+    app,
+    output_dir=os.environ.get('PROFILE_DIR', os.path.join(app.instance_path, 'profiles')),
+    sample_rate=float(os.environ.get('PROFILE_SAMPLE_RATE', 0)),
+    endpoints=[name.strip() for name in os.environ.get('PROFILE_ENDPOINTS', '').split(',') if name.strip()],
+    max_files=int(os.environ.get('PROFILE_MAX_FILES', 200)),
+    max_age_days=float(os.environ.get('PROFILE_MAX_AGE_DAYS', 7)),
+)
+
+# --- コンパイル済みSQLのキャッシュのヒット率 (/admin/metrics/sql-cache) ---
+compiled_cache_stats = CompiledCacheStats()
+compiled_cache_stats.install()
+
+# --- DBが遅い・応答しないときのダッシュボード (/admin/metrics/dashboard) ---
+# 接続できない・タイムアウトした (DBの状態による) 例外。クエリの誤りなどは含めない
+DB_UNAVAILABLE = (OperationalError, InterfaceError, PoolTimeoutError)
+# ダッシュボードのSQL1つあたりの実行時間の上限 (ミリ秒、PostgreSQLのみ。0 で上限なし)
+app.config['DASHBOARD_STATEMENT_TIMEOUT_MS'] = int(os.environ.get('DASHBOARD_STATEMENT_TIMEOUT_MS', 2000))
+# 失敗が DB_BREAKER_FAILURES 回続いたら、DB_BREAKER_RESET_SECONDS 秒はDBに問い合わせない
+dashboard_breaker = CircuitBreaker(
+    failure_threshold=int(os.environ.get('DB_BREAKER_FAILURES', 5)),
+    reset_timeout=float(os.environ.get('DB_BREAKER_RESET_SECONDS', 30)),
+    failure_types=DB_UNAVAILABLE,
+)
+# 組織・絞り込みの条件ごとに、最後に読めたダッシュボードのデータを保持する件数
+dashboard_cache = StaleCache(max_entries=int(os.environ.get('DASHBOARD_STALE_CACHE_SIZE', 256)))
+# セッションごとに、最後に読めたログインユーザー (ロール・組織を含む列の値) を保持する件数
+session_user_cache = StaleCache(max_entries=int(os.environ.get('SESSION_USER_STALE_CACHE_SIZE', 1024)))
+
+# SQLiteは接続ごとに外部キー制約 (ON DELETE CASCADE を含む) を有効にする必要がある
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
 # --- 定数 ---
 # SQLAlchemyとMigrateの初期化をapp.config設定後に行う
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+# online_migrations のヘルパーは途中でコミットするため、マイグレーションごとにトランザクションを分ける
+migrate = Migrate(app, db, transaction_per_migration=True)
 
 
 TICKET_STATUSES = ['新規', '対応中', '保留', '解決済み', 'クローズ']
+# 担当者の作業キューに並べる (未解決の) ステータス
+OPEN_STATUSES = [status for status in TICKET_STATUSES if status not in RESOLVED_STATUSES]
 PRIORITIES = {1: "低", 2: "中", 3: "高"}
+# 新しいチケットの担当者の自動割り当ての方式 (assignment.py)
+AUTO_ASSIGN_STRATEGIES = {
+    'round_robin': "順番に割り当てる",
+    'least_open': "未解決のチケットが最も少ない人",
+    'priority_weighted': "未解決のチケットの優先度の合計が最も小さい人",
+}
 
 # --- データベースモデル ---
 
@@ -50,8 +171,13 @@ class Organization(db.Model):
     __tablename__ = 'organizations'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), unique=True, nullable=False)
-    users = db.relationship('User', backref='organization', lazy='dynamic') # type: ignore
-    tickets = db.relationship('Ticket', backref='organization', lazy='dynamic') # type: ignore
+    # updated_at は分析用スナップショット (flask snapshot) の差分の取得に使う (ユーザー・チケット・サブチケットも同様)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    # 新しいチケットの担当者の自動割り当ての方式 (AUTO_ASSIGN_STRATEGIES のキー。None なら割り当てない)
+    auto_assign_strategy = db.Column(db.String(20), nullable=True)
+    # 組織の削除時はDBの ON DELETE CASCADE に任せ、子の行をセッションに読み込まない
+    users = db.relationship('User', backref='organization', lazy='dynamic', passive_deletes=True) # type: ignore
+    tickets = db.relationship('Ticket', backref='organization', lazy='dynamic', passive_deletes=True) # type: ignore
 
 class Role(db.Model):
     __tablename__ = 'roles'
@@ -65,46 +191,547 @@ class User(UserMixin, db.Model):
     username = db.Column(db.String(80), nullable=False)
     password_hash = db.Column(db.String(255), nullable=False)
 
-    organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id'), nullable=False)
+    organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id', ondelete='CASCADE'), nullable=False, index=True)
     role_id = db.Column(db.Integer, db.ForeignKey('roles.id'), nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
     # ユーザーが一意である制約を organization_id と username の組み合わせにする
-    __table_args__ = (db.UniqueConstraint('username', 'organization_id', name='_username_org_uc'),)
+    # info の tenant は、組織のシャードに置かれるテーブルであることを示す
+    __table_args__ = (db.UniqueConstraint('username', 'organization_id', name='_username_org_uc'),
+                      {'info': {'tenant': True}})
 
     # リレーションシップ
     requested_tickets = db.relationship('Ticket', foreign_keys='Ticket.requester_id', backref='requester', lazy=True)
-    assigned_tickets = db.relationship('Ticket', foreign_keys='Ticket.assignee_id', backref='assignee', lazy=True)
+    assigned_tickets = db.relationship('Ticket', foreign_keys='Ticket.assignee_id', backref='assignee', lazy=True,
+                                       passive_deletes=True)
+
+    def get_id(self):
+        # ユーザーIDはシャードごとに採番され、シャード間の移動でも採番し直されるため、
+        # 組織IDとログインしたときの組織のシャードを組み合わせてセッションに保存する
+        return f"{self.organization_id}:{self.id}@{shard_directory.lookup(self.organization_id).shard_key}"
 
     def is_admin(self):
         return self.role and self.role.name == 'admin'
 
 class Ticket(db.Model):
     __tablename__ = 'tickets'
+    __table_args__ = {'info': {'tenant': True}}
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255), nullable=False)
     status = db.Column(db.String(50), nullable=False, default='新規')
     due_date = db.Column(db.Date, nullable=True)
-    priority = db.Column(db.Integer, nullable=True, default=2)
+    # 作業キューの並び順に使うため必須 (NULLの並び順はDBによって異なる)
+    priority = db.Column(db.Integer, nullable=False, default=2)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-
-    organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id'), nullable=False)
+    # 解決済み・クローズになった日時 (ステータスを変更すると自動で設定・解除される)
+    resolved_at = db.Column(db.DateTime, nullable=True, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    # 楽観的排他制御の版数。更新のたびに1増え、UPDATE文は読み込んだときの版数の行だけを更新する
+    # (一致しなければ StaleDataError)。UPDATE文で直接更新する場合も version を1増やすこと
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id', ondelete='CASCADE'), nullable=False, index=True)
     requester_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    assignee_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)  # 担当者は未定の場合もある
+    # 担当者は未定の場合もある。担当者のユーザーが削除された場合は未割り当てに戻す
+    assignee_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'), nullable=True)
+
+    # サブチケットはDBの ON DELETE CASCADE で削除する (1行ずつ読み込んでDELETEしない)
+    subtickets = db.relationship('SubTicket', backref='ticket', lazy=True, cascade="all, delete-orphan",
+                                 passive_deletes=True)
+    attachments = db.relationship('Attachment', backref='ticket', lazy=True, cascade="all, delete-orphan",
+                                  passive_deletes=True, order_by='Attachment.id')
+
+    __mapper_args__ = {'version_id_col': version}
+
+    # 一覧用の TicketRow と同じ名前で、テンプレートやJSONから参照できるようにする
+    @property
+    def requester_name(self):
+        return self.requester.username if self.requester else None
+
+    @property
+    def assignee_name(self):
+        return self.assignee.username if self.assignee else None
+
+@event.listens_for(Ticket.status, 'set')
+def track_resolved_at(ticket, value, oldvalue, initiator):
+    if value in RESOLVED_STATUSES:
+        if oldvalue not in RESOLVED_STATUSES or ticket.resolved_at is None:
+            ticket.resolved_at = datetime.utcnow()
+    else:
+        ticket.resolved_at = None
+
+
+# 作業キューの並び順: 優先度の高い順、期限日の近い順 (期限日なしは最後)、古い順 (IDの昇順)
+QUEUE_ORDER = (Ticket.priority.desc(), Ticket.due_date.is_(None), Ticket.due_date, Ticket.id)
 
-    subtickets = db.relationship('SubTicket', backref='ticket', lazy=True, cascade="all, delete-orphan")
+# 未解決のチケットだけの部分インデックス。担当者ごとのキューと、組織の未割り当てのキュー (claim) 用
+db.Index('ix_tickets_open_queue', Ticket.assignee_id, *QUEUE_ORDER,
+         postgresql_where=Ticket.status.in_(OPEN_STATUSES), sqlite_where=Ticket.status.in_(OPEN_STATUSES))
+db.Index('ix_tickets_unassigned_queue', Ticket.organization_id, *QUEUE_ORDER,
+         postgresql_where=Ticket.assignee_id.is_(None) & Ticket.status.in_(OPEN_STATUSES),
+         sqlite_where=Ticket.assignee_id.is_(None) & Ticket.status.in_(OPEN_STATUSES))
+
+def _next_subticket_position(context):
+    """ORMで1件ずつ追加するサブチケットの並び順 (チケットのサブチケットの末尾)"""
+    subtickets = SubTicket.__table__
+    return context.connection.scalar(
+        select(func.coalesce(func.max(subtickets.c.position), 0) + 1)
+        .where(subtickets.c.ticket_id == context.get_current_parameters()['ticket_id']))
 
 class SubTicket(db.Model):
     __tablename__ = 'subtickets'
+    __table_args__ = {'info': {'tenant': True}}
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255), nullable=False)
     completed = db.Column(db.Boolean, nullable=False, default=False)
-    ticket_id = db.Column(db.Integer, db.ForeignKey('tickets.id'), nullable=False)
+    ticket_id = db.Column(db.Integer, db.ForeignKey('tickets.id', ondelete='CASCADE'), nullable=False, index=True)
+    # 親のサブチケット (None ならチケットの直下)。入れ子にしても ticket_id は常にチケットを指す
+    parent_id = db.Column(db.Integer, db.ForeignKey('subtickets.id', ondelete='CASCADE'), nullable=True, index=True)
+    # 同じ親の中での並び順 (同じ値ならIDの順)。まとめて追加する場合は add_subtickets() で採番する
+    position = db.Column(db.Integer, nullable=False, default=_next_subticket_position)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    # 楽観的排他制御の版数 (Ticket.version と同じ)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
+
+class Attachment(db.Model):
+    """チケットの添付ファイル (本体は attachment_store に組織・内容のハッシュごとに1つだけ置く)"""
+    __tablename__ = 'attachments'
+    # 同じ内容のファイルの有無と、本体が参照されているかを組織ごとに調べる
+    __table_args__ = (db.Index('ix_attachments_organization_id_sha256', 'organization_id', 'sha256'),
+                      {'info': {'tenant': True}})
+    id = db.Column(db.Integer, primary_key=True)
+    organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id', ondelete='CASCADE'), nullable=False)
+    ticket_id = db.Column(db.Integer, db.ForeignKey('tickets.id', ondelete='CASCADE'), nullable=False, index=True)
+    uploaded_by_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'), nullable=True)
+    filename = db.Column(db.String(255), nullable=False)
+    content_type = db.Column(db.String(255), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class TicketDailyStat(db.Model):
+    """組織・担当者・日ごとのチケット数の集計 (flask rollup-stats で更新する派生データ)"""
+    __tablename__ = 'ticket_daily_stats'
+    # derived: シャード移動ではコピーせず、移動先で作り直す
+    __table_args__ = (db.UniqueConstraint('organization_id', 'day', 'assignee_id', name='_ticket_daily_stats_uc'),
+                      {'info': {'tenant': True, 'derived': True}})
+    id = db.Column(db.Integer, primary_key=True)
+    organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id', ondelete='CASCADE'), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    # ユーザーIDはシャード移動で採番し直されるため外部キーにしない (0 は未割り当て)
+    assignee_id = db.Column(db.Integer, nullable=False, default=UNASSIGNED)
+    created_count = db.Column(db.Integer, nullable=False, default=0)
+    resolved_count = db.Column(db.Integer, nullable=False, default=0)
+    overdue_count = db.Column(db.Integer, nullable=False, default=0)
+
+class OrganizationShard(db.Model):
+    """組織がどのシャードに置かれているかを記録するディレクトリ (既定のデータベースに置く)"""
+    __tablename__ = 'organization_shards'
+    organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id'), primary_key=True)
+    shard_key = db.Column(db.String(64), nullable=False, default=DEFAULT_SHARD)
+    # シャード間の移動中は書き込みを止める
+    read_only = db.Column(db.Boolean, nullable=False, default=False)
+
+class OutboxEvent(db.Model):
+    """外部への通知を待つチケット・サブチケットの変更 (変更と同じコミットで書き、flask dispatch-outbox が配信する)"""
+    __tablename__ = 'outbox_events'
+    # 変更と同じトランザクションで書くため組織のシャードに置く。シャード移動ではコピーせず
+    # (移動先で採番し直すと再配信になる)、移動元に残ったイベントは移動元から配信する
+    __table_args__ = (db.Index('ix_outbox_events_organization_id_id', 'organization_id', 'id'),
+                      {'info': {'tenant': True, 'derived': True}})
+    id = db.Column(db.Integer, primary_key=True)
+    organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id', ondelete='CASCADE'), nullable=False)
+    event_type = db.Column(db.String(64), nullable=False)  # 例: 'ticket.created', 'subticket.updated'
+    aggregate_id = db.Column(db.Integer, nullable=False)
+    payload = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+class WebhookSubscription(db.Model):
+    """組織のイベントを受け取るWebhookの送信先 (既定のデータベースに置く)"""
+    __tablename__ = 'webhook_subscriptions'
+    id = db.Column(db.Integer, primary_key=True)
+    organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id', ondelete='CASCADE'), nullable=False,
+                                index=True)
+    url = db.Column(db.String(2048), nullable=False)
+    # 受け取るイベントの種類 (カンマ区切り。None なら全て)
+    event_types = db.Column(db.String(255), nullable=True)
+    active = db.Column(db.Boolean, nullable=False, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class WebhookCursor(db.Model):
+    """購読先・シャードごとの配信済みの位置と、失敗時の再試行の状態"""
+    __tablename__ = 'webhook_cursors'
+    subscription_id = db.Column(db.Integer, db.ForeignKey('webhook_subscriptions.id', ondelete='CASCADE'),
+                                primary_key=True)
+    shard_key = db.Column(db.String(64), primary_key=True)
+    last_event_id = db.Column(db.Integer, nullable=False, default=0)
+    failures = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.String(500), nullable=True)
+    last_delivered_at = db.Column(db.DateTime, nullable=True)
+    # 配信位置より前で、まだコミットされていない (かロールバックされた) イベントID {"ID": 最初に欠けていた日時}
+    pending_gaps = db.Column(db.JSON, nullable=True)
+
+
+# --- シャードディレクトリ ---
+def _load_shard_entry(organization_id):
+    entry = db.session.get(OrganizationShard, organization_id)
+    if entry is None:  # ディレクトリに登録のない組織は既定のデータベースに置かれている
+        return ShardEntry(DEFAULT_SHARD, False)
+    return ShardEntry(entry.shard_key, entry.read_only)
+
+
+shard_directory = ShardDirectory(_load_shard_entry, ttl=app.config['SHARD_DIRECTORY_TTL'])
+
+def reset_connection_pools(close=True):
+    """既定のデータベースと全シャードの接続プールを作り直す (gunicornのfork前後に呼ぶ)
+
+    接続はプロセス間で共有できないため、fork前のマスターでは close=True で閉じ、
+    fork後のワーカーでは close=False で親の接続に触れずに新しいプールへ切り替える。
+    """
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=close)
+    shard_map.reset_pools(close=close)
+
+def shard_engine(shard_key):
+    """シャードキーに対応するエンジンを返す"""
+    return db.engine if shard_key == DEFAULT_SHARD else shard_map.engine(shard_key)
+
+def use_organization_shard(organization_id):
+    """このリクエストのテナントテーブルへのクエリを、組織のシャードに向ける"""
+    entry = shard_directory.lookup(organization_id)
+    use_shard(entry.shard_key)
+    return entry
+
+# --- 組織名・ロールのキャッシュ (ログインとサインアップで毎回DBを引かないように) ---
+def _load_organization_id(name):
+    return db.session.scalar(select(Organization.id).where(Organization.name == name))
+
+def _load_roles():
+    return db.session.execute(select(Role.name, Role.id)).all()
+
+
+organization_ids = OrganizationNameCache(_load_organization_id)
+role_cache = RoleCache(_load_roles)
+
+# --- 新しいチケットの担当者の自動割り当て ---
+def _load_assignment_state(organization_id):
+    """組織のユーザーと、担当者ごとの未解決チケットの件数・優先度の合計 (定期的な読み直しで使う)"""
+    use_organization_shard(organization_id)
+    members = db.session.scalars(select(User.id).where(User.organization_id == organization_id)
+                                 .order_by(User.id)).all()
+    loads = db.session.execute(
+        select(Ticket.assignee_id, func.count(), func.sum(Ticket.priority))
+        .where(Ticket.organization_id == organization_id, Ticket.assignee_id.is_not(None),
+               Ticket.status.in_(OPEN_STATUSES))
+        .group_by(Ticket.assignee_id)
+    ).all()
+    return members, loads
+
+
+auto_assigner = AutoAssigner(_load_assignment_state,
+                             reconcile_interval=float(os.environ.get('AUTO_ASSIGN_RECONCILE_SECONDS', 60)))
+
+def choose_auto_assignee(organization):
+    """組織が自動割り当てを有効にしていれば、新しいチケットの担当者のユーザーIDを返す"""
+    if organization.auto_assign_strategy not in AUTO_ASSIGN_STRATEGIES:
+        return None
+    return auto_assigner.choose(organization.id, organization.auto_assign_strategy)
+
+def _ticket_load(organization_id, assignee_id, status, priority):
+    """チケット1件が担当者の負荷に占める分。未割り当て・解決済みのチケットは None"""
+    if assignee_id is None or status not in OPEN_STATUSES:
+        return None
+    return (organization_id, assignee_id), priority or 0
+
+def _previous_value(ticket, key):
+    history = inspect(ticket).attrs[key].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(ticket, key)
+
+@event.listens_for(RoutingSession, 'after_flush')
+def collect_assignment_deltas(session, flush_context):
+    """フラッシュしたチケットの変更から、担当者の負荷の増減をコミットまで貯めておく"""
+    deltas = session.info.setdefault('assignment_deltas', {})
+
+    def add(load, sign):
+        if load is not None:
+            key, weight = load
+            count_delta, weight_delta = deltas.get(key, (0, 0))
+            deltas[key] = (count_delta + sign, weight_delta + sign * weight)
+
+    for ticket in session.new:
+        if isinstance(ticket, Ticket):
+            add(_ticket_load(ticket.organization_id, ticket.assignee_id, ticket.status, ticket.priority), 1)
+    for ticket in session.dirty:
+        if isinstance(ticket, Ticket):
+            add(_ticket_load(*(_previous_value(ticket, key)
+                               for key in ('organization_id', 'assignee_id', 'status', 'priority'))), -1)
+            add(_ticket_load(ticket.organization_id, ticket.assignee_id, ticket.status, ticket.priority), 1)
+    for ticket in session.deleted:
+        if isinstance(ticket, Ticket):
+            add(_ticket_load(*(_previous_value(ticket, key)
+                               for key in ('organization_id', 'assignee_id', 'status', 'priority'))), -1)
+
+@event.listens_for(RoutingSession, 'after_commit')
+def apply_assignment_deltas(session):
+    deltas = session.info.pop('assignment_deltas', None)
+    if deltas:
+        auto_assigner.apply(deltas)
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def discard_assignment_deltas(session):
+    session.info.pop('assignment_deltas', None)
+
+
+# --- 似ているチケットの検出 (新しいチケットの作成時) ---
+# 入力中のタイトルに似ているチケットとして示す類似度 (タイトルの文字の2-gramの Jaccard 係数の推定値)
+app.config['SIMILAR_TICKET_MIN_SIMILARITY'] = float(os.environ.get('SIMILAR_TICKET_MIN_SIMILARITY', 0.25))
+# この類似度以上のチケットがあれば、作成の前に重複ではないことの確認を求める
+app.config['DUPLICATE_TICKET_MIN_SIMILARITY'] = float(os.environ.get('DUPLICATE_TICKET_MIN_SIMILARITY', 0.5))
+
+def _load_ticket_titles(organization_id):
+    """組織のチケットの (ID, タイトル) (索引を作る・定期的に作り直すときに裏のスレッドで使う)"""
+    with app.app_context():
+        use_organization_shard(organization_id)
+        return db.session.execute(select(Ticket.id, Ticket.title)
+                                  .where(Ticket.organization_id == organization_id)).all()
+
+
+similar_ticket_index = SimilarTicketIndex(
+    _load_ticket_titles, reconcile_interval=float(os.environ.get('SIMILAR_TICKET_RECONCILE_SECONDS', 300)))
+
+def find_similar_tickets(organization_id, title, exclude_id=None, limit=5):
+    """title に似ている組織のチケット (similarity.SimilarTicket の類似度の高い順のリスト)"""
+    return similar_ticket_index.similar(organization_id, title, limit=limit, exclude=exclude_id,
+                                        min_similarity=app.config['SIMILAR_TICKET_MIN_SIMILARITY'])
+
+@event.listens_for(RoutingSession, 'after_flush')
+def collect_title_changes(session, flush_context):
+    """フラッシュしたチケットの追加・タイトルの変更・削除を、コミットまで貯めておく"""
+    changes = session.info.setdefault('title_changes', {})
+    for ticket in session.new:
+        if isinstance(ticket, Ticket):
+            changes[(ticket.organization_id, ticket.id)] = ticket.title
+    for ticket in session.dirty:
+        if isinstance(ticket, Ticket) and inspect(ticket).attrs.title.history.has_changes():
+            changes[(ticket.organization_id, ticket.id)] = ticket.title
+    for ticket in session.deleted:
+        if isinstance(ticket, Ticket):
+            changes[(ticket.organization_id, ticket.id)] = None
+
+@event.listens_for(RoutingSession, 'after_commit')
+def apply_title_changes(session):
+    changes = session.info.pop('title_changes', None)
+    if changes:
+        similar_ticket_index.apply(changes)
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def discard_title_changes(session):
+    session.info.pop('title_changes', None)
+
+
+# --- トランザクションアウトボックス (外部への変更の通知) ---
+# 通知するモデルとイベント名の接頭辞 (例: 'ticket.created')
+OUTBOX_AGGREGATES = {Ticket: 'ticket', SubTicket: 'subticket'}
+# 変更のたびに必ず変わるため、変更点 (changes) には含めない列
+OUTBOX_IGNORED_COLUMNS = {'updated_at', 'version'}
+
+def _json_value(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+def outbox_row(event_type, organization_id, aggregate_id, data, changes=None):
+    """outbox_events に書く1行。data は変更後 (削除では削除前) の値、changes は {列: [変更前, 変更後]}"""
+    payload = {'data': data}
+    if changes:
+        payload['changes'] = changes
+    return {'organization_id': organization_id, 'event_type': event_type, 'aggregate_id': aggregate_id,
+            'payload': payload, 'created_at': datetime.utcnow()}
+
+def _outbox_data(obj):
+    # 読み込み済みの値だけを使い、フラッシュ中に追加のSELECTを発行しない
+    state = inspect(obj)
+    return {attr.key: _json_value(state.dict.get(attr.key)) for attr in state.mapper.column_attrs}
+
+def _outbox_changes(obj):
+    state = inspect(obj)
+    changes = {}
+    for attr in state.mapper.column_attrs:
+        history = state.attrs[attr.key].history
+        if attr.key not in OUTBOX_IGNORED_COLUMNS and (history.added or history.deleted):
+            changes[attr.key] = [_json_value(history.deleted[0] if history.deleted else None),
+                                 _json_value(history.added[0] if history.added else None)]
+    return changes
+
+def _outbox_organization_id(session, obj):
+    if isinstance(obj, Ticket):
+        return obj.organization_id
+    ticket = session.get(Ticket, obj.ticket_id)  # 多くはセッションに読み込み済み
+    return ticket.organization_id if ticket is not None else None
+
+@event.listens_for(RoutingSession, 'after_flush')
+def write_outbox_events(session, flush_context):
+    """フラッシュしたチケット・サブチケットの変更を、同じトランザクションでアウトボックスに書く"""
+    rows = []
+    for action, objects in (('created', session.new), ('updated', session.dirty), ('deleted', session.deleted)):
+        for obj in objects:
+            aggregate = OUTBOX_AGGREGATES.get(type(obj))
+            if aggregate is None:
+                continue
+            changes = _outbox_changes(obj) if action == 'updated' else None
+            if action == 'updated' and not changes:
+                continue
+            organization_id = _outbox_organization_id(session, obj)
+            if organization_id is not None:
+                rows.append(outbox_row(f'{aggregate}.{action}', organization_id, obj.id, _outbox_data(obj), changes))
+    if rows:
+        # 変更と同じシャード・同じトランザクションに書く
+        session.connection(bind_arguments={'mapper': OutboxEvent}).execute(insert(OutboxEvent.__table__), rows)
+
+def create_outbox_dispatcher(**options):
+    """全シャードのアウトボックスを配信するディスパッチャー (flask dispatch-outbox などで使う)"""
+    return OutboxDispatcher(db.engine, {shard_key: shard_engine(shard_key) for shard_key in shard_map.keys()},
+                            OutboxEvent.__table__, WebhookSubscription.__table__, WebhookCursor.__table__,
+                            **options)
+
+def find_login_user(organization_name, username):
+    """ログインするユーザーを、組織・ロールと合わせて1回のクエリで取得する。
+
+    組織IDとシャードはキャッシュから引くため、キャッシュが温まっていればDBへの問い合わせは1回。
+    戻り値は (組織ID, ユーザー)。組織が存在しなければ (None, None)。
+    """
+    cached = organization_ids.get_cached(organization_name) is not None
+    organization_id = organization_ids.lookup(organization_name)
+    if organization_id is None:
+        return None, None
+
+    use_organization_shard(organization_id)
+    user = db.session.scalars(
+        select(User)
+        .join(User.organization)
+        # 組織はシャードにコピーした行を使わず、参照したときに既定のデータベースから読む
+        .options(joinedload(User.role))
+        .where(User.organization_id == organization_id,
+               Organization.name == organization_name,
+               User.username == username)
+    ).first()
+    if user is None and cached:
+        # 組織が削除・再作成されているとキャッシュのIDが古いため、DBから引き直して一度だけ再試行する
+        organization_ids.invalidate(organization_name)
+        return find_login_user(organization_name, username)
+    return organization_id, user
+
+
+SessionUser = namedtuple('SessionUser', ['organization_id', 'user_id', 'shard_key'])
+
+def parse_user_id(user_id):
+    """セッションに保存したユーザーID ('組織ID:ユーザーID@シャード') を分解する (従来の形式で欠けた部分は None)"""
+    user_id, _, shard_key = str(user_id).partition('@')
+    organization_id, _, local_id = user_id.rpartition(':')
+    return SessionUser(int(organization_id) if organization_id else None, int(local_id), shard_key or None)
 
 
 # --- ユーザーローダーとヘルパー ---
+@lru_cache(maxsize=None)
+def _load_user_statement():
+    """load_user のSELECT文。毎リクエスト実行するため一度だけ組み立てる
+
+    画面で参照するロールも同じクエリで読み込む。User.role は Role の backref で
+    マッパーの設定後にできるため、最初の実行時に組み立てる。
+    """
+    return select(User).options(joinedload(User.role)) \
+        .where(User.id == bindparam('user_id'), User.organization_id == bindparam('organization_id'))
+
+def _query_session_user(identity, timeout):
+    organization_id = identity.organization_id
+    if organization_id is None:
+        # シャーディング導入前の形式 ('ユーザーID') のユーザーは既定のデータベースにいる
+        use_shard(DEFAULT_SHARD)
+        organization_id = db.session.scalar(select(User.organization_id).where(User.id == identity.user_id))
+        if organization_id is None:
+            return None
+    # シャード間の移動でユーザーIDは採番し直されるため、ログインしたときと組織のシャードが異なるセッションでは
+    # ログインし直してもらう (シャードを含まない従来の形式は、既定のデータベースでのログインとみなす)
+    if use_organization_shard(organization_id).shard_key != (identity.shard_key or DEFAULT_SHARD):
+        return None
+    # 組織の変更は既定のデータベースにだけ書くため、シャードにコピーした行ではなく既定のデータベースから読む
+    if db.session.get(Organization, organization_id) is None:
+        return None
+    limit_statement_time(timeout, User)
+    return db.session.scalars(_load_user_statement(), {'user_id': identity.user_id,
+                                                       'organization_id': organization_id}).one_or_none()
+
+def _load_session_user(user_id):
+    """セッションのユーザーIDのユーザー (ロールを含む)。いなければ None
+
+    ダッシュボードと同じ上限をSQLそれぞれの実行時間に設け、読み込んだ後はリクエストの残りのSQLのために戻す。
+    """
+    timeout = app.config['DASHBOARD_STATEMENT_TIMEOUT_MS']
+    try:
+        limit_statement_time(timeout, Organization)
+        user = _query_session_user(parse_user_id(user_id), timeout)
+    except DB_UNAVAILABLE:
+        # 取り消されたトランザクションのままでは後続のクエリも失敗するため、戻しておく
+        db.session.rollback()
+        raise
+    reset_statement_time(timeout, Organization, User)
+    return user
+
+def _session_user_snapshot(user):
+    """DBに問い合わせずに current_user を作り直すための、ユーザー・ロール・組織の列の値"""
+    if user is None:
+        return None
+    return tuple({attribute.key: getattr(obj, attribute.key) for attribute in inspect(obj).mapper.column_attrs}
+                 for obj in (user, user.role, user.organization))
+
+def _session_user_from_snapshot(snapshot):
+    """保持していた値から作る、セッションに入れないユーザー (画面の表示には使えるが、書き込みはできない)"""
+    if snapshot is None:
+        return None
+    user_values, role_values, organization_values = snapshot
+    user = User(**user_values)
+    # backref を発火させず、読み込み済みの関連として設定する
+    set_committed_value(user, 'role', Role(**role_values))
+    set_committed_value(user, 'organization', Organization(**organization_values))
+    return user
+
+def refresh_session_user(user_id):
+    """裏のスレッドでログインユーザーを読み直す (リクエストの外なのでアプリケーションコンテキストを作る)"""
+    with app.app_context():
+        return _session_user_snapshot(dashboard_breaker.call(_load_session_user, user_id))
+
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.get(User, int(user_id))
+    """ログインユーザーをダッシュボードと同じサーキットブレーカー越しに読み込む
+
+    DBに接続できない・上限の時間を超えた・回路が開いているときは、同じセッションで最後に読めた
+    ユーザーをDBに問い合わせずに作り直して返し、裏で読み直す。読めたことがなければ 503 にする。
+    """
+    loaded = []
+
+    def load():
+        loaded.append(dashboard_breaker.call(_load_session_user, user_id))
+        return _session_user_snapshot(loaded[0])
+
+    try:
+        served = session_user_cache.serve(user_id, load, refresh=lambda: refresh_session_user(user_id),
+                                          failure_types=DB_UNAVAILABLE)
+    except (CircuitOpen, *DB_UNAVAILABLE):
+        abort(503)
+    return _session_user_from_snapshot(served.value) if served.stale else loaded[0]
+
+@app.before_request
+def reject_writes_during_shard_move():
+    # シャード間の移動中の組織は、コピーとの整合性を保つため書き込みを受け付けない
+    if request.method in ('GET', 'HEAD', 'OPTIONS') or not current_user.is_authenticated:
+        return None
+    if shard_directory.lookup(current_user.organization_id).read_only:
+        abort(503)
+    return None
 
 def admin_required(f):
     @wraps(f)
@@ -127,58 +754,824 @@ def init_db_command():
         for role_name in roles:
             db.session.add(Role(name=role_name))
         db.session.commit()
+        role_cache.invalidate()
         print("Roles created.")
     else:
         print("Roles already exist.")
     print("Database initialized.")
 
+@app.cli.command("init-shards")
+def init_shards_command():
+    """SHARD_DATABASE_URLS に設定した各シャードにテーブルを作成します。"""
+    for shard_key in shard_map.keys():
+        if shard_key != DEFAULT_SHARD:
+            db.metadata.create_all(shard_engine(shard_key))
+            print(f"Shard '{shard_key}' initialized.")
+
+@app.cli.command("migration-plan")
+@click.argument("revision", required=False)
+def migration_plan_command(revision):
+    """未適用のマイグレーション (またはREVISION) を試しに実行し、文ごとの時間とロックを表示します。
+
+    変更はすべてロールバックします。本番に近い量のデータを入れたローカルのPostgreSQLに対して実行してください。
+    """
+    # alembic のスクリプトの読み込みはこのコマンドでしか使わない
+    from alembic.migration import MigrationContext
+    from alembic.operations import Operations
+    from alembic.script import ScriptDirectory
+    from online_migrations import dry_run
+
+    script = ScriptDirectory.from_config(migrate.get_config())
+    if revision:
+        revisions = [script.get_revision(revision)]
+    else:
+        with db.engine.connect() as connection:
+            current = MigrationContext.configure(connection).get_current_revision() or 'base'
+        revisions = list(reversed(list(script.iterate_revisions('heads', current))))
+    if not revisions:
+        print("未適用のマイグレーションはありません。")
+        return
+    with dry_run(db.engine) as plan, Operations.context(MigrationContext.configure(plan.connection)):
+        for script_revision in revisions:
+            plan.revision = f"{script_revision.revision} {script_revision.doc}"
+            script_revision.module.upgrade()
+    for line in plan.report_lines():
+        print(line)
+
+@app.cli.command("move-org")
+@click.argument("organization_name")
+@click.argument("target_shard")
+@click.option("--batch-size", default=1000, show_default=True, help="1回にコピー・削除する行数")
+@click.option("--drain-seconds", type=float, default=None,
+              help="各ワーカーのディレクトリキャッシュが更新されるまで待つ秒数 (既定: SHARD_DIRECTORY_TTL + 1)")
+@click.option("--keep-source", is_flag=True, help="切り替え後も移動元のデータを削除しない")
+def move_org_command(organization_name, target_shard, batch_size, drain_seconds, keep_source):
+    """組織のデータを別のシャードへ移動します (書き込み停止→コピー→切り替え)。"""
+    organization = Organization.query.filter_by(name=organization_name).first()
+    if organization is None:
+        raise click.ClickException(f"組織が見つかりません: {organization_name}")
+    if target_shard not in shard_map.keys():
+        raise click.ClickException(f"未定義のシャードです: {target_shard}")
+    if drain_seconds is None:
+        drain_seconds = app.config['SHARD_DIRECTORY_TTL'] + 1
+
+    directory_entry = db.session.get(OrganizationShard, organization.id) or OrganizationShard(
+        organization_id=organization.id, shard_key=DEFAULT_SHARD)
+    source_shard = directory_entry.shard_key
+    if source_shard == target_shard:
+        print(f"組織 '{organization_name}' は既にシャード '{target_shard}' にあります。")
+        return
+
+    # 1. 書き込みを止め、全ワーカーのキャッシュに反映されるまで待つ
+    directory_entry.read_only = True
+    db.session.add(directory_entry)
+    db.session.commit()
+    print(f"組織 '{organization_name}' を読み取り専用にしました。{drain_seconds}秒待機します...")
+    time.sleep(drain_seconds)
 
-# --- ルーティング ---
-@app.route('/')
-@login_required
-def index():
     try:
+        # 2. 移動先へ1つのトランザクションでコピーする
+        print(f"シャード '{source_shard}' から '{target_shard}' へコピーしています...")
+        with shard_engine(source_shard).connect() as source, shard_engine(target_shard).begin() as target:
+            copy_global_rows(db.session.connection(), target, db.metadata, organization.id)
+            copy_organization(source, target, db.metadata, organization.id, batch_size=batch_size, log=print)
+            rebuild_organization(target, Ticket.__table__, TicketDailyStat.__table__, organization.id,
+                                 datetime.utcnow().date())
+    except Exception:
+        directory_entry.read_only = False
+        db.session.commit()
+        raise
+
+    # 3. ディレクトリを切り替えて書き込みを再開する
+    directory_entry.shard_key = target_shard
+    directory_entry.read_only = False
+    db.session.commit()
+    shard_directory.invalidate(organization.id)
+    # ユーザーIDは移動先で採番し直されるため、自動割り当ての表も読み直す
+    auto_assigner.invalidate(organization.id)
+    similar_ticket_index.invalidate(organization.id)
+    print(f"組織 '{organization_name}' をシャード '{target_shard}' に切り替えました。")
+
+    # 4. 古いキャッシュで移動元を読むワーカーがいなくなってから、移動元のデータを削除する
+    if not keep_source:
+        time.sleep(drain_seconds)
+        purge_organization(shard_engine(source_shard), db.metadata, organization.id,
+                           batch_size=batch_size, log=print)
+        print("移動元のデータを削除しました。")
+
+@app.cli.command("rollup-stats")
+@click.option("--days", default=2, show_default=True, help="作り直す直近の日数 (今日を含む)")
+@click.option("--backfill", is_flag=True, help="全組織の全期間を作り直す")
+def rollup_stats_command(days, backfill):
+    """チケットの日次集計 (作成・解決・期限切れ) を更新します。定期的に実行してください。"""
+    today = datetime.utcnow().date()
+    tickets, stats = Ticket.__table__, TicketDailyStat.__table__
+    for shard_key in shard_map.keys():
+        engine = shard_engine(shard_key)
+        if backfill:
+            # 組織ごとにコミットし、長いトランザクションを避ける
+            with engine.connect() as connection:
+                organization_ids_on_shard = connection.scalars(select(tickets.c.organization_id).distinct()).all()
+            written = 0
+            for organization_id in organization_ids_on_shard:
+                with engine.begin() as connection:
+                    written += rebuild_organization(connection, tickets, stats, organization_id, today)
+        else:
+            with engine.begin() as connection:
+                written = refresh_window(connection, tickets, stats, today - timedelta(days=days - 1), today)
+        print(f"Shard '{shard_key}': {written} 行の集計を書き込みました。")
+
+@app.cli.command("snapshot")
+@click.option("--output", default=lambda: os.environ.get('SNAPSHOT_DIR', os.path.join(app.instance_path, 'snapshots')),
+              show_default="$SNAPSHOT_DIR または instance/snapshots", help="書き出し先のディレクトリ")
+@click.option("--full", is_flag=True, help="差分ではなく全件を書き出す (削除・シャード移動を反映する)")
+@click.option("--batch-size", default=10000, show_default=True, help="1回に読み込む行数 (Parquetの行グループの行数)")
+@click.option("--lag-minutes", default=5, show_default=True, help="コミット待ちの変更を取りこぼさないよう、直近の何分を次回に回すか")
+def snapshot_command(output, full, batch_size, lag_minutes):
+    """チケット・サブチケット・ユーザー・組織を分析用のParquetファイルへ書き出します。"""
+    # pyarrow はこのコマンドでしか使わないため、Webのワーカーでは読み込まない
+    from snapshot import snapshot
+
+    with db.engine.connect() as default_connection:
+        sources = [(DEFAULT_SHARD, default_connection, Organization.__table__, False)]
+        connections = {DEFAULT_SHARD: default_connection}
+        try:
+            for shard_key in shard_map.keys():
+                if shard_key not in connections:
+                    connections[shard_key] = shard_engine(shard_key).connect()
+                for model in (User, Ticket, SubTicket):
+                    sources.append((shard_key, connections[shard_key], model.__table__, True))
+            snapshot(sources, output, full=full, lag=timedelta(minutes=lag_minutes), batch_size=batch_size, log=print)
+        finally:
+            for shard_key, connection in connections.items():
+                if shard_key != DEFAULT_SHARD:
+                    connection.close()
+    print(f"スナップショットを書き出しました: {output}")
+
+@app.cli.command("add-webhook")
+@click.argument("organization_name")
+@click.argument("url")
+@click.option("--events", default=None, help="受け取るイベントの種類 (カンマ区切り、例: ticket.created,ticket.updated)。省略すると全て")
+def add_webhook_command(organization_name, url, events):
+    """組織のチケット・サブチケットの変更を受け取るWebhookの送信先を登録します。"""
+    organization = Organization.query.filter_by(name=organization_name).first()
+    if organization is None:
+        raise click.ClickException(f"組織が見つかりません: {organization_name}")
+    if not url.startswith(('http://', 'https://')):
+        raise click.ClickException(f"URLは http:// または https:// で始めてください: {url}")
+    subscription = WebhookSubscription(organization_id=organization.id, url=url, event_types=events)
+    db.session.add(subscription)
+    db.session.commit()
+    print(f"Webhook {subscription.id} を登録しました: {url}")
+
+@app.cli.command("dispatch-outbox")
+@click.option("--once", is_flag=True, help="未配信のイベントを1回送って終了する")
+@click.option("--batch-size", default=100, show_default=True, help="1回のPOSTにまとめるイベントの最大数")
+@click.option("--poll-interval", default=1.0, show_default=True, help="送るものがないときに待つ秒数")
+@click.option("--settle-seconds", default=2.0, show_default=True,
+              help="コミット前のイベントを飛ばさないよう、作成から何秒経ったイベントを送るか")
+@click.option("--gap-timeout-seconds", default=600.0, show_default=True,
+              help="欠番のイベントのコミットを待つ秒数 (過ぎたらロールバックされたものとみなす)")
+@click.option("--retention-days", default=7, show_default=True, help="この日数より古いイベントを削除する (0なら削除しない)")
+def dispatch_outbox_command(once, batch_size, poll_interval, settle_seconds, gap_timeout_seconds, retention_days):
+    """アウトボックスのイベントを購読先へWebhookで配信します (常駐させてください)。"""
+    dispatcher = create_outbox_dispatcher(batch_size=batch_size, settle=timedelta(seconds=settle_seconds),
+                                          gap_timeout=timedelta(seconds=gap_timeout_seconds), log=print)
+    try:
+        if once:
+            print(f"{dispatcher.run_once()} 件のイベントを配信しました。")
+        else:
+            dispatcher.run(poll_interval=poll_interval,
+                           prune_after=timedelta(days=retention_days) if retention_days else None)
+    finally:
+        dispatcher.close()
+
+@app.cli.command("outbox-status")
+def outbox_status_command():
+    """Webhookの購読先・シャードごとの未配信のイベント数と配信の状態を表示します。"""
+    for lag in create_outbox_dispatcher().lag():
+        oldest = f"{lag.oldest_pending_at:%Y-%m-%d %H:%M:%S}" if lag.oldest_pending_at else "-"
+        line = (f"#{lag.subscription_id} {lag.url} [{lag.shard_key}] 配信済み {lag.last_event_id} / "
+                f"未配信 {lag.pending} 件 (最古 {oldest})")
+        if lag.failures:
+            line += f" 失敗 {lag.failures} 回: {lag.last_error}"
+        print(line)
+
+@app.cli.command("build-assets")
+def build_assets_command():
+    """テンプレートで使っているクラスからCSSをビルドし、ハッシュ付きの名前で書き出します。"""
+    for logical_name, hashed_name in build_assets(output_dir=asset_manifest.output_dir).items():
+        print(f"{logical_name} -> {hashed_name}")
+    asset_manifest.reload()
+
+@app.cli.command("purge-org")
+@click.argument("organization_name")
+@click.option("--batch-size", default=500, show_default=True, help="1回のDELETEで削除する行数")
+@click.option("--pause", type=float, default=0.05, show_default=True, help="バッチ間の待機秒数")
+@click.option("--yes", is_flag=True, help="確認せずに削除する")
+def purge_org_command(organization_name, batch_size, pause, yes):
+    """組織とその全データ (ユーザー・チケット・サブチケット) を一定件数ずつ削除します。"""
+    organization = Organization.query.filter_by(name=organization_name).first()
+    if organization is None:
+        raise click.ClickException(f"組織が見つかりません: {organization_name}")
+    if not yes:
+        click.confirm(f"組織 '{organization_name}' のすべてのデータを削除しますか？", abort=True)
+
+    organization_id = organization.id
+    shard_key = shard_directory.lookup(organization_id).shard_key
+    # 長いロックを避けるため、テナントデータはバッチごとにコミットしながら削除する
+    purge_organization(shard_engine(shard_key), db.metadata, organization_id,
+                       batch_size=batch_size, pause=pause, log=print)
+
+    organizations = Organization.__table__
+    if shard_key != DEFAULT_SHARD:
+        with shard_engine(shard_key).begin() as connection:
+            connection.execute(organizations.delete().where(organizations.c.id == organization_id))
+    db.session.execute(OrganizationShard.__table__.delete().filter_by(organization_id=organization_id))
+    db.session.execute(organizations.delete().where(organizations.c.id == organization_id))
+    db.session.commit()
+    shard_directory.invalidate(organization_id)
+    organization_ids.invalidate(organization_name)
+    auto_assigner.invalidate(organization_id)
+    similar_ticket_index.invalidate(organization_id)
+    print(f"組織 '{organization_name}' を削除しました。")
+
+def _referenced_attachments(organization_id):
+    """組織の添付ファイルの行が参照している本体のハッシュ (削除済みの組織は空)"""
+    with app.app_context():
+        use_organization_shard(organization_id)
+        return set(db.session.scalars(select(Attachment.sha256).distinct()
+                                      .where(Attachment.organization_id == organization_id)))
+
+@app.cli.command("prune-attachments")
+@click.option("--grace-hours", type=float, default=24, show_default=True,
+              help="この時間より前に更新されたファイルだけを削除する (アップロード中のファイルを残すため)")
+def prune_attachments_command(grace_hours):
+    """チケット・組織の削除で参照されなくなった添付ファイルの本体を削除します。"""
+    removed = attachment_store.prune(_referenced_attachments, grace_seconds=grace_hours * 3600, log=print)
+    print(f"{removed} 件のファイルを削除しました。")
+
+
+# --- クエリ・シリアライズの共通処理 ---
+TICKET_SORT_COLUMNS = {
+    'priority': Ticket.priority,
+    'due_date': Ticket.due_date,
+    'id': Ticket.id
+}
+
+# 作業キューの1ページの件数 (APIの limit の既定値と上限)
+QUEUE_PAGE_SIZE = 20
+MAX_QUEUE_PAGE_SIZE = 100
+
+# ダッシュボード一覧の1行分 (表示する列だけを持つ読み取り専用の行)
+TicketRow = namedtuple('TicketRow', ['id', 'title', 'status', 'priority', 'due_date', 'created_at', 'version',
+                                     'assignee_id', 'requester_name', 'assignee_name'])
+
+def _select_ticket_rows():
+    """TicketRow の列 (依頼者・担当者のユーザー名を結合) を取得するSELECT文"""
+    requester = aliased(User, name='requester')
+    assignee = aliased(User, name='assignee')
+    return select(
+        Ticket.id, Ticket.title, Ticket.status, Ticket.priority, Ticket.due_date, Ticket.created_at, Ticket.version,
+        Ticket.assignee_id, requester.username.label('requester_name'),
+        assignee.username.label('assignee_name')
+    ).join(requester, Ticket.requester_id == requester.id) \
+     .outerjoin(assignee, Ticket.assignee_id == assignee.id)
+
+def build_ticket_list_query(organization_id, filter_status=None, search_term=None, sort_by='id', sort_order='desc'):
+    """ダッシュボード一覧用のSELECT文と、そのパラメータを返す。
+
+    ORMのインスタンスは作らず、表示する列と依頼者・担当者のユーザー名だけをSQLで結合して取得する。
+    結果は to_ticket_rows() で TicketRow に変換する。
+    同期 (index) と非同期 (async_app) の両方の読み取り経路で共有する。
+    session.execute(*build_ticket_list_query(...)) のように実行する。
+    """
+    filter_by_status = bool(filter_status and filter_status != 'all')
+    params = {'organization_id': organization_id}
+    if filter_by_status:
+        params['filter_status'] = filter_status
+    if search_term:
+        params['search_pattern'] = f'%{search_term}%'
+    stmt = _ticket_list_statement(filter_by_status, bool(search_term),
+                                  sort_by if sort_by in TICKET_SORT_COLUMNS else 'id', sort_order == 'desc')
+    return stmt, params
+
+@lru_cache(maxsize=None)
+def _ticket_list_statement(filter_by_status, search, sort_by, descending):
+    """絞り込み・並び順の組み合わせごとに一度だけ組み立てる一覧のSELECT文 (値は bindparam)
+
+    同じ文のオブジェクトを使い回すため、リクエストごとの文の組み立てと
+    コンパイル済みSQLのキャッシュキーの計算を省ける。組み合わせは 2×2×3×2 通り。
+    """
+    stmt = _select_ticket_rows().where(Ticket.organization_id == bindparam('organization_id'))
+
+    # 絞り込み (フィルタリング)
+    if filter_by_status:
+        stmt = stmt.where(Ticket.status == bindparam('filter_status'))
+
+    # 検索機能
+    if search:
+        stmt = stmt.where(Ticket.title.ilike(bindparam('search_pattern')))
+
+    # 並び替え機能 (デフォルトはID降順)
+    order_column = TICKET_SORT_COLUMNS[sort_by]
+    if descending:
+        return stmt.order_by(order_column.desc())
+    return stmt.order_by(order_column.asc())
+
+def to_ticket_rows(result):
+    return [TicketRow._make(row) for row in result]
+
+def limit_statement_time(milliseconds, mapper):
+    """このトランザクションで mapper のテーブルに対して実行するSQLそれぞれの実行時間の上限を設定する
+
+    PostgreSQLのみ (上限を超えたSQLは取り消され OperationalError になる)。テナントテーブルは
+    組織のシャードにあるため、mapper のテーブルを読む接続に設定する。設定はトランザクションの終わりまで有効。
+    """
+    if not milliseconds:
+        return
+    connection = db.session.connection(bind_arguments={'mapper': mapper})
+    if connection.dialect.name == 'postgresql':
+        connection.execute(select(func.set_config('statement_timeout', f'{int(milliseconds)}ms', True)))
+
+def reset_statement_time(milliseconds, *mappers):
+    """limit_statement_time で設定した上限を、トランザクションの残りのSQLについて元に戻す"""
+    if not milliseconds:
+        return
+    for mapper in mappers:
+        connection = db.session.connection(bind_arguments={'mapper': mapper})
+        if connection.dialect.name == 'postgresql':
+            connection.exec_driver_sql("SET LOCAL statement_timeout TO DEFAULT")
+
+def load_dashboard(organization_id, filter_status=None, search_term=None, sort_by='id', sort_order='desc'):
+    """ダッシュボードの担当者の選択肢とチケット一覧 ((tickets, organization_users))"""
+    try:
+        limit_statement_time(app.config['DASHBOARD_STATEMENT_TIMEOUT_MS'], Ticket)
         # ログインユーザーが所属する組織の全ユーザーを取得
-        organization_users = User.query.filter_by(organization_id=current_user.organization_id).all()
-
+        organization_users = db.session.execute(*build_organization_users_query(organization_id)).all()
         # ベースとなるクエリ (自組織のチケットのみ)
-        # joinedloadを使用してN+1問題を回避
-        query = Ticket.query.options(
-            joinedload(Ticket.requester),
-            joinedload(Ticket.assignee)
-        ).filter_by(organization_id=current_user.organization_id)
-
-        # 絞り込み (フィルタリング)
-        filter_status = request.args.get('filter_status')
-        if filter_status and filter_status != 'all':
-            query = query.filter(Ticket.status == filter_status)
-
-        # 検索機能
-        search_term = request.args.get('search_term')
-        if search_term:
-            query = query.filter(Ticket.title.ilike(f'%{search_term}%'))
-
-        # 並び替え機能 (デフォルトはID降順)
-        sort_by = request.args.get('sort_by', 'id')
-        sort_order = request.args.get('sort_order', 'desc')
-
-        sort_logic = {
-            'priority': Ticket.priority,
-            'due_date': Ticket.due_date,
-            'id': Ticket.id
-        }
-
-        order_column = sort_logic.get(sort_by, Ticket.id)
-        if sort_order == 'desc':
-            query = query.order_by(order_column.desc())
+        tickets = to_ticket_rows(db.session.execute(*build_ticket_list_query(
+            organization_id,
+            filter_status=filter_status,
+            search_term=search_term,
+            sort_by=sort_by,
+            sort_order=sort_order
+        )))
+    except DB_UNAVAILABLE:
+        # 取り消されたトランザクションのままでは後続のクエリも失敗するため、戻しておく
+        db.session.rollback()
+        raise
+    return tickets, organization_users
+
+def refresh_dashboard(organization_id, **filters):
+    """裏のスレッドでダッシュボードのデータを読み直す (リクエストの外なのでアプリケーションコンテキストを作る)"""
+    with app.app_context():
+        use_organization_shard(organization_id)
+        return dashboard_breaker.call(load_dashboard, organization_id, **filters)
+
+def serve_dashboard(organization_id, **filters):
+    """ダッシュボードのデータ (resilience.Served)
+
+    回路が開いているとき・DBに接続できないかSQLが上限の時間を超えたときは、同じ組織・条件で
+    最後に読めたデータを stale=True で返し、裏で読み直す。読めたデータがなければ例外を送出する。
+    """
+    return dashboard_cache.serve(
+        (organization_id, *sorted(filters.items())),
+        lambda: dashboard_breaker.call(load_dashboard, organization_id, **filters),
+        refresh=lambda: refresh_dashboard(organization_id, **filters),
+        failure_types=DB_UNAVAILABLE,
+    )
+
+
+_TICKET_ROW = _select_ticket_rows().where(Ticket.id == bindparam('ticket_id'))
+
+def load_ticket_row(ticket_id):
+    """チケット1件の TicketRow"""
+    return TicketRow._make(db.session.execute(_TICKET_ROW, {'ticket_id': ticket_id}).one())
+
+def build_queue_query(organization_id, assignee_id, after=None, limit=QUEUE_PAGE_SIZE):
+    """担当者の作業キュー (未解決のチケットを QUEUE_ORDER の順に) を取得するSELECT文
+
+    after には前のページの最後の行を渡す (キーセットページネーション)。OFFSETを使わないため、
+    ページが進んでも ix_tickets_open_queue を先頭から読み飛ばさない。
+    """
+    stmt = _select_ticket_rows().where(Ticket.organization_id == organization_id,
+                                       Ticket.assignee_id == assignee_id,
+                                       Ticket.status.in_(OPEN_STATUSES))
+    if after is not None:
+        stmt = stmt.where(_after_in_queue(after))
+    return stmt.order_by(*QUEUE_ORDER).limit(limit)
+
+def _after_in_queue(row):
+    """QUEUE_ORDER で row より後ろに並ぶ行の条件"""
+    if row.due_date is None:
+        # 期限日なしは最後に並ぶため、同じ優先度の期限日なしのうちIDが大きいものだけが後ろ
+        same_priority_after = Ticket.due_date.is_(None) & (Ticket.id > row.id)
+    else:
+        same_priority_after = (Ticket.due_date.is_(None) | (Ticket.due_date > row.due_date)
+                               | ((Ticket.due_date == row.due_date) & (Ticket.id > row.id)))
+    return (Ticket.priority < row.priority) | ((Ticket.priority == row.priority) & same_priority_after)
+
+
+QueueCursor = namedtuple('QueueCursor', ['priority', 'due_date', 'id'])
+
+def encode_queue_cursor(row):
+    """キューの行を次のページの cursor パラメータ ('優先度:期限日:ID') に変換する"""
+    return f"{row.priority}:{row.due_date.isoformat() if row.due_date else ''}:{row.id}"
+
+def decode_queue_cursor(value):
+    """cursor パラメータを QueueCursor に戻す。不正な値は ValueError"""
+    priority, due_date, ticket_id = value.split(':')
+    return QueueCursor(int(priority), datetime.strptime(due_date, '%Y-%m-%d').date() if due_date else None,
+                       int(ticket_id))
+
+def load_queue_page(organization_id, assignee_id, cursor=None, limit=QUEUE_PAGE_SIZE):
+    """キューの1ページ分の TicketRow と、次のページの cursor (最後のページでは None) を返す"""
+    after = decode_queue_cursor(cursor) if cursor else None
+    rows = to_ticket_rows(db.session.execute(build_queue_query(organization_id, assignee_id, after, limit + 1)))
+    next_cursor = encode_queue_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def claim_next_ticket(user, attempts=3):
+    """組織の未割り当てのチケットのうちキューの先頭のものをユーザーに割り当て、そのIDを返す
+
+    FOR UPDATE SKIP LOCKED で他のリクエストが選んでいる行を飛ばし、同時に呼ばれても
+    別々のチケットを割り当てる。SKIP LOCKED のないSQLiteでは、割り当てのUPDATEを
+    「未割り当てのままなら」に限定し、競合して0行だった場合は選び直す。
+    """
+    for _ in range(attempts):
+        candidate = db.session.execute(
+            select(Ticket.id, Ticket.priority).where(Ticket.organization_id == user.organization_id,
+                                    Ticket.assignee_id.is_(None),
+                                    Ticket.status.in_(OPEN_STATUSES))
+            .order_by(*QUEUE_ORDER).limit(1).with_for_update(skip_locked=True)
+        ).first()
+        if candidate is None:
+            db.session.rollback()
+            return None
+        ticket_id, priority = candidate
+        claimed = db.session.execute(
+            update(Ticket).where(Ticket.id == ticket_id, Ticket.assignee_id.is_(None))
+            .values(assignee_id=user.id, version=Ticket.version + 1)
+        ).rowcount
+        if claimed:
+            # UPDATE文はフラッシュを通らないため、アウトボックスにも同じコミットで直接書く
+            data = db.session.execute(select(Ticket.__table__).where(Ticket.id == ticket_id)).mappings().one()
+            db.session.execute(insert(OutboxEvent.__table__), [outbox_row(
+                'ticket.updated', user.organization_id, ticket_id,
+                {key: _json_value(value) for key, value in data.items()}, {'assignee_id': [None, user.id]})])
+        db.session.commit()
+        if claimed:
+            # UPDATE文はセッションのフラッシュを通らないため、自動割り当ての負荷に直接反映する
+            auto_assigner.apply({(user.organization_id, user.id): (1, priority)})
+            return ticket_id
+    return None
+
+
+_ORGANIZATION_USERS = select(User.id, User.username).where(User.organization_id == bindparam('organization_id'))
+
+def build_organization_users_query(organization_id):
+    """担当者の選択肢用に、組織のユーザーのIDと名前だけを取得するSELECT文とパラメータ"""
+    return _ORGANIZATION_USERS, {'organization_id': organization_id}
+
+def validate_assignee(organization_id, assignee_id):
+    """担当者 (None は未割り当て) が組織のユーザーでなければ ValueError (他の組織やないユーザーを割り当てない)"""
+    if assignee_id is None:
+        return
+    stmt, params = build_organization_users_query(organization_id)
+    if db.session.execute(stmt.where(User.id == assignee_id), params).first() is None:
+        raise ValueError("assignee_id には組織のユーザーのIDを指定してください")
+
+
+# 画面・APIのたびに実行する、組織のチケットをIDで引くSELECT文 (一度だけ組み立てる)
+_ORGANIZATION_TICKET = select(Ticket).where(Ticket.id == bindparam('ticket_id'),
+                                            Ticket.organization_id == bindparam('organization_id'))
+
+def find_organization_ticket(ticket_id, organization_id):
+    """組織のチケットをIDで取得する (他の組織のチケットやないチケットは None)"""
+    return db.session.scalars(_ORGANIZATION_TICKET,
+                              {'ticket_id': ticket_id, 'organization_id': organization_id}).one_or_none()
+
+def organization_ticket_or_404(ticket_id):
+    """ログインユーザーの組織のチケットを取得する (なければ 404)"""
+    ticket = find_organization_ticket(ticket_id, current_user.organization_id)
+    if ticket is None:
+        abort(404)
+    return ticket
+
+
+# サブチケットの木の1ノード分 (depth はチケット直下を0とした深さ、position は同じ親の中での並び順)
+# leaf_count / completed_count は配下の末端のサブチケットの数と完了数 (末端なら自分自身の1件)
+SubTicketNode = namedtuple('SubTicketNode', ['id', 'parent_id', 'title', 'completed', 'position', 'version',
+                                             'depth', 'is_leaf', 'leaf_count', 'completed_count', 'progress'])
+
+# 1回のリクエストでまとめて追加できるサブチケットの数
+MAX_SUBTICKET_BATCH = 100
+
+def build_subtree_query(ticket_id, root_id=None):
+    """チケットのサブチケット (root_id を指定するとそのサブチケットと子孫) を深さ付きで取得するSELECT文
+
+    親から子へ parent_id をたどる再帰CTEで、階層の数によらず1回のクエリで取得する。
+    """
+    start = select(SubTicket.id, SubTicket.parent_id, SubTicket.title, SubTicket.completed, SubTicket.position,
+                   SubTicket.version, literal(0).label('depth')).where(SubTicket.ticket_id == ticket_id)
+    if root_id is None:
+        start = start.where(SubTicket.parent_id.is_(None))
+    else:
+        start = start.where(SubTicket.id == root_id)
+    subtree = start.cte('subtree', recursive=True)
+    child = aliased(SubTicket)
+    subtree = subtree.union_all(
+        select(child.id, child.parent_id, child.title, child.completed, child.position, child.version,
+               subtree.c.depth + 1)
+        .join(subtree, child.parent_id == subtree.c.id)
+    )
+    return select(subtree)
+
+def build_progress_query(ticket_id):
+    """チケットのサブチケットごとに、配下の末端のサブチケットの数と完了数を取得するSELECT文
+
+    (祖先, 子孫) の組を再帰CTEで作り、子を持たない子孫を祖先ごとに数える。
+    結果は (サブチケットID, 末端の数, 完了した末端の数) の行。
+    """
+    pairs = select(SubTicket.id.label('ancestor_id'), SubTicket.id.label('descendant_id')) \
+        .where(SubTicket.ticket_id == ticket_id).cte('subticket_pairs', recursive=True)
+    child = aliased(SubTicket)
+    pairs = pairs.union_all(
+        select(pairs.c.ancestor_id, child.id).join(pairs, child.parent_id == pairs.c.descendant_id)
+    )
+    leaf = aliased(SubTicket)
+    grandchild = aliased(SubTicket)
+    return select(pairs.c.ancestor_id, func.count(), func.sum(case((leaf.completed, 1), else_=0))) \
+        .join(leaf, leaf.id == pairs.c.descendant_id) \
+        .where(~select(grandchild.id).where(grandchild.parent_id == leaf.id).exists()) \
+        .group_by(pairs.c.ancestor_id)
+
+def _progress(completed_count, leaf_count):
+    """完了率 (%)。末端のサブチケットがなければ 0"""
+    return round(100 * completed_count / leaf_count) if leaf_count else 0
+
+def load_subticket_tree(ticket_id, root_id=None):
+    """サブチケットの木を深さ優先の順の SubTicketNode のリストで返す (クエリは木と完了率の2回)
+
+    戻り値は (ノードのリスト, チケット全体の (完了した末端の数, 末端の数))。
+    root_id を指定した場合、全体の値はそのサブチケット以下のもの。
+    """
+    rows = db.session.execute(build_subtree_query(ticket_id, root_id)).all()
+    counts = {ancestor_id: (int(leaf_count), int(completed_count or 0))
+              for ancestor_id, leaf_count, completed_count in db.session.execute(build_progress_query(ticket_id))}
+    children = {}
+    for row in rows:
+        children.setdefault(row.parent_id, []).append(row)
+
+    # どのサブチケットも自分自身の祖先として counts に含まれる
+    nodes = []
+    order = lambda row: (row.position, row.id)  # noqa: E731
+    tops = sorted((row for row in rows if row.depth == 0), key=order)
+    stack = list(reversed(tops))
+    while stack:
+        row = stack.pop()
+        leaf_count, completed_count = counts[row.id]
+        nodes.append(SubTicketNode(row.id, row.parent_id, row.title, row.completed, row.position, row.version,
+                                   row.depth, row.id not in children, leaf_count, completed_count,
+                                   _progress(completed_count, leaf_count)))
+        stack.extend(sorted(children.get(row.id, []), key=order, reverse=True))
+    total = (sum(counts[row.id][1] for row in tops), sum(counts[row.id][0] for row in tops))
+    return nodes, total
+
+def _write_subticket_events(event_type, organization_id, rows, changes=lambda row: None):
+    """INSERT/UPDATE文 (フラッシュを通らない) で変更したサブチケットの行を、同じコミットでアウトボックスに書く"""
+    if rows:
+        db.session.execute(insert(OutboxEvent.__table__), [
+            outbox_row(event_type, organization_id, row['id'], {key: _json_value(value) for key, value in row.items()},
+                       changes(row))
+            for row in rows])
+
+def add_subtickets(ticket, titles, parent_id=None):
+    """チケットに titles のサブチケットをまとめて追加し、追加した行を返す (複数行のINSERTを1回)
+
+    並び順はチケットのサブチケットの末尾に、titles の順で続ける。コミットは呼び出し側で行う。
+    """
+    subtickets = SubTicket.__table__
+    start = db.session.scalar(select(func.coalesce(func.max(SubTicket.position), 0))
+                              .where(SubTicket.ticket_id == ticket.id))
+    now = datetime.utcnow()
+    # RETURNING の順は保証されないため (順序を保証させるとSQLiteでは1行ずつのINSERTになる)、並び順で並べ直す
+    rows = sorted(db.session.execute(
+        insert(subtickets).returning(*subtickets.c),
+        [{'title': title, 'ticket_id': ticket.id, 'parent_id': parent_id, 'completed': False,
+          'position': start + number, 'updated_at': now} for number, title in enumerate(titles, 1)]
+    ).mappings().all(), key=lambda row: row['position'])
+    _write_subticket_events('subticket.created', ticket.organization_id, rows)
+    return rows
+
+def reorder_subtickets(ticket, parent_id, ordered_ids):
+    """親 (None ならチケットの直下) の子を ordered_ids の順に並べ替え、動いた数を返す (UPDATEを1回)
+
+    ordered_ids がその親の子のIDの並べ替えでなければ ValueError。
+    """
+    subtickets = SubTicket.__table__
+    parent_condition = subtickets.c.parent_id.is_(None) if parent_id is None else subtickets.c.parent_id == parent_id
+    current = dict(db.session.execute(select(subtickets.c.id, subtickets.c.position)
+                                      .where(subtickets.c.ticket_id == ticket.id, parent_condition)).all())
+    if sorted(ordered_ids) != sorted(current):
+        raise ValueError("並べ替えるサブチケットが親の子と一致しません")
+    moved = {subticket_id: position for position, subticket_id in enumerate(ordered_ids, 1)
+             if current[subticket_id] != position}
+    if moved:
+        rows = db.session.execute(
+            update(subtickets).where(subtickets.c.id.in_(moved))
+            .values(position=case(moved, value=subtickets.c.id), version=subtickets.c.version + 1)
+            .returning(*subtickets.c)
+        ).mappings().all()
+        _write_subticket_events('subticket.updated', ticket.organization_id, rows,
+                                lambda row: {'position': [current[row['id']], row['position']]})
+    return len(moved)
+
+def set_subtickets_completed(ticket, completed, ids=None):
+    """チケットの末端のサブチケット (ids を指定するとそのうちの該当するもの) の完了状態をまとめて変更する
+
+    完了率は末端から集計するため、子を持つサブチケットは変更しない。戻り値は変更した数 (UPDATEを1回)。
+    """
+    subtickets = SubTicket.__table__
+    child = subtickets.alias('child')
+    stmt = update(subtickets).where(subtickets.c.ticket_id == ticket.id, subtickets.c.completed != completed,
+                                    ~select(child.c.id).where(child.c.parent_id == subtickets.c.id).exists())
+    if ids is not None:
+        stmt = stmt.where(subtickets.c.id.in_(ids))
+    rows = db.session.execute(stmt.values(completed=completed, version=subtickets.c.version + 1)
+                              .returning(*subtickets.c)).mappings().all()
+    _write_subticket_events('subticket.updated', ticket.organization_id, rows,
+                            lambda row: {'completed': [not completed, completed]})
+    return len(rows)
+
+
+# 編集画面・APIで変更できるチケットの列
+TICKET_EDITABLE_FIELDS = {'title': "タイトル", 'status': "状態", 'priority': "優先度", 'assignee_id': "担当者",
+                          'due_date': "期限日"}
+
+def _ticket_form_values(form, ticket, prefix=''):
+    """編集フォームの値 (prefix='base_' なら編集を始めたときの値) をチケットの列の値にする (不正な値は ValueError)"""
+    status = form.get(prefix + 'status')
+    if status not in TICKET_STATUSES:
+        raise ValueError(f"不正な状態です: {status}")
+    due_date = form.get(prefix + 'due_date')
+    # 「未割り当て」は 0 で送られる
+    assignee_id = form.get(prefix + 'assignee_id', type=int) or None
+    if not prefix:
+        # 編集を始めたときの値は衝突の判定に使うだけなので、その後に組織を離れたユーザーでもよい
+        validate_assignee(ticket.organization_id, assignee_id)
+    return {
+        'title': form.get(prefix + 'title'),
+        'status': status,
+        'priority': form.get(prefix + 'priority', ticket.priority, type=int),
+        'assignee_id': assignee_id,
+        'due_date': date.fromisoformat(due_date) if due_date else None,
+    }
+
+def _ticket_json_value(field, value):
+    """APIの changes の値をチケットの列の値にする (不正な値は ValueError)"""
+    if field == 'title' and not (isinstance(value, str) and 0 < len(value) <= 255):
+        raise ValueError("title は255文字までの文字列です")
+    if field == 'status' and value not in TICKET_STATUSES:
+        raise ValueError(f"status は {', '.join(TICKET_STATUSES)} のいずれかです")
+    # JSON の true / false は int の一種として通ってしまうため除く
+    if field == 'priority' and (isinstance(value, bool) or value not in PRIORITIES):
+        raise ValueError("priority は 1〜3 です")
+    if field == 'assignee_id' and not (value is None or isinstance(value, int) and not isinstance(value, bool)):
+        raise ValueError("assignee_id は整数または null です")
+    if field == 'due_date':
+        return date.fromisoformat(value) if value else None
+    return value
+
+def merge_ticket_changes(ticket, version, changes):
+    """版数 version のチケットを元にした変更 changes ({列: [編集前, 編集後]}) を ticket に適用する
+
+    その後に他の編集でチケットが更新されていても、同じ列を別の値に変えていなければ、
+    変更した列だけを上書きして統合する。同じ列が別の値に変わっていれば何も適用せず、
+    衝突した列を {列: (編集後の値, 現在の値)} で返す。
+    """
+    updates, conflicts = {}, {}
+    for field, (before, after) in changes.items():
+        current = getattr(ticket, field)
+        if current == after:
+            continue
+        if version != ticket.version and current != before:
+            conflicts[field] = (after, current)
         else:
-            query = query.order_by(order_column.asc())
+            updates[field] = after
+    if not conflicts:
+        for field, value in updates.items():
+            setattr(ticket, field, value)
+    return conflicts
+
+def save_ticket_changes(ticket, version, changes, attempts=3):
+    """merge_ticket_changes で統合してコミットし、(衝突した列, 他の編集と統合したか) を返す
+
+    読み込みからコミットまでの間に他の編集がコミットされた場合 (StaleDataError) は、
+    最新の行を読み直して統合し直す。行をロックして待たせることはしない。
+    """
+    for attempt in range(attempts):
+        merged = version != ticket.version
+        conflicts = merge_ticket_changes(ticket, version, changes)
+        if conflicts:
+            db.session.rollback()
+            return conflicts, merged
+        try:
+            db.session.commit()
+            return {}, merged
+        except StaleDataError:
+            db.session.rollback()  # ticket は期限切れになり、次に参照したときに読み直される
+            if attempt == attempts - 1:
+                raise
+
+def serialize_ticket(ticket):
+    """チケットをJSONレスポンス用の辞書に変換する"""
+    return {
+        'id': ticket.id,
+        'title': ticket.title,
+        'status': ticket.status,
+        'priority': ticket.priority,
+        'due_date': ticket.due_date.isoformat() if ticket.due_date else None,
+        'created_at': ticket.created_at.isoformat() if ticket.created_at else None,
+        'version': ticket.version,
+        'assignee_id': ticket.assignee_id,
+        'requester': ticket.requester_name,
+        'assignee': ticket.assignee_name,
+    }
+
+
+# --- 変更の部分更新 (フラグメント) ---
+# 画面のJSは data-fragment を付けたフォーム・リンクを、X-Fragment: 1 ヘッダーを付けて fetch で送る。
+# その場合、変更のルートはリダイレクトして画面全体を読み込み・描画し直す代わりに、フラッシュメッセージと
+# 変わった部分 (一覧の行、編集フォーム、サブチケットの欄) のHTMLだけを返し、画面は同じ id の要素と入れ替える。
+# ヘッダーのないリクエスト (JSが動かない場合) には従来どおりリダイレクトを返す。
+FRAGMENT_HEADER = 'X-Fragment'
+
+def wants_fragment():
+    return request.headers.get(FRAGMENT_HEADER) == '1'
+
+def render_fragments(*parts, status=200, flash_messages=True):
+    """parts の (templates/_fragments.html のマクロ名, 引数) を、フラッシュメッセージと合わせて描画する
+
+    flash_messages=False では parts だけを描画する (表示中のフラッシュメッセージを残す入力中の問い合わせ用)。
+    """
+    response = make_response(render_template('fragment.html', parts=parts, priorities=PRIORITIES,
+                                             ticket_statuses=TICKET_STATUSES, flash_messages=flash_messages),
+                             status)
+    response.headers[FRAGMENT_HEADER] = '1'
+    response.vary.add(FRAGMENT_HEADER)
+    return response
+
+def fragment_or_redirect(location, *parts, status=200):
+    """部分更新のリクエストならフラッシュメッセージと parts を、それ以外は location へのリダイレクトを返す"""
+    if wants_fragment():
+        return render_fragments(*parts, status=status)
+    return redirect(location)
+
+def _ticket_row_part(ticket_id, prepend_to=None):
+    return 'ticket_row', {'ticket': load_ticket_row(ticket_id), 'prepend_to': prepend_to}
+
+def _subtickets_response(ticket_id):
+    """サブチケットを変更したルートの応答 (部分更新ならサブチケットの欄だけを描画し直す)"""
+    if not wants_fragment():
+        return redirect(url_for('edit_ticket', ticket_id=ticket_id, _anchor='subtickets'))
+    subtickets, (completed_count, leaf_count) = load_subticket_tree(ticket_id)
+    return render_fragments(('subticket_section', {'ticket_id': ticket_id, 'subtickets': subtickets,
+                                                   'subticket_progress': _progress(completed_count, leaf_count)}))
 
-        tickets = query.all()
+
+# --- ルーティング ---
+@app.route('/')
+@login_required
+def index():
+    filter_status = request.args.get('filter_status')
+    search_term = request.args.get('search_term')
+    sort_by = request.args.get('sort_by', 'id')
+    sort_order = request.args.get('sort_order', 'desc')
+    # 重複の確認のために作成を止めたタイトル (JSが動かない場合の add_ticket からのリダイレクト)
+    new_title = request.args.get('title')
+
+    stale_since = None
+    try:
+        dashboard = serve_dashboard(
+            current_user.organization_id,
+            filter_status=filter_status,
+            search_term=search_term,
+            sort_by=sort_by,
+            sort_order=sort_order
+        )
+        tickets, organization_users = dashboard.value
+        if dashboard.stale:
+            stale_since = datetime.fromtimestamp(dashboard.stored_at)
     except Exception as error:
         flash(f"チケットの読み込み中にエラー: {error}", "danger")
         tickets = []
         organization_users = []
+    try:
+        suggestions = find_similar_tickets(current_user.organization_id, new_title) if new_title else []
+    except DB_UNAVAILABLE:
+        suggestions = []
 
     return render_template(
         'index.html',
@@ -189,7 +1582,11 @@ def index():
         current_sort_by=sort_by,
         current_sort_order=sort_order,
         current_filter_status=filter_status,
-        current_search_term=search_term
+        current_search_term=search_term,
+        auto_assign_strategies=AUTO_ASSIGN_STRATEGIES,
+        stale_since=stale_since,
+        new_title=new_title,
+        suggestions=suggestions
     )
 
 @app.route('/signup', methods=['GET', 'POST'])
@@ -216,29 +1613,41 @@ def signup():
             new_organization = Organization(name=organization_name)
             db.session.add(new_organization)
 
-            # 2. 役割を取得（なければ作成）
-            admin_role = Role.query.filter_by(name='admin').first()
-            if not admin_role:
-                admin_role = Role(name='admin')
+            # 2. 役割を取得（init-db 前でロールがなければ作成）
+            admin_role_id = role_cache.id_for('admin')
+            roles_created = admin_role_id is None
+            if roles_created:
+                admin_role = Role.query.filter_by(name='admin').first() or Role(name='admin')
                 db.session.add(admin_role)
-
-            member_role = Role.query.filter_by(name='member').first()
-            if not member_role:
-                member_role = Role(name='member')
-                db.session.add(member_role)
+                if not Role.query.filter_by(name='member').first():
+                    db.session.add(Role(name='member'))
+                db.session.flush()
+                admin_role_id = admin_role.id
 
             db.session.flush() # IDを確定させる
 
+            # 組織を配置するシャードを決め、ディレクトリに登録する
+            shard_key = app.config['NEW_ORGANIZATION_SHARD']
+            if shard_key != DEFAULT_SHARD:
+                db.session.add(OrganizationShard(organization_id=new_organization.id, shard_key=shard_key))
+                copy_global_rows(db.session.connection(),
+                                 db.session.connection(bind_arguments={'bind': shard_engine(shard_key)}),
+                                 db.metadata, new_organization.id)
+            use_shard(shard_key)
+
             # 3. ユーザーを作成し、組織の最初のユーザーとして管理者ロールを割り当てる
             hashed_password = generate_password_hash(password)
             new_user = User(
                 username=username, 
                 password_hash=hashed_password,
                 organization_id=new_organization.id,
-                role_id=admin_role.id
+                role_id=admin_role_id
             )
             db.session.add(new_user)
             db.session.commit()
+            if roles_created:
+                role_cache.invalidate()
+            organization_ids.store(organization_name, new_organization.id)
 
             flash("組織とアカウントが作成されました。ログインしてください。", "success")
             return redirect(url_for('login'))
@@ -259,23 +1668,208 @@ def login():
         password = request.form.get('password')
         organization_name = request.form.get('organization_name')
 
-        organization = Organization.query.filter_by(name=organization_name).first()
-        if not organization:
+        # DB参照やパスワードハッシュの検証より前に試行回数を判定する
+        decision = login_throttle.check(request.remote_addr, username, organization_name)
+        if not decision.allowed:
+            app.logger.warning(f"ログイン試行を拒否しました ({decision.reason}): ip={request.remote_addr}")
+            flash(f"ログイン試行が多すぎます。{decision.retry_after}秒後に再度お試しください。", "danger")
+            response = make_response(render_template('login.html'), 429)
+            response.headers['Retry-After'] = str(decision.retry_after)
+            return response
+
+        organization_id, user = find_login_user(organization_name, username)
+        if organization_id is None:
+            login_throttle.record_failure(username, organization_name)
             flash("組織が見つかりません。", "danger")
             return redirect(url_for('login'))
 
-        user = User.query.filter_by(username=username, organization_id=organization.id).first()
-
         if user and check_password_hash(user.password_hash, password):
+            login_throttle.record_success(username, organization_name)
             login_user(user)
             flash("ログインしました。", "success")
             return redirect(url_for('index'))
         else:
+            login_throttle.record_failure(username, organization_name)
             flash("ユーザー名、パスワード、または組織名が正しくありません。", "danger")
             return redirect(url_for('login'))
 
     return render_template('login.html')
 
+@app.route('/admin/metrics/login')
+@login_required
+@admin_required
+def login_throttle_metrics():
+    """ログインスロットリングのメトリクス (このワーカープロセスの集計値)"""
+    return jsonify(dict(login_throttle.metrics))
+
+@app.route('/admin/metrics/webhooks')
+@login_required
+@admin_required
+def webhook_metrics():
+    """組織のWebhookの購読先・シャードごとの配信の遅れ (未配信のイベント数、最も古い未配信のイベントの日時)"""
+    lags = create_outbox_dispatcher().lag(current_user.organization_id)
+    return jsonify({'subscribers': [{key: _json_value(value) for key, value in lag._asdict().items()}
+                                    for lag in lags]})
+
+@app.route('/admin/metrics/sql-cache')
+@login_required
+@admin_required
+def sql_cache_metrics():
+    """コンパイル済みSQLのキャッシュの結果ごとの実行回数とヒット率 (このワーカープロセスの集計値)"""
+    return jsonify(compiled_cache_stats.snapshot())
+
+@app.route('/admin/metrics/dashboard')
+@login_required
+@admin_required
+def dashboard_resilience_metrics():
+    """ダッシュボードのサーキットブレーカーの状態と、古いデータ・ユーザーを返した回数 (このワーカープロセスの集計値)"""
+    return jsonify({'breaker': dashboard_breaker.snapshot(), 'stale_cache': dashboard_cache.snapshot(),
+                    'session_user_cache': session_user_cache.snapshot()})
+
+@app.route('/admin/auto-assign', methods=['POST'])
+@login_required
+@admin_required
+def update_auto_assign():
+    """新しいチケットの担当者の自動割り当ての方式を変更する (空なら割り当てない)"""
+    strategy = request.form.get('strategy') or None
+    if strategy is not None and strategy not in AUTO_ASSIGN_STRATEGIES:
+        abort(400)
+    organization = db.session.get(Organization, current_user.organization_id)
+    organization.auto_assign_strategy = strategy
+    db.session.commit()
+    auto_assigner.invalidate(organization.id)
+    if strategy is None:
+        flash("新しいチケットの自動割り当てを無効にしました。", "info")
+    else:
+        flash(f"新しいチケットを「{AUTO_ASSIGN_STRATEGIES[strategy]}」に自動で割り当てます。", "success")
+    return redirect(url_for('index'))
+
+
+# --- チケットの推移 (rollup-stats で集計した日次の値を返す) ---
+MAX_STATS_DAYS = 366 * 5
+
+def _stats_period():
+    days = max(1, min(request.args.get('days', 90, type=int), MAX_STATS_DAYS))
+    last_day = datetime.utcnow().date()
+    return last_day - timedelta(days=days - 1), last_day
+
+@app.route('/api/stats/trend')
+@login_required
+def stats_trend():
+    """組織の日ごとの作成・解決・期限切れの件数 (assignee_id で担当者を絞り込める)"""
+    first_day, last_day = _stats_period()
+    stmt = select(
+        TicketDailyStat.day,
+        func.sum(TicketDailyStat.created_count),
+        func.sum(TicketDailyStat.resolved_count),
+        func.sum(TicketDailyStat.overdue_count)
+    ).where(TicketDailyStat.organization_id == current_user.organization_id,
+            TicketDailyStat.day.between(first_day, last_day)) \
+     .group_by(TicketDailyStat.day).order_by(TicketDailyStat.day)
+    assignee_id = request.args.get('assignee_id', type=int)
+    if assignee_id is not None:
+        stmt = stmt.where(TicketDailyStat.assignee_id == assignee_id)
+
+    series = dense_series(db.session.execute(stmt).all(), first_day, last_day)
+    return jsonify({'status': 'success', **series})
+
+@app.route('/api/stats/assignees')
+@login_required
+def stats_by_assignee():
+    """期間中の担当者ごとの作成・解決件数と、最終日の期限切れ件数"""
+    first_day, last_day = _stats_period()
+    rows = db.session.execute(
+        select(
+            TicketDailyStat.assignee_id,
+            func.sum(TicketDailyStat.created_count),
+            func.sum(TicketDailyStat.resolved_count),
+            func.sum(case((TicketDailyStat.day == last_day, TicketDailyStat.overdue_count), else_=0))
+        ).where(TicketDailyStat.organization_id == current_user.organization_id,
+                TicketDailyStat.day.between(first_day, last_day))
+        .group_by(TicketDailyStat.assignee_id)
+    ).all()
+    usernames = dict(db.session.execute(*build_organization_users_query(current_user.organization_id)).all())
+    assignees = [{
+        'assignee_id': assignee_id or None,
+        'username': usernames.get(assignee_id) if assignee_id else None,
+        'created': int(created or 0),
+        'resolved': int(resolved or 0),
+        'overdue': int(overdue or 0),
+    } for assignee_id, created, resolved, overdue in rows]
+    assignees.sort(key=lambda item: (-item['resolved'], item['assignee_id'] or 0))
+    return jsonify({'status': 'success', 'start': first_day.isoformat(), 'end': last_day.isoformat(),
+                    'assignees': assignees})
+
+# --- 作業キュー (自分に割り当てられた未解決のチケット) ---
+def _load_my_queue_page():
+    limit = max(1, min(request.args.get('limit', QUEUE_PAGE_SIZE, type=int), MAX_QUEUE_PAGE_SIZE))
+    try:
+        return load_queue_page(current_user.organization_id, current_user.id, request.args.get('cursor'), limit)
+    except ValueError:
+        abort(400)
+
+@app.route('/queue')
+@login_required
+def my_queue():
+    tickets, next_cursor = _load_my_queue_page()
+    return render_template('queue.html', tickets=tickets, next_cursor=next_cursor, priorities=PRIORITIES,
+                           is_first_page=not request.args.get('cursor'))
+
+@app.route('/api/queue')
+@login_required
+def api_my_queue():
+    """自分の作業キュー。next_cursor を cursor に渡すと次のページを返す"""
+    tickets, next_cursor = _load_my_queue_page()
+    return jsonify({'status': 'success', 'tickets': [serialize_ticket(ticket) for ticket in tickets],
+                    'next_cursor': next_cursor})
+
+@app.route('/queue/claim', methods=['POST'])
+@login_required
+def claim_ticket():
+    ticket_id = claim_next_ticket(current_user)
+    if ticket_id is None:
+        flash("未割り当てのチケットはありません。", "info")
+    else:
+        flash(f"チケットID {ticket_id} を割り当てました。", "success")
+    return redirect(url_for('my_queue'))
+
+@app.route('/api/queue/claim', methods=['POST'])
+@login_required
+def api_claim_ticket():
+    """組織の未割り当てのチケットのうち、キューの先頭のものを自分に割り当てる"""
+    ticket_id = claim_next_ticket(current_user)
+    if ticket_id is None:
+        return jsonify({'status': 'empty', 'message': "未割り当てのチケットはありません。"}), 404
+    ticket = load_ticket_row(ticket_id)
+    return jsonify({'status': 'success', 'ticket': serialize_ticket(ticket)})
+
+def asset_url(logical_name):
+    """テンプレートから参照する、ハッシュ付きのアセットのURL"""
+    return url_for('asset', filename=asset_manifest.resolve(logical_name))
+
+
+app.jinja_env.globals['asset_url'] = asset_url
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    """ビルド済みのアセットを配信する。対応していれば圧縮済みのファイルを返す"""
+    if not asset_manifest.is_fingerprinted(filename):
+        abort(404)
+    mimetype = mimetypes.guess_type(filename)[0]
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[encoding] and \
+                os.path.exists(os.path.join(asset_manifest.output_dir, filename + suffix)):
+            response = send_from_directory(asset_manifest.output_dir, filename + suffix,
+                                           mimetype=mimetype, max_age=ASSET_MAX_AGE)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(asset_manifest.output_dir, filename, mimetype=mimetype, max_age=ASSET_MAX_AGE)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
 @app.route('/logout')
 @login_required
 def logout():
@@ -289,19 +1883,38 @@ def add_ticket():
     title = request.form.get('title')
     due_date_str = request.form.get('due_date')
     priority = request.form.get('priority', type=int, default=2)
-    assignee_id = request.form.get('assignee_id', type=int)
+    # 「未割り当て」は 0 で送られる
+    assignee_id = request.form.get('assignee_id', type=int) or None
 
     if not title:
         flash("チケットのタイトルを入力してください。", "warning")
-        return redirect(url_for('index'))
+        return fragment_or_redirect(url_for('index'), status=400)
+    try:
+        validate_assignee(current_user.organization_id, assignee_id)
+    except ValueError:
+        flash("担当者には組織のユーザーを選択してください。", "warning")
+        return fragment_or_redirect(url_for('index'), status=400)
+
+    # 重複していそうなチケットがあれば、重複ではないことを確認してから作成する
+    if not request.form.get('allow_duplicate'):
+        suggestions = find_similar_tickets(current_user.organization_id, title)
+        if suggestions and suggestions[0].similarity >= app.config['DUPLICATE_TICKET_MIN_SIMILARITY']:
+            flash("似ているチケットがあります。重複していないか確認し、別のチケットとして作成する場合は"
+                  "「重複ではないので作成する」を選んでください。", "warning")
+            if not wants_fragment():
+                return redirect(url_for('index', title=title))
+            return render_fragments(('similar_tickets', {'suggestions': suggestions}), status=409)
 
     try:
+        if assignee_id is None:
+            # 方式は既定のデータベースの組織の行に保存する (シャードにコピーした行は更新しない)
+            assignee_id = choose_auto_assignee(db.session.get(Organization, current_user.organization_id))
         new_ticket = Ticket(
             title=title, 
             requester_id=current_user.id,
             organization_id=current_user.organization_id,
             priority=priority,
-            assignee_id=assignee_id # default=None で処理される想定
+            assignee_id=assignee_id
         )
         if due_date_str:
             new_ticket.due_date = datetime.strptime(due_date_str, '%Y-%m-%d').date()
@@ -313,13 +1926,36 @@ def add_ticket():
         app.logger.error(f"チケットの追加中にエラー: {error}")
         db.session.rollback()
         flash("チケットの追加中にエラーが発生しました。", "danger")
+        return fragment_or_redirect(url_for('index'), status=500)
 
-    return redirect(url_for('index'))
+    if not wants_fragment():
+        return redirect(url_for('index'))
+    # 一覧の先頭に行を追加する (絞り込み・並び順は、画面を読み込み直したときに反映する)
+    return render_fragments(('removed', {'element_id': 'ticketsEmpty'}),
+                            _ticket_row_part(new_ticket.id, prepend_to='ticketRows'),
+                            ('similar_tickets', {'suggestions': []}), status=201)
+
+@app.route('/tickets/similar')
+@login_required
+def similar_tickets():
+    """作成フォームで入力中のタイトルに似ているチケットの欄 (部分更新)"""
+    suggestions = find_similar_tickets(current_user.organization_id, request.args.get('title', ''))
+    return render_fragments(('similar_tickets', {'suggestions': suggestions}), flash_messages=False)
+
+@app.route('/api/tickets/similar')
+@login_required
+def api_similar_tickets():
+    """title に似ている組織のチケット (exclude_id のチケットを除く、類似度の高い順に limit 件まで)"""
+    title = request.args.get('title', '')
+    limit = min(max(request.args.get('limit', type=int, default=5), 1), 20)
+    suggestions = find_similar_tickets(current_user.organization_id, title,
+                                       exclude_id=request.args.get('exclude_id', type=int), limit=limit)
+    return jsonify({'similar': [suggestion._asdict() for suggestion in suggestions]})
 
 @app.route('/ticket/<int:ticket_id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_ticket(ticket_id):
-    ticket_to_edit = Ticket.query.filter_by(id=ticket_id, organization_id=current_user.organization_id).first_or_404()
+    ticket_to_edit = organization_ticket_or_404(ticket_id)
 
     if request.method == 'POST':
         # 権限チェック (管理者、担当者、依頼者のみ編集可能)
@@ -327,83 +1963,154 @@ def edit_ticket(ticket_id):
                 or ticket_to_edit.assignee_id == current_user.id
                 or ticket_to_edit.requester_id == current_user.id):
             flash("このチケットを編集する権限がありません。", "danger")
-            return redirect(url_for('index'))
+            return fragment_or_redirect(url_for('index'), status=403)
 
-        new_title = request.form.get('title')
-        new_due_date_str = request.form.get('due_date')
-        new_priority = request.form.get('priority', type=int)
-        new_status = request.form.get('status')
-        new_assignee_id = request.form.get('assignee_id', type=int)
-
-        if new_title:
-            try:
-                ticket_to_edit.title = new_title
-                ticket_to_edit.priority = new_priority
-                ticket_to_edit.status = new_status
-                ticket_to_edit.assignee_id = new_assignee_id if new_assignee_id != 0 else None
-
-                if new_due_date_str:
-                    ticket_to_edit.due_date = datetime.strptime(new_due_date_str, '%Y-%m-%d').date()
-                else:
-                    ticket_to_edit.due_date = None
-
-                db.session.commit()
-                flash(f"チケットID {ticket_id} を更新しました。", "success")
-            except Exception as error:
-                app.logger.error(f"チケットID {ticket_id} の更新中にエラー: {error}")
-                db.session.rollback()
-                flash(f"チケットID {ticket_id} の更新中にエラーが発生しました。", "danger")
-        else:
+        if not request.form.get('title'):
             flash("チケットのタイトルは必須です。", "warning")
+            return fragment_or_redirect(url_for('index'), status=400)
+        # 編集を始めたときの版数と値。版数のない (古い) フォームは現在の値を元にする (後勝ち)
+        version = request.form.get('version', type=int)
+        try:
+            submitted = _ticket_form_values(request.form, ticket_to_edit)
+            if version is None:
+                version = ticket_to_edit.version
+                base = {field: getattr(ticket_to_edit, field) for field in TICKET_EDITABLE_FIELDS}
+            else:
+                base = _ticket_form_values(request.form, ticket_to_edit, prefix='base_')
+        except ValueError:
+            flash("入力内容が正しくありません。", "warning")
+            return fragment_or_redirect(url_for('edit_ticket', ticket_id=ticket_id), status=400)
+        changes = {field: [base[field], submitted[field]] for field in TICKET_EDITABLE_FIELDS
+                   if base[field] != submitted[field]}
+
+        try:
+            conflicts, merged = save_ticket_changes(ticket_to_edit, version, changes)
+        except Exception as error:
+            app.logger.error(f"チケットID {ticket_id} の更新中にエラー: {error}")
+            db.session.rollback()
+            flash(f"チケットID {ticket_id} の更新中にエラーが発生しました。", "danger")
+            return fragment_or_redirect(url_for('index'), status=500)
+        if conflicts:
+            # 現在の値に、衝突しなかった自分の変更を重ねた状態で編集画面を表示し直す
+            flash("編集中に他のユーザーが同じ項目を変更しました。現在の値を確認して、もう一度更新してください。", "warning")
+            values = {field: getattr(ticket_to_edit, field) for field in TICKET_EDITABLE_FIELDS}
+            values.update((field, after) for field, (_, after) in changes.items() if field not in conflicts)
+            if wants_fragment():
+                return render_fragments(('ticket_form', _ticket_form_args(ticket_to_edit, values, conflicts)),
+                                        status=409)
+            return _render_edit_ticket(ticket_to_edit, values, conflicts), 409
+        if merged:
+            flash(f"チケットID {ticket_id} を更新しました (他のユーザーの変更と統合しました)。", "success")
+        else:
+            flash(f"チケットID {ticket_id} を更新しました。", "success")
+        if wants_fragment():
+            # 新しい版数のフォームに入れ替える (一覧から送った場合は行も入れ替える)
+            return render_fragments(('ticket_form', _ticket_form_args(ticket_to_edit)), _ticket_row_part(ticket_id))
         return redirect(url_for('index'))
 
-    organization_users = User.query.filter_by(organization_id=current_user.organization_id).all()
+    return _render_edit_ticket(ticket_to_edit)
+
+def _render_edit_ticket(ticket, values=None, conflicts=None):
+    """編集画面。values はフォームに表示する値 (既定はチケットの現在の値)、conflicts は衝突した列"""
+    subtickets, (completed_count, leaf_count) = load_subticket_tree(ticket.id)
     return render_template('edit.html',
-                           ticket=ticket_to_edit,
-                           organization_users=organization_users,
+                           **_ticket_form_args(ticket, values, conflicts),
+                           subtickets=subtickets,
+                           subticket_progress=_progress(completed_count, leaf_count),
                            ticket_statuses=TICKET_STATUSES,
                            priorities=PRIORITIES)
 
+def _ticket_form_args(ticket, values=None, conflicts=None):
+    """編集フォーム (_fragments.html の ticket_form) の引数"""
+    if values is None:
+        values = {field: getattr(ticket, field) for field in TICKET_EDITABLE_FIELDS}
+    organization_users = db.session.execute(*build_organization_users_query(ticket.organization_id)).all()
+    user_names = dict(organization_users)
+
+    def display(field, value):
+        if field == 'assignee_id':
+            return user_names.get(value, "未割り当て")
+        if field == 'priority':
+            return PRIORITIES.get(value, value)
+        return value if value is not None else "なし"
+
+    return {'ticket': ticket,
+            'values': values,
+            'conflicts': [(TICKET_EDITABLE_FIELDS[field], display(field, mine), display(field, current))
+                          for field, (mine, current) in (conflicts or {}).items()],
+            'organization_users': organization_users}
+
 
 @app.route('/ticket/<int:ticket_id>/delete')
 @login_required
 @admin_required # 管理者のみ削除可能
 def delete_ticket(ticket_id):
+    removed = []  # 部分更新で一覧から取り除く行
     try:
-        ticket = Ticket.query.filter_by(id=ticket_id, organization_id=current_user.organization_id).first()
+        ticket = find_organization_ticket(ticket_id, current_user.organization_id)
         if ticket:
             db.session.delete(ticket)
             db.session.commit()
             flash(f"チケットID {ticket_id} を削除しました。", "success")
+            removed.append(('removed', {'element_id': f'ticket-{ticket_id}'}))
         else:
             flash(f"チケットID {ticket_id} が見つからないか、権限がありません。", "warning")
     except Exception as error:
         app.logger.error(f"チケット {ticket_id} の削除中にエラー: {error}")
         db.session.rollback()
         flash(f"チケットID {ticket_id} の削除中にエラーが発生しました。", "danger")
-    return redirect(url_for('index'))
+    return fragment_or_redirect(url_for('index'), *removed)
 
 # サブチケット関連のルート（変更点はモデル名のみ）
 @app.route('/subticket/add/<int:ticket_id>', methods=['POST'])
 @login_required
 def add_subticket(ticket_id):
     # 親チケットの存在確認と権限確認
-    ticket = Ticket.query.filter_by(id=ticket_id, organization_id=current_user.organization_id).first_or_404()
-    title = request.form.get('subticket_title')
+    ticket = organization_ticket_or_404(ticket_id)
+    # 複数行で入力すると、1行を1件としてまとめて追加する
+    titles = [line.strip() for line in request.form.get('subticket_title', '').splitlines() if line.strip()]
+    # 親のサブチケットを指定すると、その下に入れ子で追加する
+    parent_id = request.form.get('parent_id', type=int) or None
 
-    if not title:
+    if not titles:
         flash("サブチケットのタイトルを入力してください。", "warning")
-        return redirect(url_for('index', _anchor=f'ticket-{ticket.id}'))
+        return _subtickets_response(ticket.id)
+    if len(titles) > MAX_SUBTICKET_BATCH or any(len(title) > 255 for title in titles):
+        flash(f"サブチケットは1回に{MAX_SUBTICKET_BATCH}件まで、件名は255文字までです。", "warning")
+        return _subtickets_response(ticket.id)
+    if parent_id is not None and not _is_ticket_subticket(ticket, parent_id):
+        abort(404)
 
     try:
-        new_subticket = SubTicket(title=title, ticket_id=ticket.id)
-        db.session.add(new_subticket)
+        add_subtickets(ticket, titles, parent_id)
         db.session.commit()
-        flash(f"サブチケット「{title}」をチケット「{ticket.title}」に追加しました。", "success")
+        if len(titles) == 1:
+            flash(f"サブチケット「{titles[0]}」をチケット「{ticket.title}」に追加しました。", "success")
+        else:
+            flash(f"{len(titles)}件のサブチケットをチケット「{ticket.title}」に追加しました。", "success")
     except Exception as e:
         db.session.rollback()
         flash(f"サブチケットの追加中にエラー: {e}", "danger")
-    return redirect(url_for('index', _anchor=f'ticket-{ticket.id}'))
+    return _subtickets_response(ticket.id)
+
+def _is_ticket_subticket(ticket, subticket_id):
+    return db.session.scalar(
+        select(SubTicket.id).where(SubTicket.id == subticket_id, SubTicket.ticket_id == ticket.id)) is not None
+
+@app.route('/ticket/<int:ticket_id>/subtickets/complete', methods=['POST'])
+@login_required
+def complete_subtickets(ticket_id):
+    """チケットの末端のサブチケットをまとめて完了 (completed=1) または未完了 (completed=0) にする"""
+    ticket = organization_ticket_or_404(ticket_id)
+    completed = request.form.get('completed') == '1'
+    try:
+        changed = set_subtickets_completed(ticket, completed)
+        db.session.commit()
+        flash(f"{changed}件のサブチケットを{'完了' if completed else '未完了'}にしました。", "success")
+    except Exception as e:
+        db.session.rollback()
+        flash(f"サブチケットの状態更新中にエラー: {e}", "danger")
+    return _subtickets_response(ticket.id)
 
 @app.route('/subticket/toggle/<int:subticket_id>', methods=['POST'])
 @login_required
@@ -413,14 +2120,188 @@ def toggle_subticket(subticket_id):
     if subticket.ticket.organization_id != current_user.organization_id:
         abort(403)  # Forbidden
 
+    ticket_id, title = subticket.ticket_id, subticket.title
+    stale_message = f"サブチケット「{title}」は他のユーザーが先に更新しました。現在の状態を確認してください。"
+    # 画面を表示したときの版数 (古い画面から切り替えると、他のユーザーの変更を元に戻してしまうため)
+    version = request.form.get('version', type=int)
+    if version is not None and version != subticket.version:
+        flash(stale_message, "warning")
+        return _subtickets_response(ticket_id)
+
     try:
         subticket.completed = not subticket.completed
         db.session.commit()
-        flash(f"サブチケット「{subticket.title}」の状態を更新しました。", "success")
+        flash(f"サブチケット「{title}」の状態を更新しました。", "success")
+    except StaleDataError:
+        db.session.rollback()
+        flash(stale_message, "warning")
     except Exception as e:
         db.session.rollback()
         flash(f"サブチケットの状態更新中にエラー: {e}", "danger")
-    return redirect(url_for('index', _anchor=f'ticket-{subticket.ticket_id}'))
+    return _subtickets_response(ticket_id)
+
+@app.route('/api/ticket/<int:ticket_id>/subtickets')
+@login_required
+def api_subticket_tree(ticket_id):
+    """サブチケットの木 (深さ優先の順) と、各サブチケット・チケット全体の完了率
+
+    root_id を指定すると、そのサブチケット以下だけを返す。
+    """
+    ticket_exists = db.session.scalar(
+        select(Ticket.id).where(Ticket.id == ticket_id, Ticket.organization_id == current_user.organization_id))
+    if ticket_exists is None:
+        abort(404)
+    nodes, (completed_count, leaf_count) = load_subticket_tree(ticket_id, request.args.get('root_id', type=int))
+    return jsonify({'status': 'success', 'ticket_id': ticket_id,
+                    'completed_count': completed_count, 'leaf_count': leaf_count,
+                    'progress': _progress(completed_count, leaf_count),
+                    'subtickets': [node._asdict() for node in nodes]})
+
+def _attachment_filename(filename):
+    """ブラウザが送ったファイル名からディレクトリを除く (日本語の名前はそのまま残す)"""
+    return os.path.basename(filename.replace('\\', '/')).strip()[:255] or 'attachment'
+
+@app.route('/ticket/<int:ticket_id>/attachments', methods=['POST'])
+@login_required
+def upload_attachments(ticket_id):
+    ticket = organization_ticket_or_404(ticket_id)
+    redirect_to_ticket = redirect(url_for('edit_ticket', ticket_id=ticket.id, _anchor='attachments'))
+    try:
+        # フォームの解析中に、各ファイルを添付ファイルの一時ファイルへ書き込みながらハッシュを計算する
+        files = [file for file in request.files.getlist('file') if file.filename]
+    except AttachmentTooLarge as error:
+        flash(f"添付ファイルは1件あたり{error.max_size // (1024 * 1024)}MBまでです。", "warning")
+        return redirect_to_ticket
+    if not files:
+        flash("添付するファイルを選択してください。", "warning")
+        return redirect_to_ticket
+
+    try:
+        for file in files:
+            stored = attachment_store.commit(file.stream, ticket.organization_id)
+            filename = _attachment_filename(file.filename)
+            db.session.add(Attachment(
+                organization_id=ticket.organization_id, ticket_id=ticket.id, uploaded_by_id=current_user.id,
+                filename=filename, size=stored.size, sha256=stored.sha256,
+                content_type=file.mimetype or mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+            ))
+        db.session.commit()
+        flash(f"{len(files)}件のファイルを添付しました。", "success")
+    except Exception as error:
+        app.logger.error(f"チケットID {ticket_id} への添付中にエラー: {error}")
+        db.session.rollback()
+        flash("ファイルの添付中にエラーが発生しました。", "danger")
+    return redirect_to_ticket
+
+@app.route('/attachment/<int:attachment_id>')
+@login_required
+def download_attachment(attachment_id):
+    """添付ファイルを返す。Range (一部の取得) と ETag による再検証に対応する"""
+    attachment = Attachment.query.filter_by(
+        id=attachment_id, organization_id=current_user.organization_id).first_or_404()
+    path = attachment_store.path(attachment.organization_id, attachment.sha256)
+    if not os.path.exists(path):
+        abort(404)
+    # 全体の送信は wsgi.file_wrapper (gunicornでは sendfile) か X-Sendfile でファイルから直接送る
+    response = send_file(path, mimetype=attachment.content_type, as_attachment=True,
+                         download_name=attachment.filename, conditional=True, etag=attachment.sha256, max_age=0)
+    response.cache_control.private = True
+    # アップロードされたHTMLなどをブラウザに解釈させない
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+@app.route('/attachment/<int:attachment_id>/delete', methods=['POST'])
+@login_required
+def delete_attachment(attachment_id):
+    attachment = Attachment.query.filter_by(
+        id=attachment_id, organization_id=current_user.organization_id).first_or_404()
+    ticket = attachment.ticket
+    # 権限チェック (管理者、アップロードした人、チケットの担当者・依頼者のみ削除可能)
+    if not (current_user.is_admin()
+            or attachment.uploaded_by_id == current_user.id
+            or ticket.assignee_id == current_user.id
+            or ticket.requester_id == current_user.id):
+        abort(403)
+
+    try:
+        # 本体は同じ内容の他の添付ファイルが参照していることがあるため、flask prune-attachments で消す
+        db.session.delete(attachment)
+        db.session.commit()
+        flash(f"添付ファイル「{attachment.filename}」を削除しました。", "success")
+    except Exception as error:
+        app.logger.error(f"添付ファイル {attachment_id} の削除中にエラー: {error}")
+        db.session.rollback()
+        flash("添付ファイルの削除中にエラーが発生しました。", "danger")
+    return redirect(url_for('edit_ticket', ticket_id=ticket.id, _anchor='attachments'))
+
+@app.route('/api/ticket/<int:ticket_id>/subtickets', methods=['POST'])
+@login_required
+def api_add_subtickets(ticket_id):
+    """{"titles": [...], "parent_id": null} のサブチケットをまとめて追加し、追加したサブチケットを返す"""
+    ticket = organization_ticket_or_404(ticket_id)
+    data = request.get_json(silent=True) or {}
+    titles = data.get('titles')
+    parent_id = data.get('parent_id')
+    if not isinstance(titles, list) or not 0 < len(titles) <= MAX_SUBTICKET_BATCH or \
+            not all(isinstance(title, str) and 0 < len(title.strip()) <= 255 for title in titles):
+        return jsonify({'status': 'error',
+                        'message': f"titles には1〜{MAX_SUBTICKET_BATCH}件の件名 (255文字まで) を指定してください。"}), 400
+    if parent_id is not None and not (isinstance(parent_id, int) and _is_ticket_subticket(ticket, parent_id)):
+        abort(404)
+    rows = add_subtickets(ticket, [title.strip() for title in titles], parent_id)
+    db.session.commit()
+    return jsonify({'status': 'success',
+                    'subtickets': [{key: _json_value(value) for key, value in row.items()} for row in rows]}), 201
+
+@app.route('/api/ticket/<int:ticket_id>/subtickets/order', methods=['POST'])
+@login_required
+def api_reorder_subtickets(ticket_id):
+    """{"parent_id": null, "ids": [...]} の順に、その親の子のサブチケットを並べ替える (ドラッグでの並べ替え用)"""
+    ticket = organization_ticket_or_404(ticket_id)
+    data = request.get_json(silent=True) or {}
+    ids = data.get('ids')
+    if not isinstance(ids, list) or not all(isinstance(subticket_id, int) for subticket_id in ids):
+        return jsonify({'status': 'error', 'message': "ids にはサブチケットのIDの配列を指定してください。"}), 400
+    try:
+        moved = reorder_subtickets(ticket, data.get('parent_id'), ids)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': "ids には親のすべての子のサブチケットを指定してください。"}), 400
+    db.session.commit()
+    return jsonify({'status': 'success', 'moved': moved})
+
+@app.route('/api/tickets/<int:ticket_id>', methods=['PATCH'])
+@login_required
+def api_update_ticket(ticket_id):
+    """{"version": 取得したときの版数, "changes": {"列": [変更前, 変更後]}} でチケットを更新する
+
+    他の更新と同じ列が衝突した場合は 409 と現在のチケットを返す。別の列の更新なら統合する。
+    """
+    ticket = organization_ticket_or_404(ticket_id)
+    if not (current_user.is_admin() or ticket.assignee_id == current_user.id or ticket.requester_id == current_user.id):
+        return jsonify({'status': 'error', 'message': "このチケットを編集する権限がありません。"}), 403
+    data = request.get_json(silent=True) or {}
+    version, raw_changes = data.get('version'), data.get('changes')
+    if not isinstance(version, int) or not isinstance(raw_changes, dict) or \
+            not set(raw_changes) <= set(TICKET_EDITABLE_FIELDS) or \
+            not all(isinstance(pair, list) and len(pair) == 2 for pair in raw_changes.values()):
+        return jsonify({'status': 'error', 'message': "version と changes ({列: [変更前, 変更後]}) を指定してください。"
+                        f" 変更できる列: {', '.join(TICKET_EDITABLE_FIELDS)}"}), 400
+    try:
+        changes = {field: [_ticket_json_value(field, before), _ticket_json_value(field, after)]
+                   for field, (before, after) in raw_changes.items()}
+        if 'assignee_id' in changes:
+            validate_assignee(ticket.organization_id, changes['assignee_id'][1])
+    except ValueError as error:
+        return jsonify({'status': 'error', 'message': str(error)}), 400
+
+    conflicts, merged = save_ticket_changes(ticket, version, changes)
+    current = load_ticket_row(ticket_id)
+    if conflicts:
+        return jsonify({'status': 'conflict', 'message': "他の更新と同じ列が衝突しました。",
+                        'conflicts': {field: {'yours': _json_value(mine), 'current': _json_value(value)}
+                                      for field, (mine, value) in conflicts.items()},
+                        'ticket': serialize_ticket(current)}), 409
+    return jsonify({'status': 'success', 'merged': merged, 'ticket': serialize_ticket(current)})
 
 @app.route('/profile/edit', methods=['GET', 'POST'])
 @login_required
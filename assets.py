@@ -0,0 +1,363 @@
+# assets.py
+"""テンプレートで使っているTailwindのユーティリティクラスからCSSを生成する。
+
+ブラウザでCSSをJITコンパイルするTailwindのCDNスクリプトの代わりに、templates/ の
+クラス名を走査して必要なルールだけを含む縮小済みのスタイルシートを作る。ネットワークや
+Node.jsを使わずにビルドできるよう、ユーティリティの定義はこのモジュールに持つ。
+
+出力はファイル名に内容のハッシュを含め (app.<hash>.css)、gzip / brotli で
+圧縮済みのファイルと、元の名前からハッシュ付きの名前を引く manifest.json を書き出す。
+
+    python assets.py            # static/dist にビルドする
+    flask build-assets          # 同上 (アプリのCLIから)
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+
+try:
+    import brotli
+except ImportError:  # brotliがなければgzipのみ作成する
+    brotli = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_DIR = os.path.join(BASE_DIR, 'templates')
+OUTPUT_DIR = os.path.join(BASE_DIR, 'static', 'dist')
+MANIFEST_NAME = 'manifest.json'
+STYLESHEET_NAME = 'app.css'
+
+# --- デザイントークン (Tailwind CSS v3 の既定値) ---
+COLORS = {
+    'slate': ['#f8fafc', '#f1f5f9', '#e2e8f0', '#cbd5e1', '#94a3b8',
+              '#64748b', '#475569', '#334155', '#1e293b', '#0f172a'],
+    'gray': ['#f9fafb', '#f3f4f6', '#e5e7eb', '#d1d5db', '#9ca3af',
+             '#6b7280', '#4b5563', '#374151', '#1f2937', '#111827'],
+    'red': ['#fef2f2', '#fee2e2', '#fecaca', '#fca5a5', '#f87171',
+            '#ef4444', '#dc2626', '#b91c1c', '#991b1b', '#7f1d1d'],
+    'orange': ['#fff7ed', '#ffedd5', '#fed7aa', '#fdba74', '#fb923c',
+               '#f97316', '#ea580c', '#c2410c', '#9a3412', '#7c2d12'],
+    'yellow': ['#fefce8', '#fef9c3', '#fef08a', '#fde047', '#facc15',
+               '#eab308', '#ca8a04', '#a16207', '#854d0e', '#713f12'],
+    'green': ['#f0fdf4', '#dcfce7', '#bbf7d0', '#86efac', '#4ade80',
+              '#22c55e', '#16a34a', '#15803d', '#166534', '#14532d'],
+    'sky': ['#f0f9ff', '#e0f2fe', '#bae6fd', '#7dd3fc', '#38bdf8',
+            '#0ea5e9', '#0284c7', '#0369a1', '#075985', '#0c4a6e'],
+    'blue': ['#eff6ff', '#dbeafe', '#bfdbfe', '#93c5fd', '#60a5fa',
+             '#3b82f6', '#2563eb', '#1d4ed8', '#1e40af', '#1e3a8a'],
+    'indigo': ['#eef2ff', '#e0e7ff', '#c7d2fe', '#a5b4fc', '#818cf8',
+               '#6366f1', '#4f46e5', '#4338ca', '#3730a3', '#312e81'],
+    'purple': ['#faf5ff', '#f3e8ff', '#e9d5ff', '#d8b4fe', '#c084fc',
+               '#a855f7', '#9333ea', '#7e22ce', '#6b21a8', '#581c87'],
+}
+SHADES = ['50', '100', '200', '300', '400', '500', '600', '700', '800', '900']
+SPECIAL_COLORS = {'white': '#fff', 'black': '#000', 'transparent': 'transparent', 'current': 'currentColor'}
+
+BREAKPOINTS = [('sm', '640px'), ('md', '768px'), ('lg', '1024px'), ('xl', '1280px'), ('2xl', '1536px')]
+PSEUDO_CLASSES = {'hover': ':hover', 'focus': ':focus', 'active': ':active', 'disabled': ':disabled'}
+
+FONT_SIZES = {
+    'xs': ('.75rem', '1rem'), 'sm': ('.875rem', '1.25rem'), 'base': ('1rem', '1.5rem'),
+    'lg': ('1.125rem', '1.75rem'), 'xl': ('1.25rem', '1.75rem'), '2xl': ('1.5rem', '2rem'),
+    '3xl': ('1.875rem', '2.25rem'), '4xl': ('2.25rem', '2.5rem'), '5xl': ('3rem', '1'),
+}
+MAX_WIDTHS = {
+    'xs': '20rem', 'sm': '24rem', 'md': '28rem', 'lg': '32rem', 'xl': '36rem', '2xl': '42rem',
+    '3xl': '48rem', '4xl': '56rem', '5xl': '64rem', '6xl': '72rem', '7xl': '80rem', 'full': '100%',
+}
+RADII = {'none': '0', 'sm': '.125rem', '': '.25rem', 'md': '.375rem', 'lg': '.5rem', 'xl': '.75rem',
+         '2xl': '1rem', 'full': '9999px'}
+SHADOWS = {
+    'sm': '0 1px 2px 0 rgb(0 0 0/.05)',
+    '': '0 1px 3px 0 rgb(0 0 0/.1),0 1px 2px -1px rgb(0 0 0/.1)',
+    'md': '0 4px 6px -1px rgb(0 0 0/.1),0 2px 4px -2px rgb(0 0 0/.1)',
+    'lg': '0 10px 15px -3px rgb(0 0 0/.1),0 4px 6px -4px rgb(0 0 0/.1)',
+    'none': '0 0 #0000',
+}
+FONT_WEIGHTS = {'normal': '400', 'medium': '500', 'semibold': '600', 'bold': '700'}
+TRACKING = {'tighter': '-.05em', 'tight': '-.025em', 'normal': '0', 'wide': '.025em', 'wider': '.05em',
+            'widest': '.1em'}
+
+# 値を持たないユーティリティ
+STATIC_UTILITIES = {
+    'block': 'display:block', 'inline-block': 'display:inline-block', 'inline': 'display:inline',
+    'flex': 'display:flex', 'inline-flex': 'display:inline-flex', 'grid': 'display:grid',
+    'table': 'display:table', 'hidden': 'display:none',
+    'flex-wrap': 'flex-wrap:wrap', 'flex-col': 'flex-direction:column', 'flex-1': 'flex:1 1 0%',
+    'items-start': 'align-items:flex-start', 'items-center': 'align-items:center',
+    'items-end': 'align-items:flex-end', 'items-baseline': 'align-items:baseline',
+    'justify-start': 'justify-content:flex-start', 'justify-center': 'justify-content:center',
+    'justify-end': 'justify-content:flex-end', 'justify-between': 'justify-content:space-between',
+    'w-full': 'width:100%', 'w-auto': 'width:auto', 'h-full': 'height:100%', 'h-screen': 'height:100vh',
+    'min-w-full': 'min-width:100%', 'min-h-screen': 'min-height:100vh',
+    'overflow-hidden': 'overflow:hidden', 'overflow-auto': 'overflow:auto', 'overflow-x-auto': 'overflow-x:auto',
+    'text-left': 'text-align:left', 'text-center': 'text-align:center', 'text-right': 'text-align:right',
+    'uppercase': 'text-transform:uppercase', 'lowercase': 'text-transform:lowercase',
+    'italic': 'font-style:italic', 'underline': 'text-decoration-line:underline',
+    'line-through': 'text-decoration-line:line-through',
+    'whitespace-nowrap': 'white-space:nowrap', 'truncate': 'overflow:hidden;text-overflow:ellipsis;white-space:nowrap',
+    'align-baseline': 'vertical-align:baseline', 'align-middle': 'vertical-align:middle',
+    'appearance-none': 'appearance:none', 'list-disc': 'list-style-type:disc',
+    'border': 'border-width:1px', 'border-0': 'border-width:0', 'border-2': 'border-width:2px',
+    'border-t': 'border-top-width:1px', 'border-b': 'border-bottom-width:1px',
+    'cursor-pointer': 'cursor:pointer', 'cursor-move': 'cursor:move', 'opacity-50': 'opacity:.5',
+    'outline-none': 'outline:2px solid transparent;outline-offset:2px',
+    'transition': ('transition-property:color,background-color,border-color,text-decoration-color,fill,stroke,'
+                   'opacity,box-shadow,transform,filter,backdrop-filter;'
+                   'transition-timing-function:cubic-bezier(.4,0,.2,1);transition-duration:150ms'),
+}
+
+SPACING_PROPERTIES = {
+    'm': ['margin'], 'mx': ['margin-left', 'margin-right'], 'my': ['margin-top', 'margin-bottom'],
+    'mt': ['margin-top'], 'mr': ['margin-right'], 'mb': ['margin-bottom'], 'ml': ['margin-left'],
+    'p': ['padding'], 'px': ['padding-left', 'padding-right'], 'py': ['padding-top', 'padding-bottom'],
+    'pt': ['padding-top'], 'pr': ['padding-right'], 'pb': ['padding-bottom'], 'pl': ['padding-left'],
+    'gap': ['gap'], 'gap-x': ['column-gap'], 'gap-y': ['row-gap'],
+    'w': ['width'], 'h': ['height'],
+}
+
+# 兄弟要素の間に適用するユーティリティ (space-y-4, divide-y など)
+BETWEEN_CHILDREN = '>:not([hidden])~:not([hidden])'
+
+# Tailwindのpreflight (ブラウザ既定スタイルのリセット) を縮めたもの
+PREFLIGHT = (
+    '*,::before,::after{box-sizing:border-box;border:0 solid #e5e7eb}'
+    'html{line-height:1.5;-webkit-text-size-adjust:100%;tab-size:4;font-family:ui-sans-serif,system-ui,'
+    'sans-serif,"Apple Color Emoji","Segoe UI Emoji","Segoe UI Symbol","Noto Color Emoji"}'
+    'body{margin:0;line-height:inherit}'
+    'h1,h2,h3,h4,h5,h6{font-size:inherit;font-weight:inherit}'
+    'a{color:inherit;text-decoration:inherit}'
+    'b,strong{font-weight:bolder}'
+    'table{text-indent:0;border-color:inherit;border-collapse:collapse}'
+    'button,input,optgroup,select,textarea{font-family:inherit;font-size:100%;font-weight:inherit;'
+    'line-height:inherit;color:inherit;margin:0;padding:0}'
+    'button,select{text-transform:none}'
+    'button,[type=button],[type=reset],[type=submit]{-webkit-appearance:button;background-color:transparent;'
+    'background-image:none}'
+    'blockquote,dl,dd,h1,h2,h3,h4,h5,h6,hr,figure,p,pre{margin:0}'
+    'fieldset{margin:0;padding:0}'
+    'ol,ul,menu{list-style:none;margin:0;padding:0}'
+    'textarea{resize:vertical}'
+    'input::placeholder,textarea::placeholder{opacity:1;color:#9ca3af}'
+    'button,[role=button]{cursor:pointer}'
+    'img,svg,video,canvas,audio,iframe,embed,object{display:block;vertical-align:middle}'
+    'img,video{max-width:100%;height:auto}'
+    '[hidden]{display:none}'
+)
+
+CANDIDATE_PATTERN = re.compile(r'[a-z0-9][a-z0-9:\-./]*')
+
+
+def _spacing_value(value):
+    if value == 'px':
+        return '1px'
+    if value == 'auto':
+        return 'auto'
+    if value == 'full':
+        return '100%'
+    if re.fullmatch(r'\d+(\.5)?', value):
+        number = float(value) / 4
+        if number == 0:
+            return '0'
+        return re.sub(r'^0\.', '.', f'{number:g}') + 'rem'
+    return None
+
+
+def _color_value(value):
+    if value in SPECIAL_COLORS:
+        return SPECIAL_COLORS[value]
+    name, _, shade = value.rpartition('-')
+    if name in COLORS and shade in SHADES:
+        return COLORS[name][SHADES.index(shade)]
+    return None
+
+
+def utility_rules(utility):
+    """バリアントを除いたクラス名から (セレクタの接尾辞, 宣言) のリストを返す。未対応なら None"""
+    if utility in STATIC_UTILITIES:
+        return [('', STATIC_UTILITIES[utility])]
+    if utility == 'container':
+        return [('', 'width:100%')]
+
+    prefix, _, value = utility.rpartition('-')
+    if prefix in SPACING_PROPERTIES:
+        size = _spacing_value(value)
+        if size is not None:
+            return [('', ';'.join(f'{prop}:{size}' for prop in SPACING_PROPERTIES[prefix]))]
+
+    if utility.startswith(('space-y-', 'space-x-')):
+        size = _spacing_value(utility[8:])
+        side = 'margin-top' if utility[6] == 'y' else 'margin-left'
+        return [(BETWEEN_CHILDREN, f'{side}:{size}')] if size else None
+    if utility in ('divide-y', 'divide-x'):
+        if utility == 'divide-y':
+            return [(BETWEEN_CHILDREN, 'border-top-width:1px;border-bottom-width:0')]
+        return [(BETWEEN_CHILDREN, 'border-left-width:1px;border-right-width:0')]
+    if utility.startswith('divide-'):
+        color = _color_value(utility[7:])
+        return [(BETWEEN_CHILDREN, f'border-color:{color}')] if color else None
+
+    if utility.startswith('grid-cols-') and utility[10:].isdigit():
+        return [('', f'grid-template-columns:repeat({utility[10:]},minmax(0,1fr))')]
+    if utility.startswith('max-w-') and utility[6:] in MAX_WIDTHS:
+        return [('', f'max-width:{MAX_WIDTHS[utility[6:]]}')]
+    if utility.startswith('font-') and utility[5:] in FONT_WEIGHTS:
+        return [('', f'font-weight:{FONT_WEIGHTS[utility[5:]]}')]
+    if utility.startswith('tracking-') and utility[9:] in TRACKING:
+        return [('', f'letter-spacing:{TRACKING[utility[9:]]}')]
+    if utility.startswith('leading-'):
+        size = _spacing_value(utility[8:])
+        return [('', f'line-height:{size}')] if size else None
+    if utility == 'rounded' or utility.startswith('rounded-'):
+        radius = RADII.get(utility[8:])
+        return [('', f'border-radius:{radius}')] if radius else None
+    if utility == 'shadow' or utility.startswith('shadow-'):
+        shadow = SHADOWS.get(utility[7:])
+        return [('', f'box-shadow:{shadow}')] if shadow else None
+    if utility.startswith('ring-') and utility[5:].isdigit() or utility == 'ring':
+        width = utility[5:] or '3'
+        return [('', f'box-shadow:0 0 0 {width}px var(--tw-ring-color,rgb(59 130 246/.5))')]
+
+    for prefix, prop in (('text-', 'color'), ('bg-', 'background-color'), ('border-', 'border-color'),
+                         ('ring-', '--tw-ring-color')):
+        if utility.startswith(prefix):
+            value = utility[len(prefix):]
+            if prefix == 'text-' and value in FONT_SIZES:
+                size, line_height = FONT_SIZES[value]
+                return [('', f'font-size:{size};line-height:{line_height}')]
+            color = _color_value(value)
+            return [('', f'{prop}:{color}')] if color else None
+    return None
+
+
+def escape_class(name):
+    return re.sub(r'([:./])', r'\\\1', name)
+
+
+def parse_class(name):
+    """クラス名を (ブレークポイント, 疑似クラス, ユーティリティ) に分解する"""
+    *variants, utility = name.split(':')
+    breakpoint, pseudo = None, ''
+    for variant in variants:
+        if variant in dict(BREAKPOINTS) and breakpoint is None:
+            breakpoint = variant
+        elif variant in PSEUDO_CLASSES:
+            pseudo += PSEUDO_CLASSES[variant]
+        else:
+            return None
+    return breakpoint, pseudo, utility
+
+
+def scan_templates(template_dir=TEMPLATE_DIR):
+    """テンプレート中のクラス名の候補を集める (Tailwindと同様に全トークンを候補とする)"""
+    candidates = set()
+    for root, _, files in os.walk(template_dir):
+        for filename in files:
+            if filename.endswith(('.html', '.js')):
+                with open(os.path.join(root, filename), encoding='utf-8') as f:
+                    candidates.update(CANDIDATE_PATTERN.findall(f.read()))
+    return candidates
+
+
+def build_css(class_names):
+    """クラス名の集合から縮小済みのCSSを生成する。未対応のトークンは無視する"""
+    base_rules = []
+    responsive_rules = {key: [] for key, _ in BREAKPOINTS}
+    # バリアント付きのクラスは、同じ詳細度の基本ユーティリティより後に出力する
+    for name in sorted(class_names, key=lambda name: (':' in name, name)):
+        parsed = parse_class(name)
+        if parsed is None:
+            continue
+        breakpoint, pseudo, utility = parsed
+        rules = utility_rules(utility)
+        if not rules:
+            continue
+        selector = '.' + escape_class(name) + pseudo
+        css = ''.join(f'{selector}{suffix}{{{declarations}}}' for suffix, declarations in rules)
+        (responsive_rules[breakpoint] if breakpoint else base_rules).append(css)
+
+    output = [PREFLIGHT]
+    if 'container' in class_names:
+        # .container は各ブレークポイントで最大幅を持つ
+        output.append('.container{width:100%}')
+        output.extend(f'@media (min-width:{width}){{.container{{max-width:{width}}}}}' for _, width in BREAKPOINTS)
+    output.extend(rule for rule in base_rules if not rule.startswith('.container{'))
+    for key, width in BREAKPOINTS:
+        if responsive_rules[key]:
+            output.append(f'@media (min-width:{width}){{{"".join(responsive_rules[key])}}}')
+    return ''.join(output)
+
+
+def fingerprint(content):
+    return hashlib.sha256(content).hexdigest()[:12]
+
+
+def write_asset(output_dir, logical_name, content):
+    """内容のハッシュを含む名前で書き出し、圧縮済みのファイルも作成する。書き出した名前を返す"""
+    stem, ext = os.path.splitext(logical_name)
+    hashed_name = f'{stem}.{fingerprint(content)}{ext}'
+    path = os.path.join(output_dir, hashed_name)
+    with open(path, 'wb') as f:
+        f.write(content)
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(content, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(content, quality=11))
+    return hashed_name
+
+
+def build_assets(template_dir=TEMPLATE_DIR, output_dir=OUTPUT_DIR):
+    """スタイルシートをビルドし、manifest.json を書き出す。manifestの内容を返す"""
+    os.makedirs(output_dir, exist_ok=True)
+    css = build_css(scan_templates(template_dir)).encode('utf-8')
+    manifest = {STYLESHEET_NAME: write_asset(output_dir, STYLESHEET_NAME, css)}
+
+    # 以前のビルドで作成した古いファイルを削除する
+    current = set(manifest.values())
+    for filename in os.listdir(output_dir):
+        base = re.sub(r'\.(gz|br)$', '', filename)
+        if filename != MANIFEST_NAME and base not in current:
+            os.remove(os.path.join(output_dir, filename))
+
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+class AssetManifest:
+    """元のファイル名からハッシュ付きのファイル名を引く。manifestがなければビルドする"""
+
+    def __init__(self, output_dir=OUTPUT_DIR, template_dir=TEMPLATE_DIR):
+        self.output_dir = output_dir
+        self.template_dir = template_dir
+        self._manifest = None
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            path = os.path.join(self.output_dir, MANIFEST_NAME)
+            if os.path.exists(path):
+                with open(path, encoding='utf-8') as f:
+                    self._manifest = json.load(f)
+            else:
+                self._manifest = build_assets(self.template_dir, self.output_dir)
+        return self._manifest
+
+    def resolve(self, logical_name):
+        return self.manifest[logical_name]
+
+    def is_fingerprinted(self, filename):
+        return filename in self.manifest.values()
+
+    def reload(self):
+        self._manifest = None
+
+
+if __name__ == '__main__':
+    output = sys.argv[1] if len(sys.argv) > 1 else OUTPUT_DIR
+    for logical_name, hashed_name in build_assets(output_dir=output).items():
+        print(f"{logical_name} -> {os.path.join(output, hashed_name)}")
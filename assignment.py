@@ -0,0 +1,164 @@
+# assignment.py
+"""新しいチケットの担当者の自動割り当て。
+
+組織ごとに次のいずれかの方式を選べる (Organization.auto_assign_strategy、未設定なら割り当てない)。
+- round_robin: 組織のユーザーに順番に割り当てる
+- least_open: 未解決のチケットが最も少ないユーザーに割り当てる
+- priority_weighted: 未解決のチケットの優先度の合計 (低=1, 中=2, 高=3) が最も小さいユーザーに割り当てる
+
+担当者ごとの負荷はプロセス内の表 (OrganizationLoad) に持ち、チケットの追加・変更・削除の
+コミット時に増減させる。割り当てのたびにチケットを数えることはせず、負荷の値ごとの
+バケット (LoadBuckets) から最小の担当者を O(1) で取り出す。
+
+他のワーカーでの変更やDBのカスケードでの変更はこの表に反映されないため、
+reconcile_interval 秒ごとに組織の担当者と負荷をDBから読み直す。
+"""
+
+import threading
+import time
+from collections import defaultdict
+
+
+class LoadBuckets:
+    """担当者ごとの負荷を値ごとのバケットに分けて持ち、負荷が最小の担当者を O(1) で返す
+
+    同じ負荷の担当者は、その負荷になった順 (先に来た担当者から) に返す。
+    """
+
+    def __init__(self):
+        self._loads = {}
+        self._buckets = defaultdict(dict)  # 負荷 → {担当者: None} (挿入順を保つ集合として使う)
+        self._min = None
+
+    def __contains__(self, member):
+        return member in self._loads
+
+    def load(self, member):
+        return self._loads.get(member, 0)
+
+    def add(self, member, load=0):
+        if member in self._loads:
+            self.remove(member)
+        self._loads[member] = load
+        self._buckets[load][member] = None
+        if self._min is None or load < self._min:
+            self._min = load
+
+    def remove(self, member):
+        load = self._loads.pop(member, None)
+        if load is None:
+            return
+        bucket = self._buckets[load]
+        del bucket[member]
+        if not bucket:
+            del self._buckets[load]
+            if load == self._min:
+                self._min = min(self._buckets) if self._buckets else None
+
+    def adjust(self, member, delta):
+        """負荷を delta だけ増減する (0未満にはしない)。表にない担当者は無視する"""
+        if member not in self._loads or delta == 0:
+            return
+        old = self._loads[member]
+        new = max(0, old + delta)
+        bucket = self._buckets[old]
+        del bucket[member]
+        if not bucket:
+            del self._buckets[old]
+        self._loads[member] = new
+        self._buckets[new][member] = None
+        if new < self._min:
+            self._min = new
+        elif old == self._min and old not in self._buckets:
+            # 最小のバケットが空になった場合、次の最小は old より大きく new 以下にある
+            while self._min not in self._buckets:
+                self._min += 1
+
+    def least(self):
+        if self._min is None:
+            return None
+        return next(iter(self._buckets[self._min]))
+
+
+class OrganizationLoad:
+    """組織の担当者の一覧と、担当者ごとの未解決チケットの件数・優先度の合計"""
+
+    def __init__(self, members, loads, loaded_at):
+        """members はユーザーIDの列。loads は (担当者ID, 件数, 優先度の合計) の列"""
+        self.members = list(members)
+        self.open_counts = LoadBuckets()
+        self.weighted = LoadBuckets()
+        for member in self.members:
+            self.open_counts.add(member)
+            self.weighted.add(member)
+        for member, count, weight in loads:
+            if member in self.open_counts:
+                self.open_counts.adjust(member, int(count or 0))
+                self.weighted.adjust(member, int(weight or 0))
+        self.loaded_at = loaded_at
+        self._next = 0
+
+    def choose(self, strategy):
+        if not self.members:
+            return None
+        if strategy == 'round_robin':
+            member = self.members[self._next % len(self.members)]
+            self._next += 1
+            return member
+        if strategy == 'least_open':
+            return self.open_counts.least()
+        if strategy == 'priority_weighted':
+            return self.weighted.least()
+        raise ValueError(f"未対応の割り当て方式です: {strategy}")
+
+    def apply(self, member, count, weight):
+        self.open_counts.adjust(member, count)
+        self.weighted.adjust(member, weight)
+
+
+class AutoAssigner:
+    """組織ごとの OrganizationLoad を保持し、新しいチケットの担当者を選ぶ
+
+    loader は組織IDを受け取り (ユーザーIDの列, (担当者ID, 件数, 優先度の合計) の列) を返す関数。
+    """
+
+    def __init__(self, loader, reconcile_interval=60.0, clock=time.monotonic):
+        self.loader = loader
+        self.reconcile_interval = reconcile_interval
+        self.clock = clock
+        self._organizations = {}
+        self._lock = threading.Lock()
+
+    def _organization(self, organization_id):
+        now = self.clock()
+        organization = self._organizations.get(organization_id)
+        if organization is None or now - organization.loaded_at >= self.reconcile_interval:
+            members, loads = self.loader(organization_id)
+            with self._lock:
+                previous, organization = organization, OrganizationLoad(members, loads, now)
+                if previous is not None:
+                    # 読み直しても順番に割り当てる位置は引き継ぐ
+                    organization._next = previous._next
+                self._organizations[organization_id] = organization
+        return organization
+
+    def choose(self, organization_id, strategy):
+        """新しいチケットの担当者のユーザーIDを返す (組織にユーザーがいなければ None)"""
+        organization = self._organization(organization_id)
+        with self._lock:
+            return organization.choose(strategy)
+
+    def apply(self, deltas):
+        """{(組織ID, 担当者ID): (件数の増減, 優先度の合計の増減)} を読み込み済みの組織に反映する"""
+        with self._lock:
+            for (organization_id, member), (count, weight) in deltas.items():
+                organization = self._organizations.get(organization_id)
+                if organization is not None:
+                    organization.apply(member, count, weight)
+
+    def invalidate(self, organization_id=None):
+        with self._lock:
+            if organization_id is None:
+                self._organizations.clear()
+            else:
+                self._organizations.pop(organization_id, None)
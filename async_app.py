@@ -0,0 +1,261 @@
+# async_app.py
+"""読み取り系エンドポイントの非同期 (ASGI) 版。
+
+遅いクエリがgunicornのスレッドを占有しないよう、ダッシュボード一覧・チケット詳細・
+検索・JSON一覧を sqlalchemy.ext.asyncio (asyncpg / aiosqlite) で提供する。
+モデル・テンプレート・セッションCookieは app.py のWSGIアプリと共有するため、
+同じドメインの読み取りリクエストだけをこちらへ振り分けて使う。
+
+    uvicorn async_app:asgi_app --host 0.0.0.0 --port 5002
+"""
+
+import json
+import re
+from urllib.parse import parse_qs
+
+from flask import g, render_template, session as flask_session
+from itsdangerous import BadSignature
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from werkzeug.http import parse_cookie
+
+from app import (app as flask_app, Ticket, User, Organization, OrganizationShard, PRIORITIES, TICKET_STATUSES,
+                 build_organization_users_query, build_ticket_list_query, to_ticket_rows, serialize_ticket,
+                 parse_user_id, shard_directory, shard_map)
+from sharding import DEFAULT_SHARD, ShardEntry
+
+# 同期ドライバのURLを非同期ドライバに読み替える
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def to_async_url(database_url):
+    """同期用のデータベースURLを非同期ドライバ用のURLに変換する"""
+    url = make_url(database_url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"非同期ドライバに対応していないデータベースです: {backend}")
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+class AsyncReadApp:
+    """読み取り専用エンドポイントを提供する最小限のASGIアプリケーション"""
+
+    def __init__(self, flask_app, database_url=None, engine=None):
+        self.flask_app = flask_app
+        self.engine = engine or create_async_engine(
+            to_async_url(database_url or flask_app.config['SQLALCHEMY_DATABASE_URI']),
+            pool_pre_ping=True
+        )
+        # シャードごとの非同期エンジン (初回利用時に作成する)
+        self.engines = {DEFAULT_SHARD: self.engine}
+        # レスポンス生成時に属性を再読み込みしないよう、コミット時の失効を無効化
+        self.sessionmaker = async_sessionmaker(self.engine, expire_on_commit=False)
+        self.routes = [
+            (re.compile(r'^/$'), self.dashboard),
+            (re.compile(r'^/api/tickets$'), self.ticket_list),
+            (re.compile(r'^/api/tickets/(\d+)$'), self.ticket_detail),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        if scope['method'] not in ('GET', 'HEAD'):
+            await self._send_json(send, 405, {'status': 'error', 'message': 'Method Not Allowed'})
+            return
+
+        for pattern, handler in self.routes:
+            match = pattern.match(scope['path'])
+            if match:
+                identity = self.session_identity(scope)
+                shard_key = await self.shard_for(identity.organization_id) if identity else DEFAULT_SHARD
+                async with self.sessionmaker(bind=self.engine_for(shard_key)) as session:
+                    await handler(scope, send, session, *match.groups())
+                return
+        await self._send_json(send, 404, {'status': 'error', 'message': 'Not Found'})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for engine in self.engines.values():
+                    await engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    # --- シャード ---
+    def engine_for(self, shard_key):
+        if shard_key not in self.engines:
+            self.engines[shard_key] = create_async_engine(to_async_url(shard_map.urls[shard_key]),
+                                                          pool_pre_ping=True)
+        return self.engines[shard_key]
+
+    async def shard_for(self, organization_id):
+        """組織のシャードを返す。ディレクトリはWSGI側と同じプロセス内キャッシュを使う"""
+        if organization_id is None:
+            return DEFAULT_SHARD
+        entry = shard_directory.get_cached(organization_id)
+        if entry is None:
+            async with self.sessionmaker(bind=self.engine) as session:
+                row = await session.get(OrganizationShard, organization_id)
+            entry = ShardEntry(row.shard_key, row.read_only) if row else ShardEntry(DEFAULT_SHARD, False)
+            shard_directory.store(organization_id, entry)
+        return entry.shard_key
+
+    # --- 認証 ---
+    def _cookie_header(self, scope):
+        for name, value in scope.get('headers', []):
+            if name == b'cookie':
+                return value.decode('latin-1')
+        return ''
+
+    def session_identity(self, scope):
+        """Flaskのセッションを検証し、(組織ID, ユーザーID, シャード) を返す。DBには問い合わせない"""
+        cookies = parse_cookie(self._cookie_header(scope))
+        cookie_value = cookies.get(self.flask_app.config['SESSION_COOKIE_NAME'])
+        if not cookie_value:
+            return None
+
+        serializer = self.flask_app.session_interface.get_signing_serializer(self.flask_app)
+        try:
+            data = serializer.loads(
+                cookie_value,
+                max_age=int(self.flask_app.permanent_session_lifetime.total_seconds())
+            )
+        except BadSignature:
+            return None
+
+        user_id = data.get('_user_id')
+        if not user_id:
+            return None
+        return parse_user_id(user_id)
+
+    async def load_current_user(self, session, scope):
+        """ログイン中のユーザーを、組織のシャードから取得する"""
+        identity = self.session_identity(scope)
+        if identity is None:
+            return None
+        # テンプレートで参照する role は遅延読み込みできないため先に読み込む
+        user = await session.get(User, identity.user_id, options=[joinedload(User.role)])
+        if user is None or identity.organization_id not in (None, user.organization_id):
+            return None
+        # ログインしたときと組織のシャードが異なるセッションは、WSGI側と同じく無効にする
+        if await self.shard_for(user.organization_id) != (identity.shard_key or DEFAULT_SHARD):
+            return None
+        # 組織はシャードにコピーした行ではなく、既定のデータベースの行を使う
+        async with self.sessionmaker(bind=self.engine) as default_session:
+            organization = await default_session.get(Organization, user.organization_id)
+        if organization is None:
+            return None
+        set_committed_value(user, 'organization', organization)
+        return user
+
+    # --- ハンドラ ---
+    def _list_params(self, scope):
+        args = {k: v[0] for k, v in parse_qs(scope.get('query_string', b'').decode()).items()}
+        return {
+            'filter_status': args.get('filter_status'),
+            'search_term': args.get('search_term'),
+            'sort_by': args.get('sort_by', 'id'),
+            'sort_order': args.get('sort_order', 'desc'),
+        }
+
+    async def dashboard(self, scope, send, session):
+        user = await self.load_current_user(session, scope)
+        if user is None:
+            await self._send(send, 302, b'', headers=[(b'location', b'/login')])
+            return
+
+        params = self._list_params(scope)
+        tickets = to_ticket_rows(await session.execute(*build_ticket_list_query(user.organization_id, **params)))
+        organization_users = (await session.execute(*build_organization_users_query(user.organization_id))).all()
+
+        # テンプレート・url_for・フラッシュメッセージはFlaskのリクエストコンテキスト上で処理する
+        with self.flask_app.test_request_context(
+                scope['path'],
+                query_string=scope.get('query_string', b''),
+                headers={'Cookie': self._cookie_header(scope)}):
+            g._login_user = user
+            body = render_template(
+                'index.html',
+                tickets=tickets,
+                organization_users=organization_users,
+                priorities=PRIORITIES,
+                ticket_statuses=TICKET_STATUSES,
+                current_sort_by=params['sort_by'],
+                current_sort_order=params['sort_order'],
+                current_filter_status=params['filter_status'],
+                current_search_term=params['search_term']
+            )
+            # 表示済みのフラッシュメッセージを消すため、更新されたセッションCookieを返す
+            response = self.flask_app.response_class()
+            self.flask_app.session_interface.save_session(self.flask_app, flask_session, response)
+            headers = [(b'set-cookie', value.encode('latin-1'))
+                       for value in response.headers.getlist('Set-Cookie')]
+
+        headers.append((b'content-type', b'text/html; charset=utf-8'))
+        await self._send(send, 200, body.encode('utf-8'), headers=headers)
+
+    async def ticket_list(self, scope, send, session):
+        user = await self.load_current_user(session, scope)
+        if user is None:
+            await self._send_json(send, 401, {'status': 'error', 'message': 'ログインが必要です。'})
+            return
+
+        tickets = to_ticket_rows(await session.execute(
+            *build_ticket_list_query(user.organization_id, **self._list_params(scope))
+        ))
+        await self._send_json(send, 200, {
+            'status': 'success',
+            'tickets': [serialize_ticket(ticket) for ticket in tickets]
+        })
+
+    async def ticket_detail(self, scope, send, session, ticket_id):
+        user = await self.load_current_user(session, scope)
+        if user is None:
+            await self._send_json(send, 401, {'status': 'error', 'message': 'ログインが必要です。'})
+            return
+
+        ticket = (await session.scalars(
+            select(Ticket).options(
+                joinedload(Ticket.requester),
+                joinedload(Ticket.assignee),
+                selectinload(Ticket.subtickets)
+            ).filter_by(id=int(ticket_id), organization_id=user.organization_id)
+        )).first()
+        if ticket is None:
+            await self._send_json(send, 404, {'status': 'error', 'message': 'チケットが見つかりません。'})
+            return
+
+        data = serialize_ticket(ticket)
+        data['subtickets'] = [
+            {'id': sub.id, 'parent_id': sub.parent_id, 'title': sub.title, 'completed': sub.completed,
+             'version': sub.version}
+            for sub in ticket.subtickets
+        ]
+        await self._send_json(send, 200, {'status': 'success', 'ticket': data})
+
+    # --- レスポンス送信 ---
+    async def _send(self, send, status, body, headers=None):
+        headers = list(headers or [])
+        headers.append((b'content-length', str(len(body)).encode()))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _send_json(self, send, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        await self._send(send, status, body, headers=[(b'content-type', b'application/json')])
+
+
+asgi_app = AsyncReadApp(flask_app)
@@ -0,0 +1,163 @@
+# attachments.py
+"""チケットの添付ファイルを、内容のハッシュ (SHA-256) を名前にしてローカルのディレクトリに保存する。
+
+    <保存先>/<組織ID>/<ハッシュの先頭2文字>/<ハッシュ>   ファイルの本体
+    <保存先>/tmp/upload-*                                 アップロード中の一時ファイル
+
+- アップロードは受け取りながら一時ファイルへ書き、同時にハッシュとサイズを数える
+  (ファイル全体をメモリに載せない)。書き終えたら本体の名前に rename する。
+- 組織の中で同じ内容のファイルは1つだけ保存し、複数の添付ファイルの行が同じ本体を指す。
+  組織ごとにディレクトリを分けるため、他の組織が同じファイルを持っているかは分からない。
+- 本体は行の削除と同時には消さない (同じ内容のアップロードと競合するため)。
+  どの行からも参照されなくなった本体は prune() で削除する。
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+import time
+from collections import namedtuple
+
+CHUNK_SIZE = 64 * 1024
+TMP_DIR = 'tmp'
+
+# deduplicated: 組織に同じ内容のファイルが既にあり、新しく保存しなかった
+StoredFile = namedtuple('StoredFile', ['sha256', 'size', 'deduplicated'])
+
+_SHA256 = re.compile(r'^[0-9a-f]{64}$')
+
+
+class AttachmentTooLarge(Exception):
+    """アップロードが上限のサイズを超えた (werkzeug のフォームの解析は ValueError を握りつぶすため別の型にする)"""
+
+    def __init__(self, max_size):
+        super().__init__(f"添付ファイルは {max_size} バイトまでです")
+        self.max_size = max_size
+
+
+class Upload:
+    """アップロード中の一時ファイル。書き込みながらハッシュとサイズを数える
+
+    werkzeug のフォームの解析 (stream_factory) からファイルとして使えるよう、
+    write() 以外は一時ファイルに委ねる。閉じたときに保存されていなければ削除する。
+    """
+
+    def __init__(self, directory, max_size=None):
+        fd, self.path = tempfile.mkstemp(dir=directory, prefix='upload-')
+        self._file = os.fdopen(fd, 'w+b')
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.max_size = max_size
+        self.stored = False
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            self.close()
+            raise AttachmentTooLarge(self.max_size)
+        self._hash.update(data)
+        return self._file.write(data)
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def close(self):
+        self._file.close()
+        if not self.stored:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AttachmentStore:
+    """組織ごとに内容のハッシュで添付ファイルを保存するディレクトリ"""
+
+    def __init__(self, root, max_size=None, chunk_size=CHUNK_SIZE):
+        self.root = root
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+
+    def path(self, organization_id, sha256):
+        if not _SHA256.match(sha256):
+            raise ValueError(f"SHA-256のハッシュではありません: {sha256!r}")
+        return os.path.join(self.root, str(int(organization_id)), sha256[:2], sha256)
+
+    def open_upload(self):
+        directory = os.path.join(self.root, TMP_DIR)
+        os.makedirs(directory, exist_ok=True)
+        return Upload(directory, self.max_size)
+
+    def commit(self, upload, organization_id):
+        """書き終えた upload を組織のファイルとして保存する"""
+        upload.flush()
+        os.fsync(upload.fileno())
+        target = self.path(organization_id, upload.sha256)
+        if os.path.exists(target):
+            # prune() の猶予時間を延ばし、参照する行のコミット前に削除されないようにする
+            os.utime(target)
+            upload.close()
+            return StoredFile(upload.sha256, upload.size, True)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(upload.path, target)
+        upload.stored = True
+        upload.close()
+        return StoredFile(upload.sha256, upload.size, False)
+
+    def save(self, stream, organization_id):
+        """stream を chunk_size ずつ読んで保存する"""
+        with self.open_upload() as upload:
+            while chunk := stream.read(self.chunk_size):
+                upload.write(chunk)
+            return self.commit(upload, organization_id)
+
+    def organization_ids(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(int(name) for name in os.listdir(self.root) if name.isdigit())
+
+    def prune(self, referenced, grace_seconds=24 * 60 * 60, log=None):
+        """どの行からも参照されていない本体と、残った一時ファイルを削除する
+
+        referenced(organization_id) は組織の行が参照するハッシュの集合を返す。
+        アップロード中 (行のコミット前) のファイルを消さないよう、猶予時間より前に
+        更新されたものだけを削除する。戻り値は削除したファイルの数。
+        """
+        cutoff = time.time() - grace_seconds
+        removed = 0
+
+        def remove_if_old(path):
+            nonlocal removed
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.unlink(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+
+        tmp_dir = os.path.join(self.root, TMP_DIR)
+        if os.path.isdir(tmp_dir):
+            for name in os.listdir(tmp_dir):
+                remove_if_old(os.path.join(tmp_dir, name))
+
+        for organization_id in self.organization_ids():
+            keep = referenced(organization_id)
+            organization_dir = os.path.join(self.root, str(organization_id))
+            for prefix in os.listdir(organization_dir):
+                for name in os.listdir(os.path.join(organization_dir, prefix)):
+                    if name not in keep:
+                        remove_if_old(os.path.join(organization_dir, prefix, name))
+            if log:
+                log(f"組織ID {organization_id}: 参照されているファイル {len(keep)} 件")
+        return removed
@@ -0,0 +1,142 @@
+# benchmarks/async_read_bench.py
+"""DB遅延を注入した状態で、WSGI (スレッド) と ASGI (非同期) のダッシュボードの同時処理性能を比較する。
+
+WSGI側は `gunicorn --threads 8` を模したスレッドプール、ASGI側は1つのイベントループで
+同じ件数のリクエストを同時に処理し、スループットとレイテンシを表示する。
+
+    python benchmarks/async_read_bench.py --latency-ms 50 --requests 200 --concurrency 64
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import aiosqlite  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+from app import app, db, User, Ticket, Organization, Role  # noqa: E402
+from async_app import AsyncReadApp  # noqa: E402
+
+
+def seed(ticket_count):
+    with app.app_context():
+        db.create_all()
+        role = Role(name='admin')
+        org = Organization(name='BenchOrg')
+        user = User(username='bench', password_hash=generate_password_hash('pw'), organization=org, role=role)
+        db.session.add_all([role, org, user])
+        db.session.flush()
+        db.session.add_all([
+            Ticket(title=f'Ticket {i}', requester_id=user.id, organization_id=org.id, priority=i % 3 + 1)
+            for i in range(ticket_count)
+        ])
+        db.session.commit()
+        return user.get_id()
+
+
+def summarize(label, elapsed, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{label:<24} {len(latencies) / elapsed:8.1f} req/s   "
+          f"p50 {statistics.median(latencies) * 1000:7.1f} ms   p95 {p95 * 1000:7.1f} ms")
+
+
+def run_wsgi(cookie_value, args):
+    latency = args.latency_ms / 1000
+
+    with app.app_context():
+        engine = db.engine
+
+    # 同期ドライバ: クエリごとにスレッドをブロックする遅延を注入
+    @event.listens_for(engine, 'before_cursor_execute')
+    def inject_latency(*_):
+        time.sleep(latency)
+
+    def one_request(_):
+        client = app.test_client()
+        client.set_cookie('session', cookie_value)
+        started = time.perf_counter()
+        response = client.get('/')
+        assert response.status_code == 200
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        latencies = list(pool.map(one_request, range(args.requests)))
+    summarize(f'WSGI ({args.threads} threads)', time.perf_counter() - started, latencies)
+    event.remove(engine, 'before_cursor_execute', inject_latency)
+
+
+def run_asgi(cookie_value, args):
+    latency = args.latency_ms / 1000
+    original_execute = aiosqlite.Cursor.execute
+
+    # 非同期ドライバ: クエリごとにイベントループへ制御を返す遅延を注入
+    async def slow_execute(self, sql, parameters=None):
+        await asyncio.sleep(latency)
+        return await original_execute(self, sql, parameters)
+
+    asgi_app = AsyncReadApp(app, database_url=os.environ['DATABASE_URL'])
+    scope = {'type': 'http', 'method': 'GET', 'path': '/', 'query_string': b'',
+             'headers': [(b'cookie', f'session={cookie_value}'.encode())]}
+
+    async def one_request(semaphore):
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            messages.append(message)
+
+        async with semaphore:
+            started = time.perf_counter()
+            await asgi_app(scope, receive, send)
+            assert messages[0]['status'] == 200
+            return time.perf_counter() - started
+
+    async def main():
+        semaphore = asyncio.Semaphore(args.concurrency)
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(one_request(semaphore) for _ in range(args.requests)))
+        elapsed = time.perf_counter() - started
+        await asgi_app.engine.dispose()
+        return elapsed, latencies
+
+    aiosqlite.Cursor.execute = slow_execute
+    try:
+        elapsed, latencies = asyncio.run(main())
+    finally:
+        aiosqlite.Cursor.execute = original_execute
+    summarize(f'ASGI (concurrency {args.concurrency})', elapsed, latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--tickets', type=int, default=50)
+    args = parser.parse_args()
+
+    session_user_id = seed(args.tickets)
+    cookie_value = app.session_interface.get_signing_serializer(app).dumps({'_user_id': session_user_id})
+
+    print(f"injected DB latency: {args.latency_ms} ms/query, requests: {args.requests}, tickets: {args.tickets}")
+    run_wsgi(cookie_value, args)
+    run_asgi(cookie_value, args)
+
+
+if __name__ == '__main__':
+    main()
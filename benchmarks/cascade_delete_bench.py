@@ -0,0 +1,113 @@
+# benchmarks/cascade_delete_bench.py
+"""サブチケットを数百件持つチケットの削除を、ORMのカスケードとDBの ON DELETE CASCADE で比較する。
+
+ORMのカスケード (従来の挙動) はサブチケットをすべてセッションに読み込んでからDELETEを発行する。
+passive_deletes を使う現在の実装は、チケットのDELETEを1回発行するだけでDBがサブチケットを削除する。
+あわせて、purge-org が使うバッチ削除で組織全体を削除する時間も計測する。
+
+    python benchmarks/cascade_delete_bench.py --tickets 20 --subtickets 500
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import event, insert  # noqa: E402
+
+from app import app, db, User, Ticket, SubTicket, Organization, Role  # noqa: E402
+from sharding import purge_organization  # noqa: E402
+
+
+def seed(ticket_count, subticket_count):
+    role = Role.query.first() or Role(name='admin')
+    org = Organization(name=f'BenchOrg{time.time_ns()}')
+    user = User(username='bench', password_hash='x', organization=org, role=role)
+    db.session.add_all([role, org, user])
+    db.session.flush()
+    ticket_ids = db.session.scalars(
+        insert(Ticket).returning(Ticket.id),
+        [{'title': f'Ticket {i}', 'requester_id': user.id, 'organization_id': org.id, 'status': '新規'}
+         for i in range(ticket_count)]
+    ).all()
+    db.session.execute(insert(SubTicket), [
+        {'title': f'Step {n}', 'ticket_id': ticket_id, 'completed': False, 'position': n}
+        for ticket_id in ticket_ids for n in range(subticket_count)
+    ])
+    db.session.commit()
+    return org.id, ticket_ids
+
+
+class StatementCounter:
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def delete_with_orm_cascade(ticket_id):
+    """従来の挙動: サブチケットを読み込み、ORMが1件ずつ削除する"""
+    ticket = db.session.get(Ticket, ticket_id)
+    for subticket in list(ticket.subtickets):
+        db.session.delete(subticket)
+    db.session.delete(ticket)
+    db.session.commit()
+
+
+def delete_with_db_cascade(ticket_id):
+    """現在の実装 (delete_ticket と同じ): チケットだけを削除し、DBがサブチケットを削除する"""
+    db.session.delete(db.session.get(Ticket, ticket_id))
+    db.session.commit()
+
+
+def measure(label, delete, ticket_ids):
+    db.session.expunge_all()
+    with StatementCounter(db.engine) as counter:
+        started = time.perf_counter()
+        for ticket_id in ticket_ids:
+            delete(ticket_id)
+        elapsed = time.perf_counter() - started
+    per_ticket = elapsed / len(ticket_ids) * 1000
+    print(f"{label:<22} {per_ticket:8.2f} ms/ticket   {counter.count / len(ticket_ids):6.1f} statements/ticket")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tickets', type=int, default=20)
+    parser.add_argument('--subtickets', type=int, default=500)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+        print(f"tickets: {args.tickets}, subtickets/ticket: {args.subtickets}")
+
+        _, ticket_ids = seed(args.tickets, args.subtickets)
+        measure('ORM cascade', delete_with_orm_cascade, ticket_ids)
+
+        _, ticket_ids = seed(args.tickets, args.subtickets)
+        measure('ON DELETE CASCADE', delete_with_db_cascade, ticket_ids)
+
+        organization_id, _ = seed(args.tickets, args.subtickets)
+        started = time.perf_counter()
+        purge_organization(db.engine, db.metadata, organization_id, batch_size=args.batch_size)
+        print(f"{'purge-org (batched)':<22} {(time.perf_counter() - started) * 1000:8.2f} ms total "
+              f"(batch size {args.batch_size})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# benchmarks/dashboard_projection_bench.py
+"""ダッシュボード一覧の取得を、ORMのインスタンス (従来) と列の射影 (TicketRow) で比較する。
+
+従来の経路は Ticket と依頼者・担当者の User (パスワードハッシュを含む) を joinedload で
+組み立て、すべてセッションのidentity mapに登録する。現在の build_ticket_list_query は
+表示する列とユーザー名だけを取得して TicketRow (namedtuple) に詰める。
+クエリとテンプレートの描画を含めた時間と、tracemallocで測ったメモリのピークを表示する。
+
+    python benchmarks/dashboard_projection_bench.py --tickets 10000
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import g, render_template  # noqa: E402
+from sqlalchemy import insert, select  # noqa: E402
+from sqlalchemy.orm import joinedload  # noqa: E402
+
+from app import (app, db, User, Ticket, Organization, Role, PRIORITIES, TICKET_STATUSES,  # noqa: E402
+                 build_organization_users_query, build_ticket_list_query, to_ticket_rows)
+
+
+def seed(ticket_count, user_count=20):
+    role = Role(name='admin')
+    org = Organization(name='BenchOrg')
+    users = [User(username=f'user{i}', password_hash='pbkdf2:sha256:600000$' + 'x' * 80,
+                  organization=org, role=role) for i in range(user_count)]
+    db.session.add_all([role, org] + users)
+    db.session.flush()
+    user_ids = [user.id for user in users]
+    db.session.execute(insert(Ticket), [
+        {'title': f'Ticket {i} ' + 'x' * 40, 'status': TICKET_STATUSES[i % 5], 'priority': i % 3 + 1,
+         'organization_id': org.id, 'requester_id': user_ids[i % user_count],
+         'assignee_id': user_ids[(i * 7) % user_count] if i % 3 else None}
+        for i in range(ticket_count)
+    ])
+    db.session.commit()
+    return org.id, users[0].id
+
+
+def load_orm(organization_id):
+    """従来の経路: ORMのインスタンスを組み立てる"""
+    organization_users = User.query.filter_by(organization_id=organization_id).all()
+    tickets = db.session.scalars(
+        select(Ticket).options(joinedload(Ticket.requester), joinedload(Ticket.assignee))
+        .filter_by(organization_id=organization_id).order_by(Ticket.id.desc())
+    ).all()
+    return tickets, organization_users
+
+
+def load_rows(organization_id):
+    """現在の経路: 表示する列だけを取得する"""
+    organization_users = db.session.execute(*build_organization_users_query(organization_id)).all()
+    tickets = to_ticket_rows(db.session.execute(*build_ticket_list_query(organization_id)))
+    return tickets, organization_users
+
+
+def render(tickets, organization_users):
+    return render_template('index.html', tickets=tickets, organization_users=organization_users,
+                           priorities=PRIORITIES, ticket_statuses=TICKET_STATUSES,
+                           current_sort_by='id', current_sort_order='desc',
+                           current_filter_status=None, current_search_term=None)
+
+
+def measure(label, load, organization_id, repeat):
+    timings = {'query': [], 'render': []}
+    for _ in range(repeat):
+        db.session.expunge_all()
+        started = time.perf_counter()
+        tickets, organization_users = load(organization_id)
+        loaded = time.perf_counter()
+        render(tickets, organization_users)
+        timings['query'].append((loaded - started) * 1000)
+        timings['render'].append((time.perf_counter() - loaded) * 1000)
+
+    db.session.expunge_all()
+    tracemalloc.start()
+    tickets, organization_users = load(organization_id)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    identity_map_size = len(db.session.identity_map)
+    print(f"{label:<18} query {statistics.median(timings['query']):8.1f} ms   "
+          f"render {statistics.median(timings['render']):8.1f} ms   "
+          f"peak {peak / 1024 / 1024:7.1f} MiB   identity map {identity_map_size:>6} objects")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tickets', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+        organization_id, user_id = seed(args.tickets)
+        print(f"tickets: {args.tickets}")
+        with app.test_request_context('/'):
+            # テンプレートが参照する組織とロールを先に読み込み、セッションから切り離しておく
+            g._login_user = db.session.get(User, user_id, options=[joinedload(User.organization),
+                                                                   joinedload(User.role)])
+            measure('ORM (joinedload)', load_orm, organization_id, args.repeat)
+            measure('TicketRow', load_rows, organization_id, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
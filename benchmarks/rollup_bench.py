@@ -0,0 +1,104 @@
+# benchmarks/rollup_bench.py
+"""日次集計のバックフィル時間と、推移APIの応答時間を計測する。
+
+数年分のチケットを作成し、rebuild_organization (NumPyによる一括集計) で集計を作り直した後、
+/api/stats/trend と /api/stats/assignees を全期間で呼び出す。比較のため、集計テーブルを
+使わずにチケットから日ごとの作成数を数えるクエリの時間も表示する。
+
+    python benchmarks/rollup_bench.py --tickets 200000 --years 3
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import func, insert, select  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+from app import app, db, User, Ticket, TicketDailyStat, Organization, Role, login_throttle  # noqa: E402
+from rollups import rebuild_organization  # noqa: E402
+
+
+def seed(ticket_count, years, user_count=20):
+    role = Role(name='admin')
+    org = Organization(name='BenchOrg')
+    users = [User(username=f'user{i}', password_hash=generate_password_hash('pw'), organization=org, role=role)
+             for i in range(user_count)]
+    db.session.add_all([role, org] + users)
+    db.session.flush()
+
+    rng = random.Random(0)
+    start = datetime.utcnow() - timedelta(days=365 * years)
+    span = 365 * years * 24 * 3600
+    rows = []
+    for i in range(ticket_count):
+        created_at = start + timedelta(seconds=rng.randrange(span))
+        resolved = rng.random() < 0.8
+        rows.append({
+            'title': f'Ticket {i}', 'organization_id': org.id, 'requester_id': users[0].id,
+            'assignee_id': rng.choice(users).id if rng.random() < 0.9 else None,
+            'created_at': created_at,
+            'status': '解決済み' if resolved else '対応中',
+            'resolved_at': created_at + timedelta(hours=rng.randrange(1, 24 * 30)) if resolved else None,
+            'due_date': (created_at + timedelta(days=rng.randrange(1, 20))).date(),
+        })
+    for offset in range(0, len(rows), 10000):
+        db.session.execute(insert(Ticket), rows[offset:offset + 10000])
+    db.session.commit()
+    return org.id
+
+
+def timed(label, func_, repeat=1):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func_()
+        timings.append((time.perf_counter() - started) * 1000)
+    print(f"{label:<36} {statistics.median(timings):10.1f} ms")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tickets', type=int, default=200000)
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+        organization_id = seed(args.tickets, args.years)
+        print(f"tickets: {args.tickets}, years: {args.years}")
+
+        today = datetime.utcnow().date()
+        with db.engine.begin() as connection:
+            timed('backfill (rebuild_organization)', lambda: rebuild_organization(
+                connection, Ticket.__table__, TicketDailyStat.__table__, organization_id, today))
+        print(f"{'rollup rows':<36} {TicketDailyStat.query.count():10d}")
+
+        timed('created/day from tickets (no rollup)', lambda: db.session.execute(
+            select(func.date(Ticket.created_at), func.count())
+            .where(Ticket.organization_id == organization_id)
+            .group_by(func.date(Ticket.created_at))
+        ).all(), args.repeat)
+
+    login_throttle.reset()
+    client = app.test_client()
+    client.post('/login', data={'organization_name': 'BenchOrg', 'username': 'user0', 'password': 'pw'})
+    days = 365 * args.years
+    timed(f'GET /api/stats/trend ({days} days)', lambda: client.get(f'/api/stats/trend?days={days}'), args.repeat)
+    timed(f'GET /api/stats/assignees ({days} days)',
+          lambda: client.get(f'/api/stats/assignees?days={days}'), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
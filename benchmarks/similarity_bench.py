@@ -0,0 +1,75 @@
+# benchmarks/similarity_bench.py
+"""似ているチケットの検出で、1回の問い合わせにかかる時間を比較する。
+
+単純な方法 (組織の全チケットのタイトルと文字の2-gramの Jaccard 係数を1件ずつ計算する) と、
+TitleIndex (MinHash の署名と LSH のバケットで候補を絞り、候補だけを NumPy で比べる) で、
+同じタイトルの問い合わせを繰り返す。索引を作る時間 (起動後の最初の問い合わせ・作り直し) も表示する。
+
+    python benchmarks/similarity_bench.py --tickets 100000 --queries 200
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from similarity import TitleIndex, normalize  # noqa: E402
+
+SUBJECTS = ['ログイン画面', '請求書のPDF', 'ダッシュボード', 'メール通知', 'CSVの出力', 'パスワードの再設定',
+            '検索結果', '添付ファイル', 'Webhook', 'API トークン', 'モバイル版', '管理画面']
+PROBLEMS = ['が表示されない', 'でエラーが出る', 'が遅い', 'ができない', 'の文字化け', 'が二重に届く',
+            'が500を返す', 'の並び順がおかしい', 'がタイムアウトする', 'の権限が効かない']
+
+
+def make_titles(count, rng):
+    return [f"{rng.choice(SUBJECTS)}{rng.choice(PROBLEMS)} ({rng.randrange(10000)})" for _ in range(count)]
+
+
+def bigrams(text):
+    text = normalize(text)
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def naive_similar(titles, query, limit=5, min_similarity=0.25):
+    query_grams = bigrams(query)
+    scores = []
+    for ticket_id, title in enumerate(titles):
+        grams = bigrams(title)
+        similarity = len(grams & query_grams) / len(grams | query_grams) if grams else 0
+        if similarity >= min_similarity:
+            scores.append((similarity, ticket_id))
+    return sorted(scores, reverse=True)[:limit]
+
+
+def measure(label, run, queries):
+    started = time.perf_counter()
+    for query in queries:
+        run(query)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<8} {elapsed / len(queries) * 1e3:8.2f} ms/query")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tickets', type=int, default=100_000)
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    titles = make_titles(args.tickets, rng)
+    queries = make_titles(args.queries, rng)
+
+    started = time.perf_counter()
+    index = TitleIndex()
+    index.add_many(enumerate(titles))
+    print(f"build    {time.perf_counter() - started:8.2f} s ({args.tickets} tickets)")
+
+    measure('naive', lambda query: naive_similar(titles, query), queries[:max(1, len(queries) // 20)])
+    measure('index', index.similar, queries)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# benchmarks/statement_cache_bench.py
+"""ダッシュボードの1リクエスト分のクエリで、文の組み立てにかかるPythonの処理時間を比較する。
+
+従来の経路はリクエストのたびに SELECT 文を組み立て (値をSQLの式に埋め込む)、SQLAlchemy が
+そのたびにキャッシュキーを計算してからコンパイル済みSQLのキャッシュを引く。現在の経路は
+bindparam を使った文を一度だけ組み立てて使い回す (キャッシュキーは文のオブジェクトに記憶される)。
+
+SQLの実行時間が目立たないよう、少ない行数のSQLiteでユーザーの読み込み・担当者の選択肢・
+一覧・チケットの取得を繰り返し、1リクエストあたりの時間とキャッシュのヒット率を表示する。
+
+    python benchmarks/statement_cache_bench.py --requests 5000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import insert, select  # noqa: E402
+from sqlalchemy.orm import aliased, joinedload  # noqa: E402
+
+from app import (app, db, User, Ticket, Organization, Role, TICKET_SORT_COLUMNS, TICKET_STATUSES,  # noqa: E402
+                 build_organization_users_query, build_ticket_list_query, compiled_cache_stats,
+                 find_organization_ticket, load_user)
+
+
+def seed(ticket_count=20, user_count=5):
+    role = Role(name='admin')
+    org = Organization(name='BenchOrg')
+    users = [User(username=f'user{i}', password_hash='x', organization=org, role=role) for i in range(user_count)]
+    db.session.add_all([role, org] + users)
+    db.session.flush()
+    db.session.execute(insert(Ticket), [
+        {'title': f'Ticket {i}', 'status': TICKET_STATUSES[i % 5], 'priority': i % 3 + 1,
+         'organization_id': org.id, 'requester_id': users[i % user_count].id}
+        for i in range(ticket_count)
+    ])
+    db.session.commit()
+    return org.id, users[0].id
+
+
+def requests_before(organization_id, user_id, ticket_id):
+    """従来の経路: 文を毎回組み立てる"""
+    db.session.get(User, user_id, options=[joinedload(User.organization), joinedload(User.role)])
+    db.session.execute(select(User.id, User.username).where(User.organization_id == organization_id)).all()
+    requester, assignee = aliased(User, name='requester'), aliased(User, name='assignee')
+    db.session.execute(
+        select(Ticket.id, Ticket.title, Ticket.status, Ticket.priority, Ticket.due_date, Ticket.created_at,
+               Ticket.version, Ticket.assignee_id, requester.username.label('requester_name'),
+               assignee.username.label('assignee_name'))
+        .join(requester, Ticket.requester_id == requester.id)
+        .outerjoin(assignee, Ticket.assignee_id == assignee.id)
+        .where(Ticket.organization_id == organization_id, Ticket.status == '新規',
+               Ticket.title.ilike('%Ticket%'))
+        .order_by(TICKET_SORT_COLUMNS['priority'].desc())
+    ).all()
+    Ticket.query.filter_by(id=ticket_id, organization_id=organization_id).first()
+
+
+def requests_after(organization_id, user_id, ticket_id):
+    """現在の経路: 一度だけ組み立てた文を使い回す"""
+    load_user(f'{organization_id}:{user_id}')
+    db.session.execute(*build_organization_users_query(organization_id)).all()
+    db.session.execute(*build_ticket_list_query(organization_id, filter_status='新規', search_term='Ticket',
+                                                sort_by='priority')).all()
+    find_organization_ticket(ticket_id, organization_id)
+
+
+def measure(label, run, args, count):
+    run(*args)  # コンパイル済みSQLのキャッシュを温める
+    compiled_cache_stats.reset()
+    started = time.perf_counter()
+    for _ in range(count):
+        run(*args)
+        db.session.expunge_all()
+    elapsed = time.perf_counter() - started
+    stats = compiled_cache_stats.snapshot()
+    print(f"{label:<10} {elapsed / count * 1e6:8.1f} µs/request   "
+          f"hits {stats.get('cache_hit', 0):>7}   misses {stats.get('cache_miss', 0):>4}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+        organization_id, user_id = seed()
+        ticket_id = db.session.scalar(select(Ticket.id).limit(1))
+        with app.test_request_context('/'):
+            for label, run in [('before', requests_before), ('after', requests_after)]:
+                measure(label, run, (organization_id, user_id, ticket_id), args.requests)
+
+
+if __name__ == '__main__':
+    main()
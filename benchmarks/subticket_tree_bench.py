@@ -0,0 +1,130 @@
+# benchmarks/subticket_tree_bench.py
+"""入れ子のサブチケットの木と完了率の取得を、再帰CTE (現在) と1階層ずつの読み込み (N+1) で比較する。
+
+深い木 (1本の鎖) と広い木 (各ノードが fanout 個の子を持つ) を作り、
+load_subticket_tree (木と完了率でクエリ2回) と、ノードごとに子を問い合わせて
+完了率を再帰で集計する素朴な実装の時間とクエリ数を表示する。
+
+    python benchmarks/subticket_tree_bench.py --depth 200 --fanout 8 --levels 4
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import event, insert, select  # noqa: E402
+
+from app import app, db, User, Ticket, SubTicket, Organization, Role, load_subticket_tree  # noqa: E402
+
+
+def create_ticket(title, user):
+    ticket = Ticket(title=title, requester_id=user.id, organization_id=user.organization_id)
+    db.session.add(ticket)
+    db.session.flush()
+    return ticket.id
+
+
+def insert_level(ticket_id, parent_ids, per_parent, start):
+    """parent_ids の各ノードに per_parent 個の子を追加し、追加したIDを返す"""
+    rows = [{'title': f'node {start + i}', 'ticket_id': ticket_id, 'parent_id': parent_id,
+             'completed': (start + i) % 3 == 0, 'position': start + i}
+            for i, parent_id in enumerate(parent_id for parent_id in parent_ids for _ in range(per_parent))]
+    return list(db.session.scalars(insert(SubTicket).returning(SubTicket.id, sort_by_parameter_order=True), rows))
+
+
+def seed_deep(user, depth):
+    ticket_id = create_ticket('Deep', user)
+    parent_ids = [None]
+    for level in range(depth):
+        parent_ids = insert_level(ticket_id, parent_ids, 1, level)
+    return ticket_id
+
+
+def seed_wide(user, fanout, levels):
+    ticket_id = create_ticket('Wide', user)
+    parent_ids, created = [None], 0
+    for _ in range(levels):
+        parent_ids = insert_level(ticket_id, parent_ids, fanout, created)
+        created += len(parent_ids)
+    return ticket_id, created
+
+
+def load_naive(ticket_id):
+    """1階層ずつ子を問い合わせ、末端から完了率を集計する (ノード数だけクエリが走る)"""
+    def visit(parent_id, depth, nodes):
+        children = db.session.execute(
+            select(SubTicket.id, SubTicket.title, SubTicket.completed)
+            .where(SubTicket.ticket_id == ticket_id,
+                   SubTicket.parent_id.is_(None) if parent_id is None else SubTicket.parent_id == parent_id)
+            .order_by(SubTicket.position, SubTicket.id)
+        ).all()
+        leaves = completed = 0
+        for child in children:
+            index = len(nodes)
+            nodes.append(None)
+            child_leaves, child_completed = visit(child.id, depth + 1, nodes)
+            if child_leaves == 0:
+                child_leaves, child_completed = 1, int(child.completed)
+            nodes[index] = (child.id, depth, child_leaves, child_completed)
+            leaves += child_leaves
+            completed += child_completed
+        return leaves, completed
+
+    nodes = []
+    total = visit(None, 0, nodes)
+    return nodes, total
+
+
+def measure(label, load, ticket_id, repeat):
+    statements = []
+    record = lambda conn, cursor, statement, *args: statements.append(statement)  # noqa: E731
+    timings = []
+    for _ in range(repeat):
+        statements.clear()
+        event.listen(db.engine, 'before_cursor_execute', record)
+        started = time.perf_counter()
+        nodes, _ = load(ticket_id)
+        timings.append((time.perf_counter() - started) * 1000)
+        event.remove(db.engine, 'before_cursor_execute', record)
+    print(f"  {label:<22} {statistics.median(timings):10.1f} ms   {len(statements):>7} queries   {len(nodes):>7} nodes")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--depth', type=int, default=200, help="深い木の階層数")
+    parser.add_argument('--fanout', type=int, default=8, help="広い木の各ノードの子の数")
+    parser.add_argument('--levels', type=int, default=4, help="広い木の階層数")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+        role = Role(name='admin')
+        org = Organization(name='BenchOrg')
+        user = User(username='owner', password_hash='x', organization=org, role=role)
+        db.session.add_all([role, org, user])
+        db.session.flush()
+        deep_id = seed_deep(user, args.depth)
+        wide_id, wide_nodes = seed_wide(user, args.fanout, args.levels)
+        db.session.commit()
+
+        # 読み込むたびに同じ結果になることを確かめてから計測する
+        assert load_subticket_tree(deep_id)[1] == tuple(reversed(load_naive(deep_id)[1]))
+        assert load_subticket_tree(wide_id)[1] == tuple(reversed(load_naive(wide_id)[1]))
+
+        for label, ticket_id in ((f'deep (depth {args.depth})', deep_id),
+                                 (f'wide ({args.fanout}^{args.levels}, {wide_nodes} nodes)', wide_id)):
+            print(label)
+            measure('recursive CTE', load_subticket_tree, ticket_id, args.repeat)
+            measure('per-level (N+1)', load_naive, ticket_id, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+# benchmarks/worker_memory.py
+"""gunicornのマスターとワーカーごとのメモリ (RSS / PSS / 共有 / 専有) を表示する。
+
+/proc/<pid>/smaps_rollup を読むためLinux専用。PSS (共有ページをプロセス数で按分した値) の
+合計がコンテナ全体の実際の使用量の目安になる。
+
+    python benchmarks/worker_memory.py --pid <マスターのPID>         # 起動中のサーバーを測る
+    python benchmarks/worker_memory.py --workers 4 --requests 200    # preloadあり・なしで起動して比べる
+
+比較モードでは、SQLiteの一時データベースに対して `gunicorn -c gunicorn_config.py` (preload + gc.freeze)
+と、設定なしの `gunicorn app:app` (ワーカーごとにアプリを読み込む) を順に起動し、
+各ワーカーにリクエストを送ってから測る。
+"""
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+FIELDS = ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty')
+
+
+def read_memory(pid):
+    """プロセスのメモリ (KiB) を {'rss', 'pss', 'shared', 'private'} で返す"""
+    values = dict.fromkeys(FIELDS, 0)
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            name, _, rest = line.partition(':')
+            if name in values:
+                values[name] = int(rest.split()[0])
+    return {
+        'rss': values['Rss'],
+        'pss': values['Pss'],
+        'shared': values['Shared_Clean'] + values['Shared_Dirty'],
+        'private': values['Private_Clean'] + values['Private_Dirty'],
+    }
+
+
+def child_pids(pid):
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # comm に空白や括弧が含まれても崩れないよう、最後の ')' 以降を分割する
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(entry))
+    return sorted(children)
+
+
+def report(label, master_pid):
+    workers = child_pids(master_pid)
+    print(f"{label}")
+    print(f"  {'process':<16}{'RSS':>10}{'PSS':>10}{'shared':>10}{'private':>10}   (MiB)")
+    totals = dict.fromkeys(('rss', 'pss', 'shared', 'private'), 0)
+    for name, pid in [('master', master_pid)] + [(f'worker {pid}', pid) for pid in workers]:
+        memory = read_memory(pid)
+        for key in totals:
+            totals[key] += memory[key]
+        print(f"  {name:<16}" + ''.join(f"{memory[key] / 1024:10.1f}" for key in ('rss', 'pss', 'shared', 'private')))
+    print(f"  {'total':<16}" + ''.join(f"{totals[key] / 1024:10.1f}" for key in ('rss', 'pss', 'shared', 'private')))
+    if workers:
+        worker_pss = sum(read_memory(pid)['pss'] for pid in workers) / len(workers)
+        print(f"  PSS per worker: {worker_pss / 1024:.1f} MiB")
+    return totals
+
+
+def prepare_database(path):
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{path}')
+    subprocess.run([sys.executable, '-c', 'from app import app, db\nwith app.app_context(): db.create_all()'],
+                   cwd=ROOT, env=env, check=True)
+
+
+def wait_for_workers(process, url, workers, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("gunicornが終了しました")
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            if len(child_pids(process.pid)) >= workers:
+                return
+        except OSError:
+            # 読み込み中のワーカーは応答が遅いので、接続の失敗もタイムアウトも待って再試行する
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("gunicornのワーカーが起動しませんでした")
+
+
+def measure_mode(label, args, extra_args, db_path, port):
+    # メモリの計測だけのため、ログイン試行の制限をワーカーごとに持ったまま複数ワーカーで起動する
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{db_path}', WEB_CONCURRENCY=str(args.workers),
+               GUNICORN_BIND=f'127.0.0.1:{port}', ASSET_OUTPUT_DIR=tempfile.mkdtemp(),
+               GUNICORN_ALLOW_PER_WORKER_STATE='1')
+    command = ['gunicorn', *extra_args, '--workers', str(args.workers), '--bind', f'127.0.0.1:{port}',
+               '--log-level', 'warning', 'app:app']
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+    try:
+        url = f'http://127.0.0.1:{port}/login'
+        wait_for_workers(process, url, args.workers)
+        for _ in range(args.requests):
+            urllib.request.urlopen(url, timeout=30).read()
+        time.sleep(0.5)
+        return report(label, process.pid)
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pid', type=int, help="起動中のgunicornのマスターのPID (指定すると比較せずに測るだけ)")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=200, help="測る前に送るリクエスト数")
+    parser.add_argument('--port', type=int, default=5099)
+    args = parser.parse_args()
+
+    if args.pid:
+        report(f"gunicorn (master {args.pid})", args.pid)
+        return
+
+    db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    prepare_database(db_path)
+    print(f"workers: {args.workers}, requests: {args.requests}\n")
+    preloaded = measure_mode('preload + gc.freeze (gunicorn_config.py)', args, ['-c', 'gunicorn_config.py'],
+                             db_path, args.port)
+    print()
+    separate = measure_mode('no preload (gunicorn app:app)', args, [], db_path, args.port + 1)
+    print(f"\ntotal PSS: {preloaded['pss'] / 1024:.1f} MiB vs {separate['pss'] / 1024:.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# caches.py
+"""ログインとサインアップで毎回引いていた、ほとんど変わらない値のプロセス内キャッシュ。
+
+- OrganizationNameCache: 組織名 → 組織ID。組織名は変更されないため期限を持たず、
+  存在する組織だけを件数の上限付きで保持する (存在しない名前はキャッシュしない)。
+- RoleCache: ロール名 → ロールID。ロールは init-db で作成した後は変わらないため、
+  最初の参照時に一度だけ読み込む。
+
+どちらも loader は値をデータベースから読む関数で、組織の削除やロールの作成など
+前提が崩れる操作の後は invalidate() を呼ぶ。
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class OrganizationNameCache:
+    """組織名から組織IDを引く (LRU)"""
+
+    def __init__(self, loader, max_size=10000):
+        self.loader = loader
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_cached(self, name):
+        with self._lock:
+            organization_id = self._cache.get(name)
+            if organization_id is not None:
+                self._cache.move_to_end(name)
+            return organization_id
+
+    def lookup(self, name):
+        """キャッシュになければ読み込む。組織が存在しなければ None"""
+        organization_id = self.get_cached(name)
+        if organization_id is None:
+            organization_id = self.loader(name)
+            if organization_id is not None:
+                self.store(name, organization_id)
+        return organization_id
+
+    def store(self, name, organization_id):
+        with self._lock:
+            self._cache[name] = organization_id
+            self._cache.move_to_end(name)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def invalidate(self, name=None):
+        with self._lock:
+            if name is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(name, None)
+
+
+class RoleCache:
+    """ロール名からロールIDを引く"""
+
+    def __init__(self, loader):
+        self.loader = loader
+        self._roles = None
+        self._lock = threading.Lock()
+
+    def id_for(self, name):
+        roles = self._roles
+        if roles is None:
+            with self._lock:
+                if self._roles is None:
+                    self._roles = dict(self.loader())
+                roles = self._roles
+        return roles.get(name)
+
+    def invalidate(self):
+        with self._lock:
+            self._roles = None
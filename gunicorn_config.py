@@ -0,0 +1,76 @@
+# gunicorn_config.py
+"""本番用のgunicornの設定 (gunicorn -c gunicorn_config.py app:app)。
+
+マスタープロセスでアプリを読み込んでからワーカーをforkし (preload_app)、Flask・SQLAlchemy・
+モデル・テンプレートなどのメモリをワーカー間でコピーオンライトのまま共有する。
+- 読み込みの間はGCを止め、解放されたオブジェクトの穴をページに作らない。
+- fork直前に gc.freeze() で既存のオブジェクトをGCの対象から外す。ワーカーのGCが
+  共有ページ上のオブジェクトのGC用の情報を書き換え、ページがコピーされるのを防ぐ。
+- データベースの接続はプロセス間で共有できないため、fork前にマスターの接続を閉じ、
+  fork後のワーカーでは親の接続に触れずに接続プールを作り直す。
+
+環境変数:
+    GUNICORN_BIND       待ち受けるアドレス (既定 0.0.0.0:5001)
+    WEB_CONCURRENCY     ワーカー数 (既定 1)
+    GUNICORN_THREADS    ワーカーごとのスレッド数 (既定 8)
+    GUNICORN_ALLOW_PER_WORKER_STATE
+                        1 なら、ログイン試行の制限がワーカーのメモリにあっても複数ワーカーで起動する
+
+ログイン試行の制限・自動割り当ての順番・似ているチケットの索引・ダッシュボードの古い一覧と
+サーキットブレーカーは、ワーカーのメモリに持つ。ワーカーを増やすとログイン試行の制限は
+ワーカー数の分だけ緩くなるため、既定は1ワーカー・複数スレッドにし、2以上にする場合は
+LOGIN_THROTTLE_STORAGE_URL に Redis を指定しないと起動しない。
+"""
+
+import gc
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5001')
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+preload_app = True
+accesslog = '-'
+errorlog = '-'
+
+# この設定はアプリより先に読み込まれる。アプリの読み込み (preload) が終わるまでGCを止める
+gc.disable()
+
+
+def check_shared_state(workers, environ=os.environ):
+    """ワーカーが2以上なのに、ログイン試行の制限をワーカー間で共有していなければ例外を送出する"""
+    storage_url = environ.get('LOGIN_THROTTLE_STORAGE_URL') or ''
+    if workers <= 1 or storage_url.startswith(('redis://', 'rediss://', 'unix://')):
+        return
+    if environ.get('GUNICORN_ALLOW_PER_WORKER_STATE') == '1':
+        return
+    raise RuntimeError(
+        f"ワーカー数が{workers}ですが、ログイン試行の制限がワーカーのメモリにあります (許可される試行回数が"
+        f"ワーカー数倍になります)。LOGIN_THROTTLE_STORAGE_URL=redis://... を指定するか、WEB_CONCURRENCY=1 で"
+        "起動してください。")
+
+
+def on_starting(server):
+    """マスターの起動時 (アプリの読み込み前) に呼ばれる。--workers で指定した数も server.cfg に入る"""
+    check_shared_state(server.cfg.workers)
+
+
+def when_ready(server):
+    """アプリを読み込んだマスターで、最初のワーカーをforkする前に呼ばれる"""
+    from app import reset_connection_pools
+
+    # 読み込み中に開いた接続をワーカーに引き継がない
+    reset_connection_pools(close=True)
+    gc.freeze()
+    gc.enable()
+
+
+def pre_fork(server, worker):
+    # ワーカーの再起動に備え、その後マスターで作られたオブジェクトも対象から外す
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from app import reset_connection_pools
+
+    reset_connection_pools(close=False)
+    gc.enable()
@@ -0,0 +1,449 @@
+# online_migrations.py
+"""大きなテーブルのスキーマを、長い排他ロックを取らずに変更するためのマイグレーション用のヘルパー。
+
+migrations/versions のマイグレーションから次の順に使う。
+
+    import online_migrations as online
+
+    def upgrade():
+        online.add_column('users', sa.Column('timezone', sa.String(64), nullable=True))
+        online.backfill('users', 'timezone', sa.literal('Asia/Tokyo'))
+        online.set_not_null('users', 'timezone')
+        online.create_index('ix_users_timezone', 'users', ['timezone'])
+
+- add_column: NULL可の列を追加する (テーブルを書き換えないため、ACCESS EXCLUSIVE は一瞬で済む)。
+- backfill: 主キーの順に batch_size 行ずつ、チャンクごとにコミットしながら値を埋める。
+  進捗を online_migration_progress に記録し、中断しても次回は続きから再開する。
+- set_not_null / add_foreign_key: NOT VALID の制約を追加してから検証する。検証中も読み書きは止めない
+  (PostgreSQL 12以降の SET NOT NULL は、検証済みのCHECK制約があればテーブルを読み直さない)。
+- create_index / drop_index: CREATE / DROP INDEX CONCURRENTLY (書き込みを止めない)。
+- DDLはロックを待つ間も後続のクエリを待たせるため、lock_timeout (MIGRATION_LOCK_TIMEOUT、既定5秒) を
+  付けて実行する。タイムアウトした場合はマイグレーションを再実行する (各手順は再実行できる)。
+
+チャンクごとのコミットと CONCURRENTLY はトランザクションの外で実行する必要があるため、
+これらのヘルパーはその時点までのマイグレーションをコミットする (Migrate は transaction_per_migration)。
+PostgreSQL以外 (開発用のSQLite) では、同じ結果になる通常のDDLを実行する。
+
+dry_run (flask migration-plan) は、マイグレーションを1つのトランザクションで実行してからロールバックし、
+文ごとの所要時間と取得したロック、そのロックが止める操作を記録する。ヘルパーの手順は実行せず、
+バックフィルは1チャンクだけ試し、インデックスの作成や制約の検証はテーブル全体の読み込み時間から見積もる。
+"""
+
+import math
+import os
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy import event, func, select
+
+LOCK_TIMEOUT = os.environ.get('MIGRATION_LOCK_TIMEOUT', '5s')
+
+# バックフィルの進捗 (完了した行は削除し、空になったらテーブルも削除する)
+progress_table = sa.Table(
+    'online_migration_progress', sa.MetaData(),
+    sa.Column('name', sa.String(255), primary_key=True),
+    sa.Column('last_key', sa.BigInteger, nullable=True),
+    sa.Column('rows_done', sa.BigInteger, nullable=False, default=0),
+    sa.Column('updated_at', sa.DateTime, nullable=False),
+)
+
+# PostgreSQLのテーブルロックのうち、保持している間に読み込み・書き込みを待たせるもの
+BLOCKS_READS = {'AccessExclusiveLock'}
+BLOCKS_WRITES = {'ShareLock', 'ShareRowExclusiveLock', 'ExclusiveLock', 'AccessExclusiveLock'}
+
+# dry_run の1手順。estimated が真の手順は実行しておらず、seconds は見積もり
+PlanStep = namedtuple('PlanStep', ['revision', 'description', 'locks', 'seconds', 'estimated'])
+
+_dry_run = None
+
+
+def blocked_operations(mode):
+    """ロックを保持している間に待たされる操作"""
+    if mode in BLOCKS_READS:
+        return "読み書きを止める"
+    if mode in BLOCKS_WRITES:
+        return "書き込みを止める"
+    return "読み書きは止めない"
+
+
+def _is_postgresql(connection):
+    return connection.dialect.name == 'postgresql'
+
+
+def _quote(connection, name):
+    return connection.dialect.identifier_preparer.quote(name)
+
+
+@contextmanager
+def _lock_timeout(connection):
+    if not _is_postgresql(connection):
+        yield
+        return
+    connection.exec_driver_sql(f"SET lock_timeout = '{LOCK_TIMEOUT}'")
+    try:
+        yield
+    finally:
+        connection.exec_driver_sql("RESET lock_timeout")
+
+
+def estimate_rows(connection, table_name):
+    """テーブルの行数。PostgreSQLでは統計情報の推定値を使う (全件を数えない)"""
+    if _is_postgresql(connection):
+        estimate = connection.scalar(sa.text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:name)"),
+                                     {'name': table_name})
+        if estimate is not None and estimate >= 0:  # ANALYZE 前は -1
+            return estimate
+    return connection.scalar(select(func.count()).select_from(sa.table(table_name)))
+
+
+def add_column(table_name, column):
+    """NULL可の列を追加する。値は backfill で埋め、set_not_null で必須にする"""
+    if not column.nullable:
+        raise ValueError(f"{table_name}.{column.name}: add_column にはNULL可の列を渡してください")
+    connection = op.get_bind()
+    with _lock_timeout(connection):
+        op.add_column(table_name, column)
+
+
+def _save_progress(connection, name, last_key, rows_done):
+    values = {'last_key': last_key, 'rows_done': rows_done, 'updated_at': datetime.utcnow()}
+    if connection.execute(progress_table.update().where(progress_table.c.name == name).values(**values)).rowcount == 0:
+        connection.execute(progress_table.insert().values(name=name, **values))
+
+
+def _chunk_upper_bound(connection, table, key, last_key, batch_size):
+    keys = select(table.c[key]).order_by(table.c[key]).limit(batch_size)
+    if last_key is not None:
+        keys = keys.where(table.c[key] > last_key)
+    return connection.scalar(select(func.max(keys.subquery().c[key])))
+
+
+def _chunk_update(table, key, column_name, value, condition, last_key, upper):
+    bounds = table.c[key] <= upper
+    if last_key is not None:
+        bounds &= table.c[key] > last_key
+    return sa.update(table).where(bounds, condition).values({column_name: value})
+
+
+def backfill(table_name, column_name, value, where=None, key='id', batch_size=1000, pause=0.1, name=None,
+             log=print, log_interval=10.0):
+    """column_name が NULL の行に value (SQL式) を埋める
+
+    主キー key の順に batch_size 行ずつ更新してコミットし、チャンクの間は pause 秒待つ。
+    where (SQL文字列) で対象の行を絞れる。中断した場合は同じ name で呼ぶと続きから再開する。
+    """
+    name = name or f'{table_name}.{column_name}'
+    table = sa.table(table_name, sa.column(key), sa.column(column_name))
+    condition = table.c[column_name].is_(None)
+    if where is not None:
+        condition &= sa.text(where)
+
+    if _dry_run is not None:
+        connection = _dry_run.connection
+        rows = estimate_rows(connection, table_name)
+        upper = _chunk_upper_bound(connection, table, key, None, batch_size)
+        seconds = 0.0 if upper is None else _dry_run.measure(
+            _chunk_update(table, key, column_name, value, condition, None, upper))
+        chunks = math.ceil(rows / batch_size)
+        _dry_run.plan(f"backfill {name}: 約{rows}行を{batch_size}行ずつ ({chunks}回コミット)",
+                      [(table_name, 'RowExclusiveLock')], chunks * (seconds + pause))
+        return
+
+    with op.get_context().autocommit_block():
+        connection = op.get_bind()
+        progress_table.create(connection, checkfirst=True)
+        progress = connection.execute(select(progress_table).where(progress_table.c.name == name)).first()
+        last_key, rows_done = (progress.last_key, progress.rows_done) if progress else (None, 0)
+        if progress is not None:
+            log(f"{name}: 前回の続き ({key} > {last_key}) から再開します。")
+        total = estimate_rows(connection, table_name)
+        started = logged_at = time.monotonic()
+        scanned = 0
+        while True:
+            upper = _chunk_upper_bound(connection, table, key, last_key, batch_size)
+            if upper is None:
+                break
+            rows_done += connection.execute(
+                _chunk_update(table, key, column_name, value, condition, last_key, upper)).rowcount
+            last_key = upper
+            scanned += batch_size
+            _save_progress(connection, name, last_key, rows_done)
+            now = time.monotonic()
+            if now - logged_at >= log_interval:
+                rate = scanned / (now - started)
+                remaining = max(0, total - scanned) / rate if rate else 0
+                log(f"{name}: {key} = {last_key} まで ({rows_done}行を更新、残り約{remaining:.0f}秒)")
+                logged_at = now
+            if pause:
+                time.sleep(pause)
+        connection.execute(progress_table.delete().where(progress_table.c.name == name))
+        if connection.scalar(select(func.count()).select_from(progress_table)) == 0:
+            progress_table.drop(connection)
+        log(f"{name}: {rows_done}行を埋めました ({time.monotonic() - started:.1f}秒)。")
+
+
+def _run_steps(steps, fallback):
+    """PostgreSQLでは (説明, SQL, ロック) の手順をトランザクションの外で1文ずつ実行し、それ以外では fallback を呼ぶ"""
+    if _dry_run is not None:
+        for description, _, locks, seconds in steps(_dry_run.connection):
+            _dry_run.plan(description, locks, seconds)
+        return
+    connection = op.get_bind()
+    if not _is_postgresql(connection):
+        fallback()
+        return
+    with op.get_context().autocommit_block():
+        connection = op.get_bind()
+        with _lock_timeout(connection):
+            for _, statement, _, _ in steps(connection):
+                connection.exec_driver_sql(statement)
+
+
+def _scan_seconds(connection, table_name):
+    """テーブル全体を読む時間 (制約の検証・インデックスの作成の見積もりに使う)"""
+    if _dry_run is None:
+        return None
+    return _dry_run.measure(select(func.count()).select_from(sa.table(table_name)))
+
+
+def set_not_null(table_name, column_name):
+    """列を NOT NULL にする。NULL の行が残っていると失敗するため、先に backfill すること"""
+    def steps(connection):
+        table, column = _quote(connection, table_name), _quote(connection, column_name)
+        constraint = _quote(connection, f'{table_name}_{column_name}_not_null')
+        return [
+            (f"{table_name}: 検証前のCHECK制約を追加",
+             f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {constraint}, "
+             f"ADD CONSTRAINT {constraint} CHECK ({column} IS NOT NULL) NOT VALID",
+             [(table_name, 'AccessExclusiveLock')], 0.0),
+            (f"{table_name}: CHECK制約を検証 (テーブル全体を読む)",
+             f"ALTER TABLE {table} VALIDATE CONSTRAINT {constraint}",
+             [(table_name, 'ShareUpdateExclusiveLock')], _scan_seconds(connection, table_name)),
+            # 同じALTER TABLEで制約を削除すると、SET NOT NULL より先に削除されてテーブル全体を読み直すため分ける
+            (f"{table_name}.{column_name}: SET NOT NULL (検証済みの制約を使う)",
+             f"ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL",
+             [(table_name, 'AccessExclusiveLock')], 0.0),
+            (f"{table_name}: CHECK制約を削除",
+             f"ALTER TABLE {table} DROP CONSTRAINT {constraint}",
+             [(table_name, 'AccessExclusiveLock')], 0.0),
+        ]
+
+    def fallback():
+        with op.batch_alter_table(table_name) as batch_op:
+            batch_op.alter_column(column_name, nullable=False)
+
+    _run_steps(steps, fallback)
+
+
+def add_foreign_key(constraint_name, source_table, referent_table, local_cols, remote_cols, ondelete=None):
+    """外部キーを NOT VALID で追加してから検証する (既存の行の検証中も書き込みを止めない)"""
+    def steps(connection):
+        source, referent = _quote(connection, source_table), _quote(connection, referent_table)
+        constraint = _quote(connection, constraint_name)
+        columns = ', '.join(_quote(connection, column) for column in local_cols)
+        remote = ', '.join(_quote(connection, column) for column in remote_cols)
+        on_delete = f" ON DELETE {ondelete}" if ondelete else ""
+        return [
+            (f"{source_table}: 検証前の外部キーを追加",
+             f"ALTER TABLE {source} DROP CONSTRAINT IF EXISTS {constraint}, "
+             f"ADD CONSTRAINT {constraint} FOREIGN KEY ({columns}) REFERENCES {referent} ({remote}){on_delete} NOT VALID",
+             [(source_table, 'ShareRowExclusiveLock'), (referent_table, 'ShareRowExclusiveLock')], 0.0),
+            (f"{source_table}: 外部キーを検証 (テーブル全体を読む)",
+             f"ALTER TABLE {source} VALIDATE CONSTRAINT {constraint}",
+             [(source_table, 'ShareUpdateExclusiveLock'), (referent_table, 'RowShareLock')],
+             _scan_seconds(connection, source_table)),
+        ]
+
+    def fallback():
+        with op.batch_alter_table(source_table) as batch_op:
+            batch_op.create_foreign_key(constraint_name, referent_table, local_cols, remote_cols, ondelete=ondelete)
+
+    _run_steps(steps, fallback)
+
+
+def create_index(index_name, table_name, columns, **kw):
+    """インデックスを CREATE INDEX CONCURRENTLY で作成する
+
+    中断して無効 (INVALID) のまま残ったインデックスは削除して作り直す。有効なものがあれば何もしない。
+    """
+    if _dry_run is not None:
+        _dry_run.plan(f"{table_name}: CREATE INDEX CONCURRENTLY {index_name} (テーブルを2回読む)",
+                      [(table_name, 'ShareUpdateExclusiveLock')], 2 * _scan_seconds(_dry_run.connection, table_name))
+        return
+    connection = op.get_bind()
+    if not _is_postgresql(connection):
+        op.create_index(index_name, table_name, columns, **kw)
+        return
+    with op.get_context().autocommit_block():
+        connection = op.get_bind()
+        valid = connection.scalar(sa.text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"),
+                                  {'name': index_name})
+        if valid:
+            return
+        with _lock_timeout(connection):
+            if valid is not None:
+                op.drop_index(index_name, table_name=table_name, postgresql_concurrently=True)
+            op.create_index(index_name, table_name, columns, postgresql_concurrently=True, **kw)
+
+
+def drop_index(index_name, table_name):
+    """インデックスを DROP INDEX CONCURRENTLY で削除する (存在しなければ何もしない)"""
+    if _dry_run is not None:
+        _dry_run.plan(f"{table_name}: DROP INDEX CONCURRENTLY {index_name}",
+                      [(table_name, 'ShareUpdateExclusiveLock')], 0.0)
+        return
+    connection = op.get_bind()
+    if not _is_postgresql(connection):
+        op.drop_index(index_name, table_name=table_name)
+        return
+    with op.get_context().autocommit_block():
+        connection = op.get_bind()
+        with _lock_timeout(connection):
+            op.drop_index(index_name, table_name=table_name, postgresql_concurrently=True, if_exists=True)
+
+
+# --- dry run ---
+LOCKS_SQL = """
+SELECT c.relname, l.mode FROM pg_locks l JOIN pg_class c ON c.oid = l.relation
+WHERE l.pid = pg_backend_pid() AND l.granted AND c.relkind IN ('r', 'p')
+  AND c.relnamespace NOT IN ('pg_catalog'::regnamespace, 'information_schema'::regnamespace)
+"""
+
+
+class DryRun:
+    """マイグレーションの文ごとの所要時間と、新たに取得したテーブルロックを記録する (dry_run で使う)
+
+    PostgreSQL以外ではロックは記録しない。
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.steps = []
+        self.revision = None
+        self._seen_locks = set()
+        self._started = None
+        self._paused = False
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self._started = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self._paused or statement.lstrip().upper().startswith(('SET ', 'RESET ', 'PRAGMA ', 'SAVEPOINT ',
+                                                                  'RELEASE ', 'ROLLBACK ')):
+            return
+        seconds = time.perf_counter() - self._started
+        description = ' '.join(statement.split())
+        if len(description) > 100:
+            description = description[:97] + '...'
+        self.steps.append(PlanStep(self.revision, description, self._new_locks(), seconds, False))
+
+    def _new_locks(self):
+        if not _is_postgresql(self.connection):
+            return []
+        self._paused = True
+        try:
+            rows = [tuple(row) for row in self.connection.exec_driver_sql(LOCKS_SQL)]
+        finally:
+            self._paused = False
+        new = [row for row in rows if row not in self._seen_locks]
+        self._seen_locks.update(new)
+        return new
+
+    def measure(self, statement):
+        """statement をセーブポイントの中で実行してロールバックし、所要時間を返す"""
+        self._paused = True
+        try:
+            savepoint = self.connection.begin_nested()
+            started = time.perf_counter()
+            try:
+                self.connection.execute(statement)
+                return time.perf_counter() - started
+            finally:
+                savepoint.rollback()
+        finally:
+            self._paused = False
+
+    def plan(self, description, locks, seconds):
+        """実行しないヘルパーの手順を記録する (別のトランザクションで実行される)"""
+        self.steps.append(PlanStep(self.revision, description, list(locks), seconds, True))
+
+    def lock_holds(self):
+        """(リビジョン, テーブル, モード, 保持する秒数) の一覧
+
+        1つのトランザクションで取得したロックはコミットまで保持されるため、取得した文から
+        ヘルパーの手順 (その前にコミットする) またはリビジョンの終わりまでの時間を合計する。
+        """
+        holds, held = [], {}
+
+        def release():
+            holds.extend((revision, table, mode, seconds) for (revision, table, mode), seconds in held.items())
+            held.clear()
+
+        previous_revision = None
+        for step in self.steps:
+            if step.revision != previous_revision:
+                release()
+                previous_revision = step.revision
+            if step.estimated:
+                release()
+                holds.extend((step.revision, table, mode, step.seconds) for table, mode in step.locks)
+                continue
+            for table, mode in step.locks:
+                held.setdefault((step.revision, table, mode), 0.0)
+            for lock in held:
+                held[lock] += step.seconds
+        release()
+        return holds
+
+    def report_lines(self):
+        lines, revision = [], object()
+        for step in self.steps:
+            if step.revision != revision:
+                revision = step.revision
+                lines.append(f"[{revision}]")
+            seconds = f"~{step.seconds:.2f}s" if step.estimated else f"{step.seconds:.3f}s"
+            lines.append(f"  {seconds:>10}  {step.description}")
+            for table, mode in step.locks:
+                lines.append(f"{'':14}{table}: {mode} ({blocked_operations(mode)})")
+        holds = [hold for hold in self.lock_holds() if hold[2] in BLOCKS_WRITES]
+        if holds:
+            lines.append("読み込み・書き込みを止めるロック (保持する時間):")
+            for revision, table, mode, seconds in sorted(holds, key=lambda hold: -hold[3]):
+                lines.append(f"  [{revision}] {table}: {mode} 約{seconds:.2f}秒 ({blocked_operations(mode)})")
+        elif not _is_postgresql(self.connection):
+            lines.append("(ロックはPostgreSQLでのみ記録します)")
+        return lines
+
+
+@contextmanager
+def dry_run(engine):
+    """マイグレーションを試しに実行するための接続 (recorder.connection) を開き、終わったらロールバックする
+
+    この中で実行した文を記録し、ヘルパーは実行せずに見積もりだけを記録する。
+    """
+    global _dry_run
+    with engine.connect() as connection:
+        sqlite = connection.dialect.name == 'sqlite'
+        if sqlite:
+            # pysqlite はDDLの前に暗黙にコミットするため、トランザクションを自分で開始してDDLも戻せるようにする
+            connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        transaction = connection.begin()
+        if sqlite:
+            connection.exec_driver_sql('BEGIN')
+        recorder = DryRun(connection)
+        event.listen(connection, 'before_cursor_execute', recorder._before_execute)
+        event.listen(connection, 'after_cursor_execute', recorder._after_execute)
+        _dry_run = recorder
+        try:
+            yield recorder
+        finally:
+            _dry_run = None
+            event.remove(connection, 'before_cursor_execute', recorder._before_execute)
+            event.remove(connection, 'after_cursor_execute', recorder._after_execute)
+            if sqlite:
+                connection.exec_driver_sql('ROLLBACK')
+            transaction.rollback()
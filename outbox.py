@@ -0,0 +1,313 @@
+# outbox.py
+"""トランザクションアウトボックスに書いたイベントを、購読先へWebhookでまとめて配信する。
+
+チケット・サブチケットの変更と同じコミットで outbox_events に行を書き (app.py)、
+別プロセスのディスパッチャー (flask dispatch-outbox) が配信する。画面のリクエストは
+外部のエンドポイントの応答を待たない。
+
+- 購読先 (webhook_subscriptions) とシャードの組ごとに、配信済みのイベントIDを
+  webhook_cursors に記録する。配信は少なくとも1回 (at-least-once) で、イベントIDは
+  シャードごとに採番されるため、受け取る側は (shard, id) で重複を除くこと。
+- 購読先ごとに未配信のイベントを batch_size 件ずつ1回のPOSTにまとめて送る。
+  HTTP接続は送信先ごとにkeep-aliveでプールし、使い回す。
+- 送信に失敗した購読先は指数バックオフで再試行する。その間、その購読先の後続のイベントは
+  送らない (順序を保つ) が、他の購読先には配信を続ける。
+- IDの採番順とコミット順は一致しないため、コミット前の行を飛ばさないよう、
+  作成から settle 以上経ったイベントだけを配信する。それでも配信位置より前に欠けていたID
+  (settle より長く開いたままのトランザクションの行か、ロールバックされた行) は配信位置と
+  一緒に記録し、以降の実行でコミットされていれば順序を入れ替えて送る。gap_timeout 経っても
+  現れない欠番はロールバックされたものとみなして忘れるため、フラッシュから gap_timeout より
+  長くコミットしないトランザクションのイベントだけは届かない。
+"""
+
+import http.client
+import json
+import random
+import time
+import urllib.parse
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+
+# 購読先・シャードごとの配信の遅れ (outbox-status / 管理者向けのメトリクス)
+SubscriberLag = namedtuple('SubscriberLag', ['subscription_id', 'url', 'shard_key', 'last_event_id', 'pending',
+                                             'oldest_pending_at', 'failures', 'next_attempt_at', 'last_error',
+                                             'last_delivered_at'])
+
+
+class DeliveryError(Exception):
+    """購読先が2xx以外を返した"""
+
+
+class ConnectionPool:
+    """送信先 (scheme, host, port) ごとにHTTP接続をkeep-aliveで使い回す"""
+
+    def __init__(self, timeout=10.0, max_idle_per_host=2):
+        self.timeout = timeout
+        self.max_idle_per_host = max_idle_per_host
+        self.connections_opened = 0
+        self._idle = defaultdict(list)
+
+    def _connect(self, scheme, host, port):
+        self.connections_opened += 1
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def post(self, url, body, headers):
+        """(ステータスコード, 本文) を返す。接続や通信の失敗は OSError / http.client.HTTPException を送出する"""
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        idle = self._idle[key]
+        reused = bool(idle)
+        connection = idle.pop() if reused else self._connect(*key)
+        try:
+            connection.request('POST', path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            if not reused:
+                raise
+            # 待機中に相手が閉じたkeep-aliveの接続だった場合は、別の接続で送り直す
+            return self.post(url, body, headers)
+        if response.will_close or len(idle) >= self.max_idle_per_host:
+            connection.close()
+        else:
+            idle.append(connection)
+        return response.status, data
+
+    def close(self):
+        for connections in self._idle.values():
+            for connection in connections:
+                connection.close()
+        self._idle.clear()
+
+
+def backoff_delay(failures, base=1.0, maximum=300.0, jitter=random.random):
+    """failures 回続けて失敗した後、次に送るまでの秒数 (指数バックオフ。同時に再試行しないよう半分までずらす)"""
+    delay = min(maximum, base * 2 ** (failures - 1))
+    return delay * (0.5 + jitter() / 2)
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+def _dump_gaps(gaps):
+    """欠番を webhook_cursors.pending_gaps に保存する形 ({"ID": 最初に欠けていた日時}) にする"""
+    return {str(event_id): seen_at.isoformat() for event_id, seen_at in sorted(gaps.items())} or None
+
+
+class OutboxDispatcher:
+    """アウトボックスのイベントを購読先へ配信する
+
+    default_engine は購読先と配信位置のテーブルを置くデータベース、shard_engines は
+    {シャードキー: エンジン} (既定のデータベースを含む) で、各シャードの events を読む。
+    """
+
+    def __init__(self, default_engine, shard_engines, events, subscriptions, cursors, pool=None, batch_size=100,
+                 settle=timedelta(seconds=2), gap_timeout=timedelta(minutes=10), backoff=backoff_delay,
+                 clock=datetime.utcnow, log=None):
+        self.default_engine = default_engine
+        self.shard_engines = dict(shard_engines)
+        self.events = events
+        self.subscriptions = subscriptions
+        self.cursors = cursors
+        self.pool = pool or ConnectionPool()
+        self.batch_size = batch_size
+        self.settle = settle
+        self.gap_timeout = gap_timeout
+        self.backoff = backoff
+        self.clock = clock
+        self.log = log or (lambda message: None)
+
+    def _load_state(self, organization_id=None):
+        subscriptions_table = self.subscriptions
+        stmt = select(subscriptions_table).where(subscriptions_table.c.active.is_(True))
+        if organization_id is not None:
+            stmt = stmt.where(subscriptions_table.c.organization_id == organization_id)
+        with self.default_engine.connect() as connection:
+            subscriptions = connection.execute(stmt.order_by(subscriptions_table.c.id)).all()
+            cursors = {(row.subscription_id, row.shard_key): row
+                       for row in connection.execute(select(self.cursors)).all()}
+        return subscriptions, cursors
+
+    def _event_condition(self, subscription, after_id):
+        events = self.events
+        condition = (events.c.organization_id == subscription.organization_id) & (events.c.id > after_id)
+        if subscription.event_types:
+            condition &= events.c.event_type.in_(
+                [name.strip() for name in subscription.event_types.split(',') if name.strip()])
+        return condition
+
+    def _save_cursor(self, subscription_id, shard_key, **values):
+        cursors = self.cursors
+        key = (cursors.c.subscription_id == subscription_id) & (cursors.c.shard_key == shard_key)
+        with self.default_engine.begin() as connection:
+            if connection.execute(cursors.update().where(key).values(**values)).rowcount == 0:
+                connection.execute(cursors.insert().values(subscription_id=subscription_id, shard_key=shard_key,
+                                                           **values))
+
+    def _post(self, subscription, shard_key, rows):
+        body = json.dumps({'subscription_id': subscription.id, 'events': [
+            {'id': row.id, 'shard': shard_key, 'type': row.event_type, 'organization_id': row.organization_id,
+             'aggregate_id': row.aggregate_id, 'created_at': _isoformat(row.created_at), **(row.payload or {})}
+            for row in rows
+        ]}, ensure_ascii=False).encode('utf-8')
+        status, _ = self.pool.post(subscription.url, body, {
+            'Content-Type': 'application/json; charset=utf-8',
+            'User-Agent': 'ticket-outbox-dispatcher',
+        })
+        if not 200 <= status < 300:
+            raise DeliveryError(f"HTTP {status}")
+
+    def _fail(self, subscription, shard_key, failures, error, now, last_event_id):
+        """送信の失敗を記録してバックオフする"""
+        failures += 1
+        retry_at = now + timedelta(seconds=self.backoff(failures))
+        self._save_cursor(subscription.id, shard_key, last_event_id=last_event_id, failures=failures,
+                          next_attempt_at=retry_at, last_error=str(error)[:500])
+        self.log(f"購読先 {subscription.id} ({shard_key}) への配信に失敗しました: {error}"
+                 f" ({failures}回目、{retry_at:%H:%M:%S} に再試行)")
+
+    def _find_gaps(self, connection, after_id, upto_id, now):
+        """(after_id, upto_id] で欠けているID (コミット前の行かロールバックされた行) を返す"""
+        events = self.events
+        # gap_timeout より前に作成された行より小さい欠番は、それより前に採番されたものなのでロールバック済みとみなす
+        start = connection.scalar(
+            select(func.max(events.c.id)).where(events.c.id > after_id, events.c.id <= upto_id,
+                                                events.c.created_at < now - self.gap_timeout)) or after_id
+        present = set(connection.scalars(select(events.c.id).where(events.c.id > start, events.c.id <= upto_id)))
+        return [event_id for event_id in range(start + 1, upto_id + 1) if event_id not in present]
+
+    def _deliver_gaps(self, connection, shard_key, subscription, gaps):
+        """前回まで欠けていたIDのうち、その後コミットされたイベントを送る。
+
+        (送った件数, コミットされていたID) を返す。送信に失敗した場合は例外をそのまま送出する。
+        """
+        events = self.events
+        ids = list(gaps)
+        committed = set(connection.scalars(select(events.c.id).where(events.c.id.in_(ids))))
+        rows = connection.execute(
+            select(events).where(self._event_condition(subscription, 0), events.c.id.in_(ids)).order_by(events.c.id)
+        ).all()
+        for start in range(0, len(rows), self.batch_size):
+            self._post(subscription, shard_key, rows[start:start + self.batch_size])
+        return len(rows), committed
+
+    def _deliver(self, connection, shard_key, subscription, cursor, now):
+        """1つの購読先へ、1つのシャードの未配信のイベントを送る。送った件数を返す"""
+        events = self.events
+        last_event_id = cursor.last_event_id if cursor is not None else 0
+        failures = cursor.failures if cursor is not None else 0
+        # 配信位置より前の欠番 {ID: 最初に欠けていた日時}
+        gaps = {int(event_id): datetime.fromisoformat(seen_at)
+                for event_id, seen_at in ((cursor.pending_gaps or {}).items() if cursor is not None else ())}
+        delivered = 0
+        if gaps:
+            try:
+                delivered, committed = self._deliver_gaps(connection, shard_key, subscription, gaps)
+            except (OSError, http.client.HTTPException, DeliveryError) as error:
+                self._fail(subscription, shard_key, failures, error, now, last_event_id)
+                return 0
+            gaps = {event_id: seen_at for event_id, seen_at in gaps.items()
+                    if event_id not in committed and seen_at > now - self.gap_timeout}
+            self._save_cursor(subscription.id, shard_key, last_event_id=last_event_id, failures=0,
+                              next_attempt_at=None, last_error=None, pending_gaps=_dump_gaps(gaps),
+                              **({'last_delivered_at': now} if delivered else {}))
+            failures = 0
+        # コミット済みとみなせる範囲 (購読しない種類のイベントもこの位置まで読み飛ばす)
+        settled = connection.scalar(
+            select(func.max(events.c.id)).where(events.c.organization_id == subscription.organization_id,
+                                                events.c.id > last_event_id,
+                                                events.c.created_at <= now - self.settle))
+        new_gaps = self._find_gaps(connection, last_event_id, settled, now) if (settled or 0) > last_event_id else []
+        while settled is not None and last_event_id < settled:
+            rows = connection.execute(
+                select(events).where(self._event_condition(subscription, last_event_id), events.c.id <= settled)
+                .order_by(events.c.id).limit(self.batch_size)
+            ).all()
+            if rows:
+                try:
+                    self._post(subscription, shard_key, rows)
+                except (OSError, http.client.HTTPException, DeliveryError) as error:
+                    self._fail(subscription, shard_key, failures, error, now, last_event_id)
+                    return delivered
+                delivered += len(rows)
+            last_event_id = rows[-1].id if len(rows) == self.batch_size else settled
+            gaps.update((event_id, now) for event_id in new_gaps if event_id <= last_event_id)
+            self._save_cursor(subscription.id, shard_key, last_event_id=last_event_id, failures=0,
+                              next_attempt_at=None, last_error=None, pending_gaps=_dump_gaps(gaps),
+                              **({'last_delivered_at': now} if rows else {}))
+            failures = 0
+        return delivered
+
+    def run_once(self):
+        """全購読先・全シャードの未配信のイベントを送り、送った件数を返す"""
+        now = self.clock()
+        subscriptions, cursors = self._load_state()
+        delivered = 0
+        for shard_key, engine in self.shard_engines.items():
+            with engine.connect() as connection:
+                for subscription in subscriptions:
+                    cursor = cursors.get((subscription.id, shard_key))
+                    if cursor is not None and cursor.next_attempt_at is not None and cursor.next_attempt_at > now:
+                        continue  # バックオフ中
+                    delivered += self._deliver(connection, shard_key, subscription, cursor, now)
+        return delivered
+
+    def run(self, poll_interval=1.0, prune_after=None, stop=lambda: False):
+        """stop() が真になるまで配信を続ける。送るものがなければ poll_interval 秒待つ
+
+        prune_after (timedelta) を指定すると、1時間ごとにそれより古いイベントを削除する。
+        """
+        pruned_at = None
+        while not stop():
+            if prune_after is not None and (pruned_at is None or time.monotonic() - pruned_at >= 3600):
+                self.prune(self.clock() - prune_after)
+                pruned_at = time.monotonic()
+            if self.run_once() == 0:
+                time.sleep(poll_interval)
+
+    def lag(self, organization_id=None):
+        """購読先・シャードごとの未配信のイベント数と、最も古い未配信のイベントの作成日時"""
+        subscriptions, cursors = self._load_state(organization_id)
+        result = []
+        for shard_key, engine in self.shard_engines.items():
+            with engine.connect() as connection:
+                for subscription in subscriptions:
+                    cursor = cursors.get((subscription.id, shard_key))
+                    last_event_id = cursor.last_event_id if cursor is not None else 0
+                    pending, oldest = connection.execute(
+                        select(func.count(), func.min(self.events.c.created_at))
+                        .where(self._event_condition(subscription, last_event_id))
+                    ).one()
+                    result.append(SubscriberLag(
+                        subscription.id, subscription.url, shard_key, last_event_id, pending, oldest,
+                        cursor.failures if cursor is not None else 0,
+                        cursor.next_attempt_at if cursor is not None else None,
+                        cursor.last_error if cursor is not None else None,
+                        cursor.last_delivered_at if cursor is not None else None))
+        return result
+
+    def prune(self, before, batch_size=1000):
+        """before より前に作成したイベントを各シャードから batch_size 件ずつ削除し、件数を返す"""
+        events = self.events
+        deleted = 0
+        for shard_key, engine in self.shard_engines.items():
+            while True:
+                with engine.begin() as connection:
+                    ids = select(events.c.id).where(events.c.created_at < before).limit(batch_size)
+                    count = connection.execute(events.delete().where(events.c.id.in_(ids))).rowcount
+                deleted += count
+                if count < batch_size:
+                    break
+        if deleted:
+            self.log(f"{deleted} 件の古いイベントを削除しました。")
+        return deleted
+
+    def close(self):
+        self.pool.close()
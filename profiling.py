@@ -0,0 +1,240 @@
+# profiling.py
+"""本番のリクエストを対象にした、必要なときだけ有効にするプロファイラ。
+
+次のいずれかに当てはまるリクエストについて、処理中のスレッドのスタックを一定間隔で
+サンプリングし、SQLとテンプレート描画のタイムラインと一緒にファイルへ書き出す。
+
+- サンプリング率 (PROFILE_SAMPLE_RATE) に当たったリクエスト
+- 管理者が X-Profile-Request ヘッダーを付けたリクエスト
+- PROFILE_ENDPOINTS に指定したエンドポイント (例: index)
+
+出力は1リクエストにつき2ファイル。`.folded` は flamegraph.pl や speedscope で
+そのまま読める折りたたみスタック形式、`.json` はSQL・描画のタイムラインとメタデータ。
+古いファイルは件数と経過日数の上限で削除する。書き出しと削除は応答を待たせないよう、
+リクエストの後に1本のスレッドで順に行う。
+
+プロファイル対象でないリクエストで行うのは、フラグの確認とContextVarの参照だけである。
+"""
+
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+
+from flask import before_render_template, g, request, template_rendered
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'X-Profile-Request'
+
+# プロファイル中のリクエストの状態 (対象外のリクエストでは None)
+_active_profile = ContextVar('active_profile', default=None)
+
+
+class StackSampler:
+    """別スレッドから対象スレッドのスタックを一定間隔で記録する"""
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples[self.fold(frame)] += 1
+
+    @staticmethod
+    def fold(frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+
+class RequestProfile:
+    """1リクエスト分のサンプルとタイムライン"""
+
+    def __init__(self, trigger, interval):
+        self.trigger = trigger
+        self.started = time.perf_counter()
+        self.timeline = []
+        self.status_code = None
+        self._open = {}
+        self.sampler = StackSampler(threading.get_ident(), interval)
+
+    def offset(self):
+        return round((time.perf_counter() - self.started) * 1000, 3)
+
+    def begin(self, key, kind, detail):
+        self._open[key] = (kind, detail, self.offset())
+
+    def samples_sorted(self):
+        return sorted(self.sampler.samples.items())
+
+    def end(self, key):
+        if key in self._open:
+            kind, detail, start = self._open.pop(key)
+            self.timeline.append({'kind': kind, 'detail': detail, 'start_ms': start,
+                                  'duration_ms': round(self.offset() - start, 3)})
+
+
+class RequestProfiler:
+    """Flaskアプリにプロファイリングのフックを登録する"""
+
+    def __init__(self, app=None, output_dir='profiles', sample_rate=0.0, endpoints=(), interval=0.005,
+                 max_files=200, max_age_days=7, rng=random.random, executor=None):
+        self.output_dir = output_dir
+        self.sample_rate = sample_rate
+        self.endpoints = set(endpoints)
+        self.interval = interval
+        self.max_files = max_files
+        self.max_age_days = max_age_days
+        self.rng = rng
+        # 書き出し・削除は1本のスレッドで投入した順に行う (削除が書き出しと競合しないように)
+        self.executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix='profile-writer')
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self._start)
+        app.after_request(self._record_status)
+        app.teardown_request(self._finish)
+        before_render_template.connect(self._template_started, app, weak=False)
+        template_rendered.connect(self._template_finished, app, weak=False)
+        if not getattr(RequestProfiler, '_sql_listeners_installed', False):
+            # リスナーは全エンジンに一度だけ登録し、プロファイル中かどうかは実行時に判定する
+            event.listen(Engine, 'before_cursor_execute', _sql_started)
+            event.listen(Engine, 'after_cursor_execute', _sql_finished)
+            RequestProfiler._sql_listeners_installed = True
+        app.extensions['request_profiler'] = self
+
+    # --- 対象の判定 ---
+    def trigger_for_request(self):
+        if request.endpoint in self.endpoints:
+            return 'endpoint'
+        if request.headers.get(PROFILE_HEADER) and current_user.is_authenticated and current_user.is_admin():
+            return 'header'
+        if self.sample_rate and self.rng() < self.sample_rate:
+            return 'sample'
+        return None
+
+    # --- リクエストのフック ---
+    def _start(self):
+        if not self.endpoints and not self.sample_rate and PROFILE_HEADER not in request.headers:
+            return None
+        trigger = self.trigger_for_request()
+        if trigger is None:
+            return None
+        profile = RequestProfile(trigger, self.interval)
+        g._request_profile_token = _active_profile.set(profile)
+        profile.sampler.start()
+        return None
+
+    def _record_status(self, response):
+        profile = _active_profile.get()
+        if profile is not None:
+            profile.status_code = response.status_code
+        return response
+
+    def _finish(self, exc):
+        profile = _active_profile.get()
+        if profile is None:
+            return
+        profile.sampler.stop()
+        _active_profile.reset(g.pop('_request_profile_token'))
+        request_info = {'method': request.method, 'path': request.path, 'endpoint': request.endpoint}
+        self.executor.submit(self._write_logged, profile, request_info, exc)
+
+    def _template_started(self, sender, template, context, **extra):
+        profile = _active_profile.get()
+        if profile is not None:
+            profile.begin(('template', template.name), 'render', template.name)
+
+    def _template_finished(self, sender, template, context, **extra):
+        profile = _active_profile.get()
+        if profile is not None:
+            profile.end(('template', template.name))
+
+    # --- 書き出し ---
+    def _write_logged(self, profile, request_info, exc):
+        try:
+            self.write(profile, request_info, exc)
+        except OSError:
+            logger.warning("プロファイルを書き出せませんでした: %s", request_info['path'], exc_info=True)
+
+    def flush(self):
+        """投入済みの書き出しが終わるまで待つ"""
+        self.executor.submit(lambda: None).result()
+
+    def write(self, profile, request_info, exc=None):
+        """プロファイルを書き出す。request_info は method / path / endpoint (リクエストの外で呼ぶため)"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}-{request_info['endpoint'] or 'unknown'}-{uuid.uuid4().hex[:8]}"
+        with open(os.path.join(self.output_dir, f'{name}.folded'), 'w', encoding='utf-8') as f:
+            for stack, count in profile.samples_sorted():
+                f.write(f'{stack} {count}\n')
+        metadata = {
+            **request_info,
+            'trigger': profile.trigger,
+            'status_code': profile.status_code,
+            'error': repr(exc) if exc else None,
+            'duration_ms': profile.offset(),
+            'sample_interval_ms': self.interval * 1000,
+            'samples': sum(profile.sampler.samples.values()),
+            'sql_ms': round(sum(item['duration_ms'] for item in profile.timeline if item['kind'] == 'sql'), 3),
+            'render_ms': round(sum(item['duration_ms'] for item in profile.timeline if item['kind'] == 'render'), 3),
+            'timeline': sorted(profile.timeline, key=lambda item: item['start_ms']),
+        }
+        with open(os.path.join(self.output_dir, f'{name}.json'), 'w', encoding='utf-8') as f:
+            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        self.prune()
+        return name
+
+    def prune(self):
+        """保存件数と保存期間の上限を超えたプロファイルを削除する"""
+        names = sorted({os.path.splitext(filename)[0] for filename in os.listdir(self.output_dir)
+                        if filename.endswith(('.folded', '.json'))}, reverse=True)
+        expires = time.time() - self.max_age_days * 24 * 60 * 60
+        for index, name in enumerate(names):
+            path = os.path.join(self.output_dir, f'{name}.json')
+            expired = os.path.exists(path) and os.path.getmtime(path) < expires
+            if index >= self.max_files or expired:
+                for ext in ('.folded', '.json'):
+                    if os.path.exists(os.path.join(self.output_dir, name + ext)):
+                        os.remove(os.path.join(self.output_dir, name + ext))
+
+
+def _sql_started(conn, cursor, statement, parameters, context, executemany):
+    profile = _active_profile.get()
+    if profile is not None:
+        # パラメータには個人情報が含まれうるため、SQL文だけを記録する
+        profile.begin(('sql', id(cursor)), 'sql', ' '.join(statement.split())[:500])
+
+
+def _sql_finished(conn, cursor, statement, parameters, context, executemany):
+    profile = _active_profile.get()
+    if profile is not None:
+        profile.end(('sql', id(cursor)))
@@ -0,0 +1,207 @@
+# ratelimit.py
+"""ログイン試行のスロットリング (トークンバケット + 段階的ロックアウト)。
+
+パスワードハッシュの検証はCPUを大きく消費するため、クレデンシャルスタッフィングの
+集中アクセスがそのままワーカーの枯渇につながる。ここではDB参照やハッシュ検証の前に、
+IP・ユーザー名+組織・組織の3つのキーでトークンバケットを消費し、超過した試行を拒否する。
+連続して失敗したユーザー名+組織には指数的に伸びるロックアウト期間を設ける。
+
+状態の保存先はプロセス内メモリ (既定) と、複数ワーカーで共有する Redis から選べる。
+Redis を使う場合は `pip install redis` の上で `LOGIN_THROTTLE_STORAGE_URL=redis://...` を指定する。
+"""
+
+import threading
+import time
+from collections import Counter, OrderedDict, namedtuple
+
+try:
+    import redis
+except ImportError:  # Redisは共有バックエンドを使う場合のみ必要
+    redis = None
+
+ThrottleDecision = namedtuple('ThrottleDecision', ['allowed', 'retry_after', 'reason'])
+
+# (バケット容量, 容量分が回復するまでの秒数)
+DEFAULT_LIMITS = {
+    'ip': (30, 60),
+    'user': (10, 300),
+    'org': (100, 60),
+}
+
+
+class MemoryBackend:
+    """プロセス内メモリに状態を保持するバックエンド。キー数はLRUで上限を設ける"""
+
+    def __init__(self, max_keys=100_000):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()   # key -> (tokens, updated_at)
+        self._failures = OrderedDict()  # key -> (count, locked_until, expires_at)
+
+    def _remember(self, store, key, value):
+        store[key] = value
+        store.move_to_end(key)
+        while len(store) > self.max_keys:
+            store.popitem(last=False)
+
+    def consume(self, key, capacity, refill_per_second, now):
+        """トークンを1つ消費する。不足していれば再試行までの秒数を返す"""
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * refill_per_second)
+            if tokens < 1:
+                self._remember(self._buckets, key, (tokens, now))
+                return False, (1 - tokens) / refill_per_second
+            self._remember(self._buckets, key, (tokens - 1, now))
+            return True, 0
+
+    def locked_until(self, key, now):
+        with self._lock:
+            entry = self._failures.get(key)
+            if entry is None or entry[2] <= now:
+                return 0
+            return entry[1]
+
+    def record_failure(self, key, lockout_for, ttl, now):
+        """失敗回数を加算する。lockout_for は回数を受け取りロック秒数を返す関数"""
+        with self._lock:
+            count, _, expires_at = self._failures.get(key, (0, 0, 0))
+            count = count + 1 if expires_at > now else 1
+            locked_until = now + lockout_for(count)
+            self._remember(self._failures, key, (count, locked_until, now + ttl))
+            return count
+
+    def reset_failures(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+            self._failures.clear()
+
+
+class RedisBackend:
+    """複数のgunicornワーカー・コンテナ間で状態を共有するRedisバックエンド"""
+
+    # トークンの補充と消費を1往復・アトミックに行う
+    CONSUME_SCRIPT = """
+        local capacity = tonumber(ARGV[1])
+        local rate = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+        local tokens = tonumber(state[1]) or capacity
+        local updated_at = tonumber(state[2]) or now
+        tokens = math.min(capacity, tokens + (now - updated_at) * rate)
+        local allowed = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+        return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, url, prefix='taskflow:login:'):
+        if redis is None:
+            raise RuntimeError("Redisバックエンドを使うには `pip install redis` が必要です。")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._consume = self.client.register_script(self.CONSUME_SCRIPT)
+
+    def consume(self, key, capacity, refill_per_second, now):
+        allowed, tokens = self._consume(keys=[self.prefix + 'bucket:' + key],
+                                        args=[capacity, refill_per_second, now])
+        if allowed:
+            return True, 0
+        return False, (1 - float(tokens)) / refill_per_second
+
+    def locked_until(self, key, now):
+        value = self.client.hget(self.prefix + 'fail:' + key, 'locked_until')
+        return float(value) if value else 0
+
+    def record_failure(self, key, lockout_for, ttl, now):
+        redis_key = self.prefix + 'fail:' + key
+        count = self.client.hincrby(redis_key, 'count', 1)
+        self.client.hset(redis_key, 'locked_until', now + lockout_for(count))
+        self.client.expire(redis_key, int(ttl))
+        return count
+
+    def reset_failures(self, key):
+        self.client.delete(self.prefix + 'fail:' + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+def create_backend(storage_url=None):
+    """ストレージURLからバックエンドを生成する (未指定またはmemory://ならメモリ)"""
+    if not storage_url or storage_url.startswith('memory://'):
+        return MemoryBackend()
+    if storage_url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBackend(storage_url)
+    raise ValueError(f"未対応のストレージURLです: {storage_url}")
+
+
+class LoginThrottle:
+    """ログイン試行を事前に判定し、失敗に応じて段階的にロックアウトする"""
+
+    def __init__(self, backend=None, limits=None, failure_threshold=3,
+                 base_delay=2, max_delay=900, clock=time.time):
+        self.backend = backend or MemoryBackend()
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        # メトリクスはプロセスごとに集計する
+        self.metrics = Counter()
+
+    @staticmethod
+    def _user_key(username, organization_name):
+        return f"{(organization_name or '').strip()}\x00{(username or '').strip()}"
+
+    def lockout_for(self, failures):
+        """連続失敗回数に応じたロックアウト秒数 (閾値を超えると倍々に伸びる)"""
+        if failures < self.failure_threshold:
+            return 0
+        return min(self.max_delay, self.base_delay * 2 ** (failures - self.failure_threshold))
+
+    def check(self, ip, username, organization_name):
+        """試行を許可するか判定する。DBやハッシュ検証より前に呼び出すこと"""
+        now = self.clock()
+        self.metrics['attempts'] += 1
+        user_key = self._user_key(username, organization_name)
+
+        locked_until = self.backend.locked_until(user_key, now)
+        if locked_until > now:
+            return self._reject('lockout', locked_until - now)
+
+        for scope, key in (('ip', ip or ''), ('user', user_key), ('org', (organization_name or '').strip())):
+            capacity, period = self.limits[scope]
+            allowed, retry_after = self.backend.consume(f'{scope}:{key}', capacity, capacity / period, now)
+            if not allowed:
+                return self._reject(scope, retry_after)
+
+        self.metrics['allowed'] += 1
+        return ThrottleDecision(True, 0, None)
+
+    def _reject(self, reason, retry_after):
+        self.metrics['rejected'] += 1
+        self.metrics[f'rejected_{reason}'] += 1
+        return ThrottleDecision(False, max(1, int(retry_after + 0.999)), reason)
+
+    def record_failure(self, username, organization_name):
+        self.metrics['failures'] += 1
+        self.backend.record_failure(self._user_key(username, organization_name),
+                                    self.lockout_for, ttl=self.max_delay * 2, now=self.clock())
+
+    def record_success(self, username, organization_name):
+        self.metrics['successes'] += 1
+        self.backend.reset_failures(self._user_key(username, organization_name))
+
+    def reset(self):
+        self.backend.clear()
+        self.metrics.clear()
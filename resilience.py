@@ -0,0 +1,211 @@
+# resilience.py
+"""データベースが遅い・応答しないときに、読み取りの画面を表示し続けるための仕組み。
+
+フェイルオーバー中などでDBが応答しないと、リクエストはそれぞれタイムアウトまで待ってから
+失敗し、その間にワーカーのスレッドが積み上がる。ここでは次の2つを提供する。
+
+- CircuitBreaker: 失敗が続いたら一定時間「開」にし、その間はDBに問い合わせずにすぐ
+  CircuitOpen で失敗させる。時間が過ぎたら1件だけ試し (半開)、成功すれば閉じる。
+- StaleCache: キーごとに最後に正常に読めた値を件数の上限付き (LRU) で保持する。読み込みが
+  失敗したとき・回路が開いているときはその値を古い印付きで返し、裏のスレッドで読み直す。
+
+どちらの状態もプロセス内に持ち、ワーカーごとに独立している。
+"""
+
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# value: 読み込んだ値, stale: 最新の読み込みに失敗して保持していた値を返したか, stored_at: 値を読み込んだ時刻
+Served = namedtuple('Served', ['value', 'stale', 'stored_at'])
+
+
+class CircuitOpen(Exception):
+    """回路が開いているため、問い合わせずに失敗させた"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"回路が開いています ({retry_after:.1f}秒後に再試行)")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """連続した失敗の回数で開閉するサーキットブレーカー
+
+    failure_types の例外だけを失敗として数える (クエリの誤りなど、DBの状態と関係ない例外は数えない)。
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, failure_types=(Exception,), clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failure_types = failure_types
+        self.clock = clock
+        self.metrics = Counter()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._opened_at = 0.0
+            self._trial_in_flight = False
+            self.metrics.clear()
+
+    def _current_state(self, now):
+        if self._state == self.OPEN and now - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self._state
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state(self.clock())
+
+    def _acquire(self):
+        """呼び出してよければそのまま戻る。半開のときは試しの1件だけを通す"""
+        with self._lock:
+            now = self.clock()
+            state = self._current_state(now)
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and not self._trial_in_flight:
+                self._state = self.HALF_OPEN
+                self._trial_in_flight = True
+                return
+            self.metrics['rejected'] += 1
+            raise CircuitOpen(max(0.0, self._opened_at + self.reset_timeout - now))
+
+    def _record_success(self):
+        with self._lock:
+            self.metrics['successes'] += 1
+            if self._state != self.CLOSED:
+                self.metrics['closed'] += 1
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def _record_failure(self):
+        with self._lock:
+            self.metrics['failures'] += 1
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.metrics['opened'] += 1
+                self._state = self.OPEN
+                self._opened_at = self.clock()
+
+    def call(self, func, *args, **kwargs):
+        """func を呼ぶ。回路が開いていれば呼ばずに CircuitOpen を送出する"""
+        self._acquire()
+        try:
+            result = func(*args, **kwargs)
+        except self.failure_types:
+            self._record_failure()
+            raise
+        except BaseException:
+            # 失敗として数えない例外でも、半開の試しは終わらせて次の呼び出しに譲る
+            with self._lock:
+                self._trial_in_flight = False
+            raise
+        self._record_success()
+        return result
+
+    def snapshot(self):
+        return {'state': self.state, **self.metrics}
+
+
+class StaleCache:
+    """キーごとの最後に正常に読めた値 (LRUで max_entries 件まで)
+
+    読み直しは executor で実行する。同じキーの読み直しは同時に1つだけにする。
+    """
+
+    def __init__(self, max_entries=256, executor=None, clock=time.time):
+        self.max_entries = max_entries
+        self.executor = executor or ThreadPoolExecutor(max_workers=2, thread_name_prefix='stale-refresh')
+        self.clock = clock
+        self.metrics = Counter()
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, stored_at)
+        self._refreshing = set()
+
+    def get(self, key):
+        """保持している (値, 読み込んだ時刻)。なければ None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, value):
+        stored_at = self.clock()
+        with self._lock:
+            self._entries[key] = (value, stored_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return stored_at
+
+    def reset(self):
+        with self._lock:
+            self._entries.clear()
+            self.metrics.clear()
+
+    def serve(self, key, load, refresh=None, failure_types=(Exception,)):
+        """load() の結果を保持して返す
+
+        load が CircuitOpen か failure_types の例外で失敗したときは、保持している値を
+        stale=True で返し、refresh (省略時は load) を裏で実行して読み直す。
+        保持している値がなければ例外をそのまま送出する。
+        """
+        try:
+            value = load()
+        except (CircuitOpen, *failure_types):
+            entry = self.get(key)
+            with self._lock:
+                self.metrics['stale' if entry is not None else 'unavailable'] += 1
+            if entry is None:
+                raise
+            self.refresh(key, refresh or load)
+            return Served(entry[0], True, entry[1])
+        stored_at = self.put(key, value)
+        with self._lock:
+            self.metrics['fresh'] += 1
+        return Served(value, False, stored_at)
+
+    def refresh(self, key, load):
+        """load を裏で実行し、成功したら値を入れ替える。同じキーを読み直し中なら何もしない"""
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            self.metrics['refreshes'] += 1
+        self.executor.submit(self._refresh, key, load)
+        return True
+
+    def _refresh(self, key, load):
+        try:
+            self.put(key, load())
+        except CircuitOpen:
+            with self._lock:
+                self.metrics['refresh_failures'] += 1
+        except Exception:
+            with self._lock:
+                self.metrics['refresh_failures'] += 1
+            logger.warning("保持している値の読み直しに失敗しました: %r", key, exc_info=True)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def snapshot(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'refreshing': len(self._refreshing), **self.metrics}
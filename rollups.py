@@ -0,0 +1,144 @@
+# rollups.py
+"""組織・担当者・日ごとのチケット数 (作成・解決・期限切れ) の集計。
+
+集計結果は ticket_daily_stats テーブルに保存し、推移のAPIはこのテーブルだけを読む。
+定期ジョブ (flask rollup-stats) が直近の数日分を作り直し、初回やシャード移動後は
+組織の全期間をまとめて作り直す (バックフィル)。どちらもチケットから必要な列だけを
+読み込み、NumPyで一括集計する。
+
+日付はUTCの日付 (created_at / resolved_at がUTCで保存されているため)。
+担当者ごとの集計は、集計した時点の担当者に計上する。
+- created: その日に作成されたチケット数
+- resolved: その日に解決 (解決済み・クローズ) されたチケット数
+- overdue: その日の終わりの時点で未解決かつ期限日を過ぎていたチケット数
+"""
+
+from datetime import date, datetime, time as dt_time, timedelta
+
+import numpy as np
+from sqlalchemy import and_, delete, insert, or_, select
+
+RESOLVED_STATUSES = ('解決済み', 'クローズ')
+# 担当者のいないチケットの assignee_id
+UNASSIGNED = 0
+
+_NEVER = np.iinfo(np.int64).max // 2  # 未解決・期限なしを表す日番号
+
+
+def day_number(value):
+    """date を 1970-01-01 からの日数に変換する"""
+    return (value - date(1970, 1, 1)).days
+
+
+def from_day_number(number):
+    return date(1970, 1, 1) + timedelta(days=int(number))
+
+
+def _to_day_numbers(values):
+    """datetime / date (Noneを含む) の列を日番号の配列に変換する。None は _NEVER"""
+    days = np.array(values, dtype='datetime64[D]')
+    numbers = days.astype(np.int64)
+    numbers[np.isnat(days)] = _NEVER
+    return numbers
+
+
+def aggregate_daily(organization_ids, assignee_ids, created, resolved, due, first_day, last_day):
+    """チケットの列から (組織ID, 担当者ID, 日, 作成数, 解決数, 期限切れ数) の行を作る
+
+    created / resolved / due は datetime または date (Noneを含む) の列。
+    集計対象の期間は first_day から last_day まで (両端を含む)。
+    """
+    if len(organization_ids) == 0:
+        return []
+    first, last = day_number(first_day), day_number(last_day)
+    n_days = last - first + 1
+
+    keys = np.stack([np.asarray(organization_ids, dtype=np.int64),
+                     np.asarray([UNASSIGNED if a is None else a for a in assignee_ids], dtype=np.int64)], axis=1)
+    groups, group_index = np.unique(keys, axis=0, return_inverse=True)
+    group_index = group_index.reshape(-1)
+    created_day = _to_day_numbers(created)
+    resolved_day = _to_day_numbers(resolved)
+    due_day = _to_day_numbers(due)
+
+    created_counts = np.zeros((len(groups), n_days), dtype=np.int64)
+    resolved_counts = np.zeros((len(groups), n_days), dtype=np.int64)
+    for counts, day in ((created_counts, created_day), (resolved_counts, resolved_day)):
+        in_range = (day >= first) & (day <= last)
+        np.add.at(counts, (group_index[in_range], day[in_range] - first), 1)
+
+    # 期限切れの期間 [max(作成日, 期限日+1), 解決日-1] を差分配列で数え、累積和で日ごとの件数にする
+    overdue_start = np.maximum(np.maximum(created_day, np.minimum(due_day, _NEVER - 1) + 1), first)
+    overdue_end = np.minimum(resolved_day - 1, last)
+    valid = (due_day != _NEVER) & (overdue_start <= overdue_end)
+    diff = np.zeros((len(groups), n_days + 1), dtype=np.int64)
+    np.add.at(diff, (group_index[valid], overdue_start[valid] - first), 1)
+    np.add.at(diff, (group_index[valid], overdue_end[valid] - first + 1), -1)
+    overdue_counts = np.cumsum(diff[:, :n_days], axis=1)
+
+    group_rows, day_offsets = np.nonzero(created_counts | resolved_counts | overdue_counts)
+    return [
+        (int(groups[g][0]), int(groups[g][1]), from_day_number(first + d),
+         int(created_counts[g, d]), int(resolved_counts[g, d]), int(overdue_counts[g, d]))
+        for g, d in zip(group_rows, day_offsets)
+    ]
+
+
+def _fetch_ticket_columns(connection, tickets, condition, batch_size=10000):
+    columns = ([], [], [], [], [])
+    stmt = select(tickets.c.organization_id, tickets.c.assignee_id, tickets.c.created_at,
+                  tickets.c.resolved_at, tickets.c.due_date).where(condition)
+    result = connection.execute(stmt, execution_options={'stream_results': True, 'yield_per': batch_size})
+    for partition in result.partitions(batch_size):
+        for row in partition:
+            for values, value in zip(columns, row):
+                values.append(value)
+    return columns
+
+
+def _replace_rows(connection, stats, condition, rows):
+    connection.execute(delete(stats).where(condition))
+    if rows:
+        connection.execute(insert(stats), [
+            {'organization_id': organization_id, 'assignee_id': assignee_id, 'day': day,
+             'created_count': created, 'resolved_count': resolved, 'overdue_count': overdue}
+            for organization_id, assignee_id, day, created, resolved, overdue in rows
+        ])
+    return len(rows)
+
+
+def refresh_window(connection, tickets, stats, first_day, last_day):
+    """全組織の first_day〜last_day の集計を作り直す (定期ジョブ用)。書き込んだ行数を返す"""
+    start = datetime.combine(first_day, dt_time.min)
+    end = datetime.combine(last_day + timedelta(days=1), dt_time.min)
+    # 期間内に作成・解決されたか、期間内に期限切れだった可能性のあるチケットだけを読む
+    condition = and_(
+        tickets.c.created_at < end,
+        or_(tickets.c.resolved_at.is_(None), tickets.c.resolved_at >= start),
+        or_(tickets.c.created_at >= start, tickets.c.resolved_at.is_not(None), tickets.c.due_date < last_day),
+    )
+    rows = aggregate_daily(*_fetch_ticket_columns(connection, tickets, condition), first_day, last_day)
+    return _replace_rows(connection, stats, stats.c.day.between(first_day, last_day), rows)
+
+
+def rebuild_organization(connection, tickets, stats, organization_id, last_day):
+    """組織の全期間の集計を作り直す (バックフィル・シャード移動後)。書き込んだ行数を返す"""
+    columns = _fetch_ticket_columns(connection, tickets, tickets.c.organization_id == organization_id)
+    created = [value for value in columns[2] if value is not None]
+    rows = []
+    if created:
+        rows = aggregate_daily(*columns, min(created).date(), last_day)
+    return _replace_rows(connection, stats, stats.c.organization_id == organization_id, rows)
+
+
+def dense_series(rows, first_day, last_day):
+    """(日, 作成数, 解決数, 期限切れ数) の行を、欠けた日を0で埋めた系列に変換する"""
+    n_days = (last_day - first_day).days + 1
+    series = {name: [0] * n_days for name in ('created', 'resolved', 'overdue')}
+    for day, created, resolved, overdue in rows:
+        offset = (day - first_day).days
+        series['created'][offset] = int(created or 0)
+        series['resolved'][offset] = int(resolved or 0)
+        series['overdue'][offset] = int(overdue or 0)
+    series['days'] = [(first_day + timedelta(days=i)).isoformat() for i in range(n_days)]
+    return series
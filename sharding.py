@@ -0,0 +1,276 @@
+# sharding.py
+"""organization_id によるテナントのシャーディング。
+
+組織・ロール・シャードディレクトリ (organization_shards) は既定のデータベースに置き、
+ユーザーやチケットなどテナントごとのテーブル (`__table_args__` の info に `tenant: True`
+を持つテーブル) は、組織が割り当てられたシャードのデータベースに置く。
+
+リクエストごとのシャードは `use_shard()` で `flask.g` に設定し、`RoutingSession` が
+テナントテーブルへのクエリをそのシャードのエンジンへ振り分ける。シャードを設定しない
+限りすべて既定のデータベースに向くため、シャードを使わない構成では従来通りに動く。
+"""
+
+import time
+from collections import namedtuple
+
+from flask import current_app, g, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import bindparam, create_engine, insert, select, delete, update, Table, inspect
+from sqlalchemy.sql.dml import UpdateBase
+
+DEFAULT_SHARD = 'default'
+
+ShardEntry = namedtuple('ShardEntry', ['shard_key', 'read_only'])
+
+
+def is_tenant_table(table):
+    return bool(table.info.get('tenant'))
+
+
+def is_derived_table(table):
+    """他のテーブルから作り直せる集計テーブル (シャード間ではコピーしない)"""
+    return bool(table.info.get('derived'))
+
+
+def parse_shard_urls(value):
+    """`shard1=postgresql://...,shard2=postgresql://...` 形式の設定を辞書に変換する"""
+    urls = {}
+    for item in (value or '').split(','):
+        if item.strip():
+            key, _, url = item.partition('=')
+            urls[key.strip()] = url.strip()
+    return urls
+
+
+class ShardMap:
+    """シャードキーからデータベースエンジンを引く。エンジンは初回利用時に作成する"""
+
+    def __init__(self, urls=None, engine_options=None):
+        self.urls = dict(urls or {})
+        self.engine_options = engine_options or {'pool_pre_ping': True}
+        self._engines = {}
+
+    def add_shard(self, key, url):
+        self.urls[key] = url
+        self._engines.pop(key, None)
+
+    def keys(self):
+        return [DEFAULT_SHARD] + sorted(self.urls)
+
+    def engine(self, key):
+        if key not in self._engines:
+            if key not in self.urls:
+                raise KeyError(f"未定義のシャードです: {key}")
+            self._engines[key] = create_engine(self.urls[key], **self.engine_options)
+        return self._engines[key]
+
+    def dispose(self):
+        for engine in self._engines.values():
+            engine.dispose()
+        self._engines.clear()
+
+    def reset_pools(self, close=True):
+        """エンジンは残したまま接続プールを作り直す
+
+        fork後の子プロセスでは close=False とし、親プロセスの接続を閉じずに手放す。
+        """
+        for engine in self._engines.values():
+            engine.dispose(close=close)
+
+
+class ShardDirectory:
+    """組織 → シャードの対応をプロセス内にTTL付きでキャッシュする
+
+    loader は組織IDを受け取り ShardEntry を返す関数。切り替え時は各ワーカーの
+    キャッシュがTTL以内に更新されることを前提に、移行コマンドがTTL分待機する。
+    """
+
+    def __init__(self, loader, ttl=5.0, clock=time.monotonic):
+        self.loader = loader
+        self.ttl = ttl
+        self.clock = clock
+        self._cache = {}
+
+    def get_cached(self, organization_id):
+        entry = self._cache.get(organization_id)
+        if entry and entry[1] > self.clock():
+            return entry[0]
+        return None
+
+    def store(self, organization_id, entry):
+        self._cache[organization_id] = (entry, self.clock() + self.ttl)
+
+    def lookup(self, organization_id):
+        entry = self.get_cached(organization_id)
+        if entry is None:
+            entry = self.loader(organization_id)
+            self.store(organization_id, entry)
+        return entry
+
+    def invalidate(self, organization_id=None):
+        if organization_id is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(organization_id, None)
+
+
+def use_shard(shard_key):
+    """現在のリクエスト (アプリケーションコンテキスト) で使うシャードを設定する"""
+    g.shard_key = shard_key or DEFAULT_SHARD
+
+
+def current_shard():
+    if has_app_context():
+        return g.get('shard_key', DEFAULT_SHARD)
+    return DEFAULT_SHARD
+
+
+def _statement_table(mapper, clause):
+    if mapper is not None:
+        return inspect(mapper).local_table
+    if isinstance(clause, Table):
+        return clause
+    if isinstance(clause, UpdateBase) and isinstance(clause.table, Table):
+        return clause.table
+    return None
+
+
+class RoutingSession(Session):
+    """テナントテーブルへのクエリを現在のシャードのエンジンへ振り分けるセッション"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            shard_key = current_shard()
+            if shard_key != DEFAULT_SHARD:
+                table = _statement_table(mapper, clause)
+                if table is not None and is_tenant_table(table):
+                    return current_app.extensions['shard_map'].engine(shard_key)
+            # セッション自体が接続に束縛されている場合 (外部トランザクションに参加するテストなど)
+            if self.bind is not None:
+                return self.bind
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+# --- シャード間のデータ移動 ---
+def tenant_tables(metadata):
+    """テナントテーブルを外部キーの依存順に返す"""
+    return [table for table in metadata.sorted_tables if is_tenant_table(table)]
+
+
+def org_scope(table, organization_id):
+    """テーブルの行のうち、指定した組織に属するものを表すWHERE句を返す
+
+    organization_id 列を持たないテーブルは、外部キーで親のテナントテーブルをたどる。
+    """
+    if 'organization_id' in table.c:
+        return table.c.organization_id == organization_id
+    for fk in table.foreign_keys:
+        parent = fk.column.table
+        if parent is not table and is_tenant_table(parent):
+            return fk.parent.in_(select(fk.column).where(org_scope(parent, organization_id)))
+    raise ValueError(f"{table.name} を組織に紐づける列がありません")
+
+
+def _single_pk(table):
+    pk = list(table.primary_key.columns)
+    return pk[0] if len(pk) == 1 else None
+
+
+def copy_global_rows(source, target, metadata, organization_id):
+    """組織とロールの行を移行先に用意する (テナントテーブルの外部キー参照先)"""
+    for table_name, row_id in (('roles', None), ('organizations', organization_id)):
+        table = metadata.tables[table_name]
+        stmt = select(table)
+        if row_id is not None:
+            stmt = stmt.where(table.c.id == row_id)
+        existing = set(target.scalars(select(table.c.id)).all())
+        rows = [dict(row) for row in source.execute(stmt).mappings() if row['id'] not in existing]
+        if rows:
+            target.execute(insert(table), rows)
+
+
+def copy_organization(source, target, metadata, organization_id, batch_size=1000, log=None):
+    """組織のテナントデータを source から target へコピーする
+
+    主キーは移行先で採番し直し、テナントテーブル間の外部キーを付け替える。
+    同じテーブルを指す外部キー (入れ子のサブチケットの親など) は、いったん NULL で挿入し、
+    テーブル全体の新しいIDが揃ってから付け替える。
+    書き込みを止めた状態 (読み取り専用) で呼び出すことで一貫したコピーになる。
+    集計テーブル (is_derived_table) はコピーしないため、移動先で作り直すこと。
+    戻り値は {テーブル名: {旧ID: 新ID}}。
+    """
+    id_maps = {}
+    for table in tenant_tables(metadata):
+        if is_derived_table(table):
+            continue
+        pk = _single_pk(table)
+        remaps = [(fk.parent.name, fk.column.table.name) for fk in table.foreign_keys
+                  if is_tenant_table(fk.column.table) and fk.column.table is not table]
+        self_refs = [fk.parent.name for fk in table.foreign_keys if fk.column.table is table]
+        mapping = id_maps.setdefault(table.name, {})
+        deferred = []  # (新ID, {列: 旧ID})
+        stmt = select(table).where(org_scope(table, organization_id))
+        if pk is not None:
+            stmt = stmt.order_by(pk)
+
+        copied = 0
+        result = source.execute(stmt, execution_options={'stream_results': True, 'yield_per': batch_size})
+        for partition in result.mappings().partitions(batch_size):
+            rows = []
+            self_ref_values = []
+            for row in partition:
+                row = dict(row)
+                for column, parent in remaps:
+                    if row[column] is not None:
+                        row[column] = id_maps[parent][row[column]]
+                self_ref_values.append({column: row[column] for column in self_refs if row[column] is not None})
+                for column in self_refs:
+                    row[column] = None
+                rows.append(row)
+
+            if pk is None:
+                target.execute(insert(table), rows)
+            else:
+                old_ids = [row.pop(pk.name) for row in rows]
+                new_ids = target.scalars(
+                    insert(table).returning(pk, sort_by_parameter_order=True), rows
+                ).all()
+                mapping.update(zip(old_ids, new_ids))
+                deferred.extend((new_id, values) for new_id, values in zip(new_ids, self_ref_values) if values)
+            copied += len(rows)
+        for column in self_refs:
+            params = [{'_new_id': new_id, '_value': mapping[values[column]]}
+                      for new_id, values in deferred if column in values]
+            if params:
+                target.execute(update(table).where(pk == bindparam('_new_id')).values({column: bindparam('_value')}),
+                               params)
+        if log:
+            log(f"  {table.name}: {copied} 行をコピーしました")
+    return id_maps
+
+
+def purge_organization(engine, metadata, organization_id, batch_size=1000, pause=0.0, log=None):
+    """組織のテナントデータを依存関係の逆順に削除する
+
+    1回のDELETEは batch_size 行までとし、バッチごとにコミットしてロックを短く保つ。
+    pause を指定すると、バッチの間に待機して他のトランザクションに譲る。
+    """
+    for table in reversed(tenant_tables(metadata)):
+        pk = _single_pk(table)
+        deleted = 0
+        while True:
+            with engine.begin() as connection:
+                if pk is None:
+                    deleted += connection.execute(delete(table).where(org_scope(table, organization_id))).rowcount
+                    break
+                ids = connection.scalars(
+                    select(pk).where(org_scope(table, organization_id)).order_by(pk).limit(batch_size)
+                ).all()
+                if not ids:
+                    break
+                connection.execute(delete(table).where(pk.in_(ids)))
+                deleted += len(ids)
+            if pause:
+                time.sleep(pause)
+        if log:
+            log(f"  {table.name}: {deleted} 行を削除しました")
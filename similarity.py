@@ -0,0 +1,300 @@
+# similarity.py
+"""似ているチケットの検出 (新しいチケットの作成時に、重複していそうな既存のチケットを示す)。
+
+タイトルを NFKC で正規化して文字の2-gramの集合にし、MinHash の署名 (num_perm 個の最小ハッシュ値) で
+集合どうしの Jaccard 係数を推定する。単語の区切りを使わないため、日本語のタイトルもそのまま扱える。
+
+組織ごとの署名は NumPy の配列 (TitleIndex) に持ち、署名を bands 個の帯に分けた値ごとのバケット (LSH) で
+候補を絞ってから、候補の署名だけを配列の演算でまとめて比べる。組織の全チケットとは比べない。
+
+チケットの追加・タイトルの変更・削除はコミット時に反映する。他のワーカーでの変更は反映されないため、
+reconcile_interval 秒ごとに組織のタイトルをDBから読み直して作り直す (AutoAssigner と同じ)。
+作り直しは裏のスレッドで組織ごとに同時に1つだけ行い、できあがるまでは前の索引を使う。
+"""
+
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SimilarTicket = namedtuple('SimilarTicket', ['id', 'title', 'similarity'])
+
+NUM_PERM = 64
+BANDS = 32
+# 2-gramの2文字をまとめて 2^32 未満の値にする
+_GRAM_MULTIPLIER = np.uint64(0x9E3779B1)
+_MASK = np.uint64(0xFFFFFFFF)
+# 署名をまとめて計算するときの1回あたりのタイトル数 (一時配列は NUM_PERM × 2-gram数)
+_BATCH = 2048
+
+
+def normalize(text):
+    """全角・半角と大文字・小文字をそろえ、記号と空白の並びを1つの空白にする"""
+    text = unicodedata.normalize('NFKC', text or '').casefold()
+    return re.sub(r'[\W_]+', ' ', text).strip()
+
+
+def shingles(text):
+    """正規化したタイトルの文字の2-gramのハッシュ値 (2^32 未満の uint64 の配列。1文字ならその文字)
+
+    同じ2-gramが複数回現れても最小ハッシュ値は変わらないため、重複は取り除かない。
+    """
+    code_points = np.frombuffer(normalize(text).encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    if len(code_points) < 2:
+        return code_points
+    return (code_points[:-1] * _GRAM_MULTIPLIER + code_points[1:]) & _MASK
+
+
+def _permutations(num_perm, seed=1):
+    """num_perm 個のハッシュ関数 (a * x + b) >> 32 の係数 (multiply-shift、uint64 の桁あふれは無視する)"""
+    rng = np.random.default_rng(seed)
+    return (rng.integers(0, 1 << 63, size=(num_perm, 1), dtype=np.uint64) * np.uint64(2) + np.uint64(1),
+            rng.integers(0, 1 << 63, size=(num_perm, 1), dtype=np.uint64))
+
+
+def minhash(hash_lists, permutations):
+    """2-gramのハッシュ値の配列 (空でないもの) それぞれの署名 (len(hash_lists) × num_perm の uint32)"""
+    a, b = permutations
+    signatures = np.empty((len(hash_lists), len(a)), dtype=np.uint32)
+    for start in range(0, len(hash_lists), _BATCH):
+        batch = hash_lists[start:start + _BATCH]
+        offsets = np.cumsum([0] + [len(hashes) for hashes in batch[:-1]])
+        permuted = (a * np.concatenate(batch) + b) >> np.uint64(32)
+        signatures[start:start + len(batch)] = np.minimum.reduceat(permuted, offsets, axis=1).T
+    return signatures
+
+
+class TitleIndex:
+    """1つの組織のチケットのタイトルの MinHash 署名と LSH のバケット
+
+    バケットは帯ごとに「帯の値の昇順に並べた値と行の配列」で持ち、二分探索で引く。並べた後に
+    追加した行は帯ごとの辞書に持ち、一定数を超えたら並べ直す。削除した行は印を付けて候補から除き、
+    並べ直すときに配列から外す (行は使い回さないため、組織の作り直しまで配列に残る)。
+    """
+
+    def __init__(self, num_perm=NUM_PERM, bands=BANDS):
+        if num_perm % bands:
+            raise ValueError("num_perm は bands で割り切れる必要があります")
+        self.num_perm = num_perm
+        self.bands = bands
+        self._permutations = _permutations(num_perm)
+        # 帯の中の値を1つの整数にまとめるときの重み (uint64 の桁あふれは無視する)
+        self._band_weights = np.random.default_rng(2).integers(1, 1 << 63, size=num_perm // bands, dtype=np.uint64)
+        self._signatures = np.zeros((16, num_perm), dtype=np.uint32)
+        self._alive = np.zeros(16, dtype=bool)
+        self._ticket_ids = []  # 行 → チケットID (削除した行は None)
+        self._titles = []
+        self._rows = {}  # チケットID → 行
+        self._sorted_keys = np.zeros((bands, 0), dtype=np.uint64)
+        self._sorted_rows = np.zeros((bands, 0), dtype=np.int64)
+        self._indexed = 0  # 並べた配列に含めた行数
+        self._recent = [{} for _ in range(bands)]  # 並べた後に追加した行の 帯の値 → 行のリスト
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, ticket_id):
+        return ticket_id in self._rows
+
+    def signature(self, title):
+        """タイトルの署名 (2-gramがなければ None)"""
+        hashes = shingles(title)
+        return minhash([hashes], self._permutations)[0] if len(hashes) else None
+
+    def _band_keys(self, signatures):
+        """署名ごとの帯の値 (帯の中の値をまとめた整数) の (署名の数 × bands) の配列"""
+        bands = signatures.reshape(len(signatures), self.bands, -1).astype(np.uint64)
+        return (bands * self._band_weights).sum(axis=2)
+
+    def add_many(self, tickets):
+        """(チケットID, タイトル) をまとめて追加する (既にあるチケットは置き換える)"""
+        tickets = [(ticket_id, title, shingles(title)) for ticket_id, title in tickets]
+        for ticket_id, _, _ in tickets:
+            self.remove(ticket_id)
+        tickets = [ticket for ticket in tickets if len(ticket[2])]
+        if not tickets:
+            return
+        signatures = minhash([hashes for _, _, hashes in tickets], self._permutations)
+        start = len(self._ticket_ids)
+        self._reserve(start + len(tickets))
+        self._signatures[start:start + len(tickets)] = signatures
+        self._alive[start:start + len(tickets)] = True
+        for row, (ticket_id, title, _) in enumerate(tickets, start):
+            self._ticket_ids.append(ticket_id)
+            self._titles.append(title)
+            self._rows[ticket_id] = row
+        if len(self._ticket_ids) - self._indexed > max(256, self._indexed // 8):
+            self._reindex()
+            return
+        for row, keys in enumerate(self._band_keys(signatures).tolist(), start):
+            for recent, key in zip(self._recent, keys):
+                recent.setdefault(key, []).append(row)
+
+    def add(self, ticket_id, title):
+        self.add_many([(ticket_id, title)])
+
+    def remove(self, ticket_id):
+        row = self._rows.pop(ticket_id, None)
+        if row is not None:
+            self._alive[row] = False
+            self._ticket_ids[row] = self._titles[row] = None
+
+    def _reserve(self, count):
+        capacity = len(self._signatures)
+        if count > capacity:
+            while capacity < count:
+                capacity *= 2
+            signatures = np.zeros((capacity, self.num_perm), dtype=np.uint32)
+            alive = np.zeros(capacity, dtype=bool)
+            signatures[:len(self._signatures)] = self._signatures
+            alive[:len(self._alive)] = self._alive
+            self._signatures, self._alive = signatures, alive
+
+    def _reindex(self):
+        """残っている全行を帯ごとに帯の値の順に並べ直す"""
+        rows = np.flatnonzero(self._alive[:len(self._ticket_ids)])
+        keys = self._band_keys(self._signatures[rows])
+        order = np.argsort(keys, axis=0)
+        self._sorted_keys = np.take_along_axis(keys, order, axis=0).T.copy()
+        self._sorted_rows = rows[order].T.copy()
+        self._indexed = len(self._ticket_ids)
+        self._recent = [{} for _ in range(self.bands)]
+
+    def _candidates(self, signature):
+        """帯の値が1つ以上一致する、削除していない行"""
+        parts = []
+        for band, key in enumerate(self._band_keys(signature[np.newaxis])[0]):
+            sorted_keys = self._sorted_keys[band]
+            low, high = np.searchsorted(sorted_keys, key, 'left'), np.searchsorted(sorted_keys, key, 'right')
+            parts.append(self._sorted_rows[band][low:high])
+            recent = self._recent[band].get(int(key))
+            if recent:
+                parts.append(np.array(recent, dtype=np.int64))
+        rows = np.unique(np.concatenate(parts))
+        return rows[self._alive[rows]]
+
+    def similar(self, title, limit=5, min_similarity=0.25, exclude=None):
+        """title に似ているチケットを、推定した類似度 (0〜1) の高い順に limit 件まで返す"""
+        signature = self.signature(title)
+        if signature is None:
+            return []
+        rows = self._candidates(signature)
+        if exclude in self._rows:
+            rows = rows[rows != self._rows[exclude]]
+        scores = np.count_nonzero(self._signatures[rows] == signature, axis=1) / self.num_perm
+        keep = scores >= min_similarity
+        rows, scores = rows[keep], scores[keep]
+        # 類似度の高い順、同じならIDの新しい順
+        ticket_ids = np.array([self._ticket_ids[row] for row in rows], dtype=np.int64)
+        order = np.lexsort((-ticket_ids, -scores))[:limit]
+        return [SimilarTicket(int(ticket_ids[i]), self._titles[rows[i]], round(float(scores[i]), 2)) for i in order]
+
+
+class SimilarTicketIndex:
+    """組織ごとの TitleIndex を保持し、似ているチケットを返す
+
+    loader は組織IDを受け取り、組織のチケットの (ID, タイトル) の列を返す関数 (executor のスレッドで呼ぶ)。
+    組織の索引は最初に使われたとき (と reconcile_interval 秒ごと) にDBから作る。最初の索引は
+    first_load_timeout 秒まで待ち、間に合わなければ索引ができるまで似ているチケットなしとして扱う。
+    作り直しは待たずに前の索引を使う。同じ組織の読み込みは同時に1つだけにし、他のリクエストはそれを待つ。
+    """
+
+    def __init__(self, loader, reconcile_interval=300.0, first_load_timeout=1.0, executor=None,
+                 clock=time.monotonic, **index_options):
+        self.loader = loader
+        self.reconcile_interval = reconcile_interval
+        self.first_load_timeout = first_load_timeout
+        self.executor = executor or ThreadPoolExecutor(max_workers=2, thread_name_prefix='similar-index')
+        self.clock = clock
+        self.index_options = index_options
+        self._organizations = {}  # 組織ID → (TitleIndex, 読み込んだ時刻)
+        self._building = {}  # 組織ID → 読み込み中の索引の Future
+        self._pending = {}  # 組織ID → 読み込み中に反映した変更 {チケットID: タイトル}
+        self._lock = threading.Lock()
+
+    def _organization(self, organization_id):
+        """組織の索引 (最初の読み込みが間に合わなければ None)"""
+        now = self.clock()
+        with self._lock:
+            entry = self._organizations.get(organization_id)
+            if entry is not None and now - entry[1] < self.reconcile_interval:
+                return entry[0]
+            future = self._building.get(organization_id)
+            started = future is None
+            if started:
+                future = self._building[organization_id] = Future()
+                self._pending[organization_id] = {}
+        if started:
+            self.executor.submit(self._build, organization_id, future, now)
+        if entry is not None:
+            return entry[0]
+        try:
+            return future.result(timeout=self.first_load_timeout)
+        except FutureTimeoutError:
+            return None
+
+    def _build(self, organization_id, future, loaded_at):
+        try:
+            index = TitleIndex(**self.index_options)
+            index.add_many(self.loader(organization_id))
+        except Exception as error:
+            logger.warning("組織 %s の類似チケットの索引を作れませんでした", organization_id, exc_info=True)
+            with self._lock:
+                if self._building.get(organization_id) is future:
+                    del self._building[organization_id]
+                    del self._pending[organization_id]
+            future.set_exception(error)
+            return
+        with self._lock:
+            # 読み込み中に無効にされていなければ入れ替える。読み込み中にコミットされた変更を重ねる
+            # (読み込んだ結果に含まれていても、同じタイトルで置き換えるだけ)
+            if self._building.get(organization_id) is future:
+                del self._building[organization_id]
+                for ticket_id, title in self._pending.pop(organization_id).items():
+                    if title is None:
+                        index.remove(ticket_id)
+                    else:
+                        index.add(ticket_id, title)
+                self._organizations[organization_id] = (index, loaded_at)
+        future.set_result(index)
+
+    def similar(self, organization_id, title, limit=5, min_similarity=0.25, exclude=None):
+        index = self._organization(organization_id)
+        if index is None:
+            return []
+        with self._lock:
+            return index.similar(title, limit=limit, min_similarity=min_similarity, exclude=exclude)
+
+    def apply(self, changes):
+        """{(組織ID, チケットID): タイトル (削除は None)} を読み込み済み・読み込み中の組織に反映する"""
+        with self._lock:
+            for (organization_id, ticket_id), title in changes.items():
+                pending = self._pending.get(organization_id)
+                if pending is not None:
+                    pending[ticket_id] = title
+                entry = self._organizations.get(organization_id)
+                if entry is None:
+                    continue
+                if title is None:
+                    entry[0].remove(ticket_id)
+                else:
+                    entry[0].add(ticket_id, title)
+
+    def invalidate(self, organization_id=None):
+        """組織 (省略時は全組織) の索引を捨てる。読み込み中の索引も使わない"""
+        with self._lock:
+            if organization_id is None:
+                self._organizations.clear()
+                self._building.clear()
+                self._pending.clear()
+            else:
+                self._organizations.pop(organization_id, None)
+                self._building.pop(organization_id, None)
+                self._pending.pop(organization_id, None)
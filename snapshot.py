@@ -0,0 +1,174 @@
+# snapshot.py
+"""分析用に、チケット・サブチケット・ユーザー・組織をParquetファイルへ書き出す。
+
+BIの集計を本番のデータベースではなくこのスナップショットに対して行うためのもの。
+
+    <出力先>/<テーブル名>/part-<日時>-<シャード>.parquet   差分 (前回から変更された行)
+    <出力先>/<テーブル名>/full-<日時>-<シャード>.parquet   全件 (--full)
+    <出力先>/_state.json                                  テーブル・シャードごとの取得済みの時刻
+
+- 各テーブルの updated_at を使い、前回の取得時刻以降に変更された行だけを読む。
+  コミットが遅れたトランザクションを取りこぼさないよう、現在時刻から lag だけ前までを
+  取得範囲とし、次回はその時刻から読む。
+- サーバーサイドカーソルで batch_size 行ずつ読み、そのまま行グループとして書き出す
+  (全件をメモリに載せない)。列ごとに zstd で圧縮する。
+- テナントのテーブルはシャードごとにIDが採番されるため shard 列を付ける。
+  行の一意なキーは (shard, id)。
+- 削除された行とシャード移動は差分に現れない。定期的に --full で全件を書き出すこと。
+  read_table() は最新の全件と、それ以降の差分を (shard, id) ごとに最新の行へまとめる。
+"""
+
+import glob
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from sqlalchemy import Boolean, Date, DateTime, Float, Integer, Numeric, select
+
+STATE_FILE = '_state.json'
+COMPRESSION = 'zstd'
+
+
+def arrow_type(column):
+    """SQLAlchemyの列の型に対応するArrowの型"""
+    column_type = column.type
+    if isinstance(column_type, Boolean):
+        return pa.bool_()
+    if isinstance(column_type, Integer):
+        return pa.int64()
+    if isinstance(column_type, (Float, Numeric)):
+        return pa.float64()
+    if isinstance(column_type, DateTime):
+        return pa.timestamp('us')
+    if isinstance(column_type, Date):
+        return pa.date32()
+    return pa.string()
+
+
+def arrow_schema(table, with_shard):
+    fields = [pa.field(column.name, arrow_type(column), nullable=column.nullable or column.primary_key)
+              for column in table.columns]
+    if with_shard:
+        fields.insert(0, pa.field('shard', pa.string(), nullable=False))
+    return pa.schema(fields)
+
+
+def load_state(output_dir):
+    path = os.path.join(output_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return {'watermarks': {}}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_state(output_dir, state):
+    path = os.path.join(output_dir, STATE_FILE)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def _open_writer(path, schema):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return pq.ParquetWriter(path + '.tmp', schema, compression=COMPRESSION)
+
+
+def export_table(connection, table, path, shard_key=None, since=None, until=None, batch_size=10000):
+    """テーブルの行を1つのParquetファイルに書き出し、書き出した行数を返す
+
+    差分 (since を指定) が0行ならファイルを作らない。全件は0行でも作る (以前の全件を打ち消すため)。
+    """
+    schema = arrow_schema(table, with_shard=shard_key is not None)
+    stmt = select(table)
+    if since is not None:
+        stmt = stmt.where(table.c.updated_at >= since)
+    if until is not None:
+        stmt = stmt.where(table.c.updated_at < until)
+    stmt = stmt.order_by(*table.primary_key.columns)
+
+    written = 0
+    writer = None
+    result = connection.execute(stmt, execution_options={'stream_results': True, 'yield_per': batch_size})
+    try:
+        for partition in result.partitions(batch_size):
+            columns = {column.name: [row[index] for row in partition] for index, column in enumerate(table.columns)}
+            if shard_key is not None:
+                columns['shard'] = [shard_key] * len(partition)
+            if writer is None:
+                writer = _open_writer(path, schema)
+            writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+            written += len(partition)
+        if writer is None and since is None:
+            writer = _open_writer(path, schema)
+    except Exception:
+        if writer is not None:
+            writer.close()
+            os.remove(path + '.tmp')
+        raise
+    if writer is not None:
+        writer.close()
+        os.replace(path + '.tmp', path)
+    return written
+
+
+def snapshot(sources, output_dir, full=False, lag=timedelta(minutes=5), batch_size=10000, now=None, log=None):
+    """スナップショットを書き出す
+
+    sources は (シャードキー, コネクション, テーブル, テナントかどうか) の列。
+    テーブルごと・シャードごとの取得済みの時刻を _state.json に保存する。
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    state = load_state(output_dir)
+    until = (now or datetime.utcnow()) - lag
+    stamp = until.strftime('%Y%m%dT%H%M%S')
+    for shard_key, connection, table, tenant in sources:
+        state_key = f'{table.name}:{shard_key}'
+        since = None if full else state['watermarks'].get(state_key)
+        kind = 'full' if since is None else 'part'
+        path = os.path.join(output_dir, table.name, f'{kind}-{stamp}-{shard_key}.parquet')
+        written = export_table(connection, table, path, shard_key=shard_key if tenant else None,
+                               since=datetime.fromisoformat(since) if since else None, until=until,
+                               batch_size=batch_size)
+        state['watermarks'][state_key] = until.isoformat()
+        if log:
+            log(f"  {table.name} ({shard_key}): {written} 行 ({kind})")
+    save_state(output_dir, state)
+    return state
+
+
+def _parse_file_name(path):
+    """'<種類>-<日時>-<シャード>.parquet' を (種類, 日時, シャード) に分解する"""
+    kind, stamp, shard_key = os.path.basename(path)[:-len('.parquet')].split('-', 2)
+    return kind, stamp, shard_key
+
+
+def read_table(output_dir, table_name):
+    """シャードごとに最新の全件とそれ以降の差分を読み、キーごとに最新の行だけを残したArrowのテーブルを返す"""
+    files_by_shard = {}
+    for path in glob.glob(os.path.join(output_dir, table_name, '*.parquet')):
+        kind, stamp, shard_key = _parse_file_name(path)
+        files_by_shard.setdefault(shard_key, []).append((stamp, kind, path))
+    files = []
+    for shard_files in files_by_shard.values():
+        full_stamps = [stamp for stamp, kind, _ in shard_files if kind == 'full']
+        latest_full = max(full_stamps, default='')
+        files.extend(path for stamp, _, path in sorted(shard_files) if stamp >= latest_full)
+    if not files:
+        return None
+
+    data = pa.concat_tables([pq.read_table(path) for path in files], promote_options='default')
+    keys = ['shard', 'id'] if 'shard' in data.column_names else ['id']
+    # (キー, updated_at) の順に並べ、キーごとに最後の行 (最新) を残す
+    data = data.take(pc.sort_indices(data, sort_keys=[(key, 'ascending') for key in keys + ['updated_at']]))
+    key_columns = [data.column(key).to_numpy(zero_copy_only=False) for key in keys]
+    last_of_key = np.ones(len(data), dtype=bool)
+    if len(data) > 1:
+        same_as_next = np.ones(len(data) - 1, dtype=bool)
+        for values in key_columns:
+            same_as_next &= values[:-1] == values[1:]
+        last_of_key[:-1] = ~same_as_next
+    return data.filter(pa.array(last_of_key))
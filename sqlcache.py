@@ -0,0 +1,50 @@
+# sqlcache.py
+"""SQLAlchemy のコンパイル済みSQLのキャッシュ (compiled cache) の利用状況を数える。
+
+SQLAlchemy は文の構造から作るキャッシュキーでコンパイル結果を再利用するが、
+文を毎回組み立てると、その組み立てとキャッシュキーの計算はリクエストごとに行われる。
+よく実行する文は値を bindparam にして一度だけ組み立て、同じ文のオブジェクトを
+使い回す (キャッシュキーは文のオブジェクトに記憶される)。
+
+CompiledCacheStats は実行のたびにコンパイル結果がキャッシュから取れたか (hit) 、
+新しくコンパイルしたか (miss) を数える。miss が増え続ける場合は、値をSQLに
+埋め込んだ文 (literal) や、キャッシュできない文が実行されている。
+"""
+
+import threading
+from collections import Counter
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class CompiledCacheStats:
+    """このワーカープロセスで実行した文の、コンパイル済みSQLのキャッシュの結果ごとの件数"""
+
+    def __init__(self):
+        self.counts = Counter()
+        self._lock = threading.Lock()
+
+    def install(self, target=Engine):
+        """target (既定はすべてのエンジン) で実行した文を数える"""
+        event.listen(target, 'after_execute', self._record)
+
+    def _record(self, conn, clauseelement, multiparams, params, execution_options, result):
+        context = getattr(result, 'context', None)
+        if context is None:
+            return
+        # cache_hit は CACHE_HIT / CACHE_MISS / CACHING_DISABLED / NO_CACHE_KEY / NO_DIALECT_SUPPORT
+        outcome = 'raw_sql' if context.compiled is None else context.cache_hit.name.lower()
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def snapshot(self):
+        with self._lock:
+            counts = dict(self.counts)
+        hits, misses = counts.get('cache_hit', 0), counts.get('cache_miss', 0)
+        counts['hit_ratio'] = round(hits / (hits + misses), 4) if hits + misses else None
+        return counts
+
+    def reset(self):
+        with self._lock:
+            self.counts.clear()
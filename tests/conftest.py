@@ -1,12 +1,81 @@
 import pytest
 import os
+import tempfile
+import time
+from collections import defaultdict
 from werkzeug.security import generate_password_hash
 
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import joinedload # joinedloadをインポート
+
+
+def _worker_database_url():
+    """テスト用のデータベースURLを決める。
+
+    DATABASE_URLがなければインメモリSQLite (プロセスごとに独立) を使う。
+    PostgreSQLでpytest-xdistを使う場合は、ワーカーごとに別のデータベースを用意する。
+    """
+    base_url = os.environ.get("DATABASE_URL", "sqlite:///:memory:")
+    worker = os.environ.get("PYTEST_XDIST_WORKER")
+    url = make_url(base_url)
+    if not worker or url.get_backend_name() != 'postgresql':
+        return base_url
+
+    worker_url = url.set(database=f"{url.database}_{worker}")
+    admin_engine = create_engine(url, isolation_level="AUTOCOMMIT")
+    with admin_engine.connect() as conn:
+        exists = conn.scalar(text("SELECT 1 FROM pg_database WHERE datname = :name"),
+                             {'name': worker_url.database})
+        if not exists:
+            conn.exec_driver_sql(f'CREATE DATABASE "{worker_url.database}"')
+    admin_engine.dispose()
+    return worker_url.render_as_string(hide_password=False)
+
+
+# app.pyはインポート時にエンジンを作成するため、インポート前に接続先を決めておく
+os.environ["DATABASE_URL"] = _worker_database_url()
+# テスト中にビルドするCSSは作業ツリーの外に書き出す
+os.environ.setdefault("ASSET_OUTPUT_DIR", tempfile.mkdtemp(prefix="assets-"))
+# 添付ファイルも作業ツリーの外に保存する
+os.environ.setdefault("ATTACHMENT_DIR", tempfile.mkdtemp(prefix="attachments-"))
+
 # Flaskアプリケーションとデータベースインスタンスをapp.pyからインポート
 # test_app.pyからもインポートするため、循環参照を避けるために
 # アプリケーションのインスタンス化や設定はここで行う
-from app import app as flask_app, db as sqlalchemy_db, User, Organization, Role
+from app import (app as flask_app, db as sqlalchemy_db, User, Ticket, Organization, Role,  # noqa: E402
+                 auto_assigner, dashboard_breaker, dashboard_cache, login_throttle, organization_ids, role_cache,
+                 session_user_cache, shard_directory, shard_map, similar_ticket_index)
+
+SEED_ORG_NAME = "SeededReadOnlyOrg"
+SEED_PASSWORD = "seeded-password"
+# シードデータのID (real_commits のテスト後に作り直すと更新される)
+_seed_state = {}
+
+
+with flask_app.app_context():
+    _test_engine = sqlalchemy_db.engine
+
+if _test_engine.dialect.name == 'sqlite':
+    # pysqliteはSAVEPOINTを正しく扱えないため、トランザクションの開始を自前で行う
+    # (https://docs.sqlalchemy.org/en/20/dialects/sqlite.html#serializable-isolation-savepoints-transactional-ddl)
+    @event.listens_for(_test_engine, "connect")
+    def _disable_pysqlite_transaction_handling(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(_test_engine, "begin")
+    def _emit_sqlite_begin(conn):
+        # インメモリDBは全接続で1つのDBAPI接続を共有するため、開始済みなら参加するだけにする
+        if not conn.connection.dbapi_connection.in_transaction:
+            conn.exec_driver_sql("BEGIN")
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers",
+        "real_commits: テストのトランザクションの外で接続を使う (CLIコマンドやシャード) ため、実際にコミットする"
+    )
+
 
 @pytest.fixture(scope='session')
 def app(request):
@@ -15,8 +84,7 @@ def app(request):
     flask_app.config.update({
         "TESTING": True,
         # CI環境のDATABASE_URLを優先し、なければインメモリSQLiteを使用
-        "SQLALCHEMY_DATABASE_URI": os.environ.get("DATABASE_URL",
-                                                "sqlite:///:memory:"),
+        "SQLALCHEMY_DATABASE_URI": os.environ["DATABASE_URL"],
         "SECRET_KEY": "test_secret_key_for_pytest",
         "WTF_CSRF_ENABLED": False,  # フォームテストを簡単にするためCSRFを無効化
         "LOGIN_DISABLED": False,  # ログイン機能のテストのため無効化しない
@@ -24,46 +92,149 @@ def app(request):
     })
 
     with flask_app.app_context():
+        sqlalchemy_db.drop_all()  # 中断したテストの残りを消す (ワーカー用のDBは再利用される)
         sqlalchemy_db.create_all()  # 全てのテーブルを作成
-        # テスト用の基本的なロールを作成
-        if Role.query.count() == 0:
-            admin_role = Role(name='admin')
-            member_role = Role(name='member')
-            sqlalchemy_db.session.add_all([admin_role, member_role])
-            sqlalchemy_db.session.commit()
-        # テスト用の組織を作成
-        if Organization.query.count() == 0:
-            test_org = Organization(name="DefaultTestOrg")
-            sqlalchemy_db.session.add(test_org)
-            sqlalchemy_db.session.commit()
+        _create_base_rows()
 
     yield flask_app # テスト実行
 
     with flask_app.app_context():
         sqlalchemy_db.drop_all() # 全てのテーブルを削除
 
+
+def _create_base_rows():
+    # テスト用の基本的なロールを作成
+    if Role.query.count() == 0:
+        admin_role = Role(name='admin')
+        member_role = Role(name='member')
+        sqlalchemy_db.session.add_all([admin_role, member_role])
+        sqlalchemy_db.session.commit()
+    # テスト用の組織を作成
+    if Organization.query.filter_by(name="DefaultTestOrg").first() is None:
+        test_org = Organization(name="DefaultTestOrg")
+        sqlalchemy_db.session.add(test_org)
+        sqlalchemy_db.session.commit()
+
+
+def _invalidate_caches():
+    shard_directory.invalidate()
+    organization_ids.invalidate()
+    role_cache.invalidate()
+    auto_assigner.invalidate()
+    similar_ticket_index.invalidate()
+    dashboard_breaker.reset()
+    dashboard_cache.reset()
+    session_user_cache.reset()
+
+
+def _delete_all_rows():
+    for table in reversed(sqlalchemy_db.metadata.sorted_tables):
+        sqlalchemy_db.session.execute(table.delete())
+    sqlalchemy_db.session.commit()
+
+
+def _create_seeded_dataset():
+    """読み取り専用のテストで共有する組織・ユーザー・チケットを作成する"""
+    admin_role = Role.query.filter_by(name='admin').one()
+    member_role = Role.query.filter_by(name='member').one()
+    org = Organization(name=SEED_ORG_NAME)
+    alice = User(username='alice', password_hash=generate_password_hash(SEED_PASSWORD),
+                 organization=org, role=admin_role)
+    bob = User(username='bob', password_hash=generate_password_hash(SEED_PASSWORD),
+               organization=org, role=member_role)
+    statuses = ['新規', '対応中', '保留', '解決済み', 'クローズ']
+    sqlalchemy_db.session.add_all([
+        Ticket(title=f"Seeded ticket {i:02d}", status=statuses[i % 5], priority=i % 3 + 1,
+               requester=alice, assignee=bob if i % 2 else None, organization=org)
+        for i in range(25)
+    ])
+    sqlalchemy_db.session.commit()
+    _seed_state.update(organization_id=org.id, alice_id=alice.id, bob_id=bob.id, ticket_count=25)
+
+
 @pytest.fixture(scope='function')
 def client(app):
     """A test client for the app."""
+    # テストごとにログイン試行の状態をリセットする (同一IPからの連続ログインで制限されないように)
+    login_throttle.reset()
     return app.test_client()
 
+
 @pytest.fixture(scope='function')
-def db(app):
-    """Provides the database instance for a test, ensuring a clean state."""
+def db(app, request):
+    """Provides the database instance for a test, ensuring a clean state.
+
+    既定では、テスト全体を1つの外部トランザクションで囲み、アプリ内のコミットは
+    SAVEPOINTの解放として扱う。テスト後にロールバックするだけで元の状態に戻る。
+    `real_commits` マーカーの付いたテストは空のテーブルから実際にコミットし、
+    終了後に基本データとシードデータを作り直す。
+    """
+    _invalidate_caches() # IDが再利用されるため、組織・ロール・シャードのキャッシュも消す
+    if request.node.get_closest_marker('real_commits'):
+        with app.app_context():
+            _delete_all_rows()
+            yield sqlalchemy_db # sqlalchemy_dbを返す
+            sqlalchemy_db.session.remove() # セッションをクリーンアップ
+        # テスト中に設定されたシャード (g.shard_key) を引き継がないよう、新しいコンテキストで作り直す
+        with app.app_context():
+            _delete_all_rows()
+            _create_base_rows()
+            if _seed_state:
+                _create_seeded_dataset()
+        _invalidate_caches()
+        return
+
     with app.app_context():
-        # 各テスト前にはテーブルのデータをクリアする
-        # (create_all/drop_allはセッションスコープで行うため、ここではデータのみ削除)
-        for table in reversed(sqlalchemy_db.metadata.sorted_tables):
-            sqlalchemy_db.session.execute(table.delete())
-        sqlalchemy_db.session.commit()
-        yield sqlalchemy_db # sqlalchemy_dbを返す
-        sqlalchemy_db.session.remove() # セッションをクリーンアップ
+        connection = sqlalchemy_db.engine.connect()
+        transaction = connection.begin()
+        original_session = sqlalchemy_db.session
+        sqlalchemy_db.session = sqlalchemy_db._make_scoped_session({
+            'bind': connection,
+            'join_transaction_mode': 'create_savepoint',
+            'class_': original_session.session_factory.class_,
+        })
+        try:
+            yield sqlalchemy_db
+        finally:
+            sqlalchemy_db.session.remove()
+            sqlalchemy_db.session = original_session
+            transaction.rollback()
+            connection.close()
+            _invalidate_caches()
+
 
 @pytest.fixture
 def runner(app):
     """A test runner for the app's Click commands."""
     return app.test_cli_runner()
 
+
+@pytest.fixture
+def shard(app, tmp_path):
+    """一時ファイルのSQLiteをシャード 'test_shard' として登録する"""
+    url = f"sqlite:///{tmp_path / 'shard.db'}"
+    shard_map.add_shard('test_shard', url)
+    sqlalchemy_db.metadata.create_all(shard_map.engine('test_shard'))
+    yield shard_map.engine('test_shard')
+    shard_map.dispose()
+    shard_map.urls.pop('test_shard')
+
+
+@pytest.fixture(scope='session')
+def seeded_data(app):
+    """読み取り専用のテスト向けに、セッション全体で一度だけ作成するデータ (変更しないこと)"""
+    with app.app_context():
+        _create_seeded_dataset()
+    return _seed_state
+
+
+@pytest.fixture
+def seeded_client(seeded_data, client, db):
+    """シードデータの管理者 (alice) でログインしたテストクライアント"""
+    client.post('/login', data=dict(username='alice', password=SEED_PASSWORD, organization_name=SEED_ORG_NAME))
+    return client
+
+
 @pytest.fixture
 def logged_in_user(client, db, app): # appフィクスチャを引数に追加
     """
@@ -103,3 +274,45 @@ def logged_in_user(client, db, app): # appフィクスチャを引数に追加
         # role属性も一緒に読み込むように変更 (SQLAlchemy 2.0 style)
         reloaded_user = db.session.get(User, user_instance_id, options=[joinedload(User.role)])
     return reloaded_user, client
+
+
+# --- 実行時間のレポート ---
+_session_started = time.time()
+_file_durations = defaultdict(float)
+_test_durations = []
+
+
+def pytest_runtest_logreport(report):
+    # xdistの場合はコントローラーに全ワーカーの結果が集まる
+    _file_durations[report.nodeid.split('::')[0]] += report.duration
+    if report.when == 'call':
+        _test_durations.append((report.duration, report.nodeid))
+
+
+def _time_budget_exceeded():
+    budget = os.environ.get("PYTEST_TIME_BUDGET")
+    return bool(budget) and sum(_file_durations.values()) > float(budget)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    # 合計実行時間が予算 (PYTEST_TIME_BUDGET 秒) を超えたらCIを失敗させる
+    if not os.environ.get("PYTEST_XDIST_WORKER") and exitstatus == 0 and _time_budget_exceeded():
+        session.exitstatus = 1
+
+
+def pytest_terminal_summary(terminalreporter, exitstatus, config):
+    """ファイルごとの実行時間と遅いテストを表示する"""
+    if not _file_durations:
+        return
+    total = sum(_file_durations.values())
+    terminalreporter.section("test timing")
+    for path, duration in sorted(_file_durations.items(), key=lambda item: -item[1]):
+        terminalreporter.write_line(f"{duration:8.2f}s  {path}")
+    terminalreporter.write_line("slowest tests:")
+    for duration, nodeid in sorted(_test_durations, reverse=True)[:5]:
+        terminalreporter.write_line(f"{duration:8.2f}s  {nodeid}")
+    terminalreporter.write_line(f"total test time (sum over workers): {total:.2f}s, "
+                                f"wall clock: {time.time() - _session_started:.2f}s")
+    if _time_budget_exceeded():
+        terminalreporter.write_line(
+            f"テストの合計実行時間 {total:.2f}s が予算 {os.environ['PYTEST_TIME_BUDGET']}s を超えました。", red=True)
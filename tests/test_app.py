@@ -3,7 +3,10 @@ import pytest
 # tests/test_app.py
 from datetime import date
 from flask import session as flask_session
-from app import User, Ticket, Organization, Role, db as app_db # モデル名をTicketに変更
+from app import User, Ticket, SubTicket, Organization, Role, db as app_db # モデル名をTicketに変更
+from sqlalchemy import event
+from app import TicketRow, build_ticket_list_query, compiled_cache_stats, organization_ids, to_ticket_rows
+from conftest import SEED_ORG_NAME, SEED_PASSWORD
 
 
 def test_index_page_unauthenticated(client):
@@ -340,4 +343,152 @@ def test_cannot_operate_other_user_task(client, db):
     assert response_delete.status_code == 200 # リダイレクト後のindex
     expected_flash_message = f"チケットID {ticket_org1.id} が見つからないか、権限がありません。"
     assert expected_flash_message.encode('utf-8') in response_delete.data
-    assert app_db.session.get(Ticket, ticket_org1.id) is not None  # 削除されていないこと
\ No newline at end of file
+    assert app_db.session.get(Ticket, ticket_org1.id) is not None  # 削除されていないこと
+
+# --- 削除のカスケードテスト ---
+def test_delete_ticket_cascades_in_database(logged_in_user, db):
+    """チケットの削除でサブチケットを読み込まず、DBのカスケードで削除されるか"""
+    user, client = logged_in_user
+    ticket = Ticket(title="Cascade Ticket", requester_id=user.id, organization_id=user.organization_id)
+    ticket.subtickets = [SubTicket(title=f"step {i}") for i in range(20)]
+    db.session.add(ticket)
+    db.session.commit()
+    ticket_id = ticket.id
+
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        response = client.get(f'/ticket/{ticket_id}/delete', follow_redirects=False)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+    assert response.status_code == 302
+    assert not any('subtickets' in s for s in statements)
+    assert SubTicket.query.filter_by(ticket_id=ticket_id).count() == 0
+
+
+@pytest.mark.real_commits
+def test_purge_org_command(runner, db):
+    """purge-org コマンドで組織のユーザー・チケット・サブチケットが一定件数ずつ削除されるか"""
+    role = Role(name='admin')
+    org, other_org = Organization(name="PurgeOrg"), Organization(name="KeepOrg")
+    user = User(username="purge", password_hash="x", organization=org, role=role)
+    keeper = User(username="keep", password_hash="x", organization=other_org, role=role)
+    tickets = [Ticket(title=f"T{i}", requester=user, organization=org,
+                      subtickets=[SubTicket(title="s1"), SubTicket(title="s2")]) for i in range(7)]
+    db.session.add_all([org, other_org, user, keeper, Ticket(title="Keep", requester=keeper, organization=other_org)]
+                       + tickets)
+    db.session.commit()
+
+    result = runner.invoke(args=['purge-org', 'PurgeOrg', '--batch-size', '3', '--pause', '0', '--yes'])
+    assert result.exit_code == 0, result.output
+
+    app_db.session.expire_all()
+    assert Organization.query.filter_by(name="PurgeOrg").first() is None
+    assert User.query.filter_by(username="purge").first() is None
+    assert SubTicket.query.count() == 0
+    assert [t.title for t in Ticket.query.all()] == ["Keep"]
+
+
+# --- シードデータを使う読み取り専用のテスト ---
+def test_dashboard_lists_seeded_tickets(seeded_client, seeded_data):
+    """シードデータの組織のチケットがすべて一覧に表示されるか"""
+    response = seeded_client.get('/')
+    assert response.status_code == 200
+    assert response.data.count(b'Seeded ticket') >= seeded_data['ticket_count']
+
+
+def test_dashboard_filter_and_sort_seeded_tickets(seeded_client):
+    """ステータスの絞り込みと並び替えが一覧に反映されるか"""
+    response = seeded_client.get('/', query_string={'filter_status': '保留', 'sort_by': 'priority', 'sort_order': 'asc'})
+    assert response.status_code == 200
+    body = response.data.decode('utf-8')
+    # 保留のチケットは 2, 7, 12, 17, 22 (優先度は i % 3 + 1)。同じ優先度の中の順番は決めていない
+    by_priority = [[12], [7, 22], [2, 17]]
+    positions = [[body.find(f"Seeded ticket {i:02d}") for i in group] for group in by_priority]
+    assert all(position >= 0 for group in positions for position in group)
+    assert max(positions[0]) < min(positions[1]) and max(positions[1]) < min(positions[2])
+    assert "Seeded ticket 00" not in body
+
+
+def test_ticket_list_query_returns_rows_without_orm_instances(seeded_data, db):
+    """一覧のクエリが表示用の行だけを返し、ORMのインスタンスをセッションに読み込まないか"""
+    rows = to_ticket_rows(db.session.execute(
+        *build_ticket_list_query(seeded_data['organization_id'], filter_status='対応中', sort_by='id', sort_order='asc')
+    ))
+    assert all(isinstance(row, TicketRow) for row in rows)
+    assert [row.title for row in rows] == [f"Seeded ticket {i:02d}" for i in (1, 6, 11, 16, 21)]
+    assert {row.requester_name for row in rows} == {'alice'}
+    assert [row.assignee_name for row in rows] == ['bob', None, 'bob', None, 'bob']
+    assert not any(isinstance(obj, (Ticket, User)) for obj in db.session.identity_map.values())
+
+
+def test_dashboard_reuses_prebuilt_statements(logged_in_user, seeded_data):
+    """一覧の文は組み合わせごとに使い回し、2回目以降のダッシュボードはコンパイル済みSQLのキャッシュに当たるか"""
+    user, client = logged_in_user
+    first, params = build_ticket_list_query(1, filter_status='新規', search_term='a', sort_by='due_date')
+    second, _ = build_ticket_list_query(2, filter_status='対応中', search_term='b', sort_by='due_date')
+    assert first is second and params == {'organization_id': 1, 'filter_status': '新規', 'search_pattern': '%a%'}
+    assert build_ticket_list_query(1, sort_by='unknown')[0] is build_ticket_list_query(1)[0]
+
+    client.get('/?filter_status=新規&search_term=x&sort_by=priority')
+    compiled_cache_stats.reset()
+    response = client.get('/?filter_status=対応中&search_term=y&sort_by=priority')
+    assert response.status_code == 200
+    stats = client.get('/admin/metrics/sql-cache').json
+    # 担当者の選択肢と一覧の文は、値が変わってもコンパイルし直さない
+    assert stats['cache_hit'] >= 2 and 'cache_miss' not in stats and stats['hit_ratio'] == 1.0
+
+
+class SelectCounter:
+    """ブロック内で実行されたSELECT文を記録する"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith('SELECT'):
+            self.statements.append(statement)
+
+
+def test_login_is_single_query_with_warm_caches(client, db, seeded_data):
+    """組織名とシャードのキャッシュが温まっていれば、ログインのDB問い合わせは1回か"""
+    credentials = dict(username='alice', password=SEED_PASSWORD, organization_name=SEED_ORG_NAME)
+    client.post('/login', data=credentials)
+    client.get('/logout')
+
+    with SelectCounter(app_db.engine) as counter:
+        response = client.post('/login', data=credentials)
+    assert response.status_code == 302 and response.location.endswith('/')
+    assert len(counter.statements) == 1
+    assert 'JOIN organizations' in counter.statements[0] and 'roles' in counter.statements[0]
+
+
+def test_login_recovers_from_stale_organization_cache(client, db, seeded_data):
+    """キャッシュの組織IDが古くても (組織の削除・再作成後など) ログインできるか"""
+    organization_ids.store(SEED_ORG_NAME, seeded_data['organization_id'] + 1000)
+    response = client.post('/login', data=dict(username='alice', password=SEED_PASSWORD,
+                                               organization_name=SEED_ORG_NAME))
+    assert response.location.endswith('/')
+    assert organization_ids.get_cached(SEED_ORG_NAME) == seeded_data['organization_id']
+
+
+def test_signup_does_not_query_roles_repeatedly(client, db):
+    """ロールはキャッシュされ、サインアップのたびに問い合わせないか"""
+    client.post('/signup', data={'organization_name': 'RoleCacheOrg1', 'username': 'u1', 'password': 'pw'})
+    with SelectCounter(app_db.engine) as counter:
+        client.post('/signup', data={'organization_name': 'RoleCacheOrg2', 'username': 'u2', 'password': 'pw'})
+    assert not [statement for statement in counter.statements if 'FROM roles' in statement]
+    user = User.query.filter_by(username='u2').one()
+    assert user.role.name == 'admin'
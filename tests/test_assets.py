@@ -0,0 +1,59 @@
+import gzip
+
+import brotli
+
+from app import asset_manifest
+from assets import build_assets, build_css
+
+
+def test_build_css_includes_only_known_utilities():
+    """テンプレートで使っているクラスだけがCSSになり、バリアントが正しく展開されるか"""
+    css = build_css({'px-6', 'hover:bg-sky-600', 'md:grid-cols-3', 'space-y-4', 'list-disc', 'pl-5', 'not-a-utility'})
+    assert '.px-6{padding-left:1.5rem;padding-right:1.5rem}' in css
+    assert '.hover\\:bg-sky-600:hover{background-color:#0284c7}' in css
+    assert '@media (min-width:768px){.md\\:grid-cols-3{grid-template-columns:repeat(3,minmax(0,1fr))}}' in css
+    assert '.space-y-4>:not([hidden])~:not([hidden]){margin-top:1rem}' in css
+    # プリフライトで消した箇条書きの記号をクラスで戻す
+    assert '.list-disc{list-style-type:disc}' in css and '.pl-5{padding-left:1.25rem}' in css
+    assert 'not-a-utility' not in css
+
+
+def test_build_assets_writes_fingerprinted_files(tmp_path):
+    """内容のハッシュを含む名前で、圧縮済みのファイルとmanifestが書き出されるか"""
+    manifest = build_assets(output_dir=str(tmp_path))
+    hashed_name = manifest['app.css']
+    assert hashed_name.startswith('app.') and hashed_name.endswith('.css') and hashed_name != 'app.css'
+    content = (tmp_path / hashed_name).read_bytes()
+    assert gzip.decompress((tmp_path / f'{hashed_name}.gz').read_bytes()) == content
+    assert brotli.decompress((tmp_path / f'{hashed_name}.br').read_bytes()) == content
+    # 同じテンプレートからは同じ名前になる
+    assert build_assets(output_dir=str(tmp_path)) == manifest
+
+
+def test_pages_use_precompiled_stylesheet(client):
+    """ページがCDNのスクリプトではなく、ハッシュ付きのスタイルシートを読み込むか"""
+    response = client.get('/login')
+    assert b'cdn.tailwindcss.com' not in response.data
+    assert f'/assets/{asset_manifest.resolve("app.css")}'.encode() in response.data
+
+
+def test_asset_served_with_long_cache_and_precompressed(client):
+    """アセットが長期キャッシュのヘッダーと、対応する圧縮形式で配信されるか"""
+    url = f'/assets/{asset_manifest.resolve("app.css")}'
+    response = client.get(url, headers={'Accept-Encoding': 'gzip, br'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'br'
+    assert response.mimetype == 'text/css'
+    assert 'max-age=31536000' in response.headers['Cache-Control']
+    assert 'immutable' in response.headers['Cache-Control']
+    assert b'.bg-slate-100{' in brotli.decompress(response.data)
+
+    response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    response = client.get(url)
+    assert 'Content-Encoding' not in response.headers
+    assert b'.bg-slate-100{' in response.data
+
+    # ハッシュのない名前や任意のファイルは配信しない
+    assert client.get('/assets/app.css').status_code == 404
+    assert client.get('/assets/manifest.json').status_code == 404
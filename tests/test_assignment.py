@@ -0,0 +1,101 @@
+import pytest
+from sqlalchemy import select
+from werkzeug.security import generate_password_hash
+
+from app import User, Ticket, Organization, auto_assigner
+from assignment import AutoAssigner, LoadBuckets
+
+
+def test_load_buckets_least():
+    """負荷の増減に合わせて、負荷が最小の担当者 (同じ負荷なら先に来た担当者) を返すか"""
+    buckets = LoadBuckets()
+    for member in (1, 2, 3):
+        buckets.add(member)
+    assert buckets.least() == 1
+    buckets.adjust(1, 3)
+    buckets.adjust(2, 1)
+    assert buckets.least() == 3
+    buckets.adjust(3, 2)
+    assert buckets.least() == 2
+    buckets.adjust(1, -3)
+    assert buckets.least() == 1
+    buckets.adjust(1, -5)  # 0未満にはならない
+    assert buckets.load(1) == 0
+    buckets.remove(1)
+    assert buckets.least() == 2
+
+
+def test_auto_assigner_strategies_and_reconcile():
+    """方式ごとに担当者を選び、負荷の増減を反映し、一定時間ごとにだけ読み直すか"""
+    now = [0.0]
+    calls = []
+
+    def loader(organization_id):
+        calls.append(organization_id)
+        # 担当者10: 高優先度1件 (3)、担当者11: 低優先度2件 (2)、担当者12: なし
+        return [10, 11, 12], [(10, 1, 3), (11, 2, 2)]
+
+    assigner = AutoAssigner(loader, reconcile_interval=60, clock=lambda: now[0])
+    assert [assigner.choose(1, 'round_robin') for _ in range(4)] == [10, 11, 12, 10]
+    assert assigner.choose(1, 'least_open') == 12
+    assigner.apply({(1, 12): (2, 2)})
+    assert assigner.choose(1, 'least_open') == 10
+    assert assigner.choose(1, 'priority_weighted') == 11
+    assert calls == [1]
+
+    now[0] = 61.0
+    assert assigner.choose(1, 'least_open') == 12
+    assert assigner.choose(1, 'round_robin') == 11  # 読み直しても順番は引き継ぐ
+    assert calls == [1, 1]
+
+
+def test_add_ticket_assigns_least_loaded_user(logged_in_user, db):
+    """自動割り当てを有効にすると、未割り当てで作成したチケットが負荷の少ない人に割り当てられるか"""
+    user, client = logged_in_user
+    other = User(username='other', password_hash=generate_password_hash('pw'),
+                 organization_id=user.organization_id, role_id=user.role_id)
+    db.session.add(other)
+    db.session.add(Ticket(title='existing', requester_id=user.id, organization_id=user.organization_id,
+                          assignee_id=user.id))
+    db.session.commit()
+
+    response = client.post('/admin/auto-assign', data={'strategy': 'least_open'})
+    assert response.status_code == 302
+    assert db.session.get(Organization, user.organization_id).auto_assign_strategy == 'least_open'
+
+    loads = []
+    original_loader = auto_assigner.loader
+    auto_assigner.loader = lambda organization_id: loads.append(organization_id) or original_loader(organization_id)
+    try:
+        for title in ('first', 'second', 'third'):
+            client.post('/ticket/add', data={'title': title, 'priority': 2, 'assignee_id': 0})
+    finally:
+        auto_assigner.loader = original_loader
+    assignees = {ticket.title: ticket.assignee_id for ticket in Ticket.query.filter_by(organization_id=user.organization_id)}
+    # other (0件) → 同数 (1件ずつ) なら先に1件になった user → other
+    assert (assignees['first'], assignees['second'], assignees['third']) == (other.id, user.id, other.id)
+    # 負荷はコミット時に更新され、DBから読み直したのは最初の1回だけ
+    assert loads == [user.organization_id]
+
+    # 担当者を指定した場合は自動割り当てしない
+    client.post('/ticket/add', data={'title': 'explicit', 'priority': 2, 'assignee_id': user.id})
+    assert Ticket.query.filter_by(title='explicit').one().assignee_id == user.id
+    assert client.post('/admin/auto-assign', data={'strategy': 'unknown'}).status_code == 400
+
+
+@pytest.mark.real_commits
+def test_auto_assign_for_sharded_organization(client, db, shard, app, monkeypatch):
+    """シャードに置いた組織でも、既定のデータベースに保存した方式で自動割り当てするか"""
+    monkeypatch.setitem(app.config, 'NEW_ORGANIZATION_SHARD', 'test_shard')
+    client.post('/signup', data={'organization_name': 'ShardedOrg', 'username': 'owner', 'password': 'pw'})
+    client.post('/login', data={'organization_name': 'ShardedOrg', 'username': 'owner', 'password': 'pw'})
+
+    assert client.post('/admin/auto-assign', data={'strategy': 'round_robin'}).status_code == 302
+    client.post('/ticket/add', data={'title': 'auto', 'priority': 2, 'assignee_id': 0})
+
+    with shard.connect() as conn:
+        owner_id, assignee_id = conn.execute(select(Ticket.requester_id, Ticket.assignee_id)
+                                             .where(Ticket.title == 'auto')).one()
+        # シャードにコピーした組織の行は更新されない
+        assert conn.scalar(select(Organization.auto_assign_strategy)) is None
+    assert assignee_id == owner_id
@@ -0,0 +1,100 @@
+import asyncio
+import json
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from werkzeug.security import generate_password_hash
+
+from app import app as flask_app, db as app_db, User, Ticket, Organization, Role
+from async_app import AsyncReadApp, to_async_url
+
+
+def call_asgi(asgi_app, path, query_string=b'', cookie=None):
+    """ASGIアプリを直接呼び出し、(ステータス, ヘッダー, ボディ) を返す"""
+    headers = [(b'cookie', cookie.encode())] if cookie else []
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query_string, 'headers': headers}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(asgi_app(scope, receive, send))
+    start, body = messages[0], messages[1]
+    return start['status'], dict(start['headers']), body['body']
+
+
+@pytest.fixture
+def async_env(app, tmp_path):
+    """ファイルベースのSQLiteにデータを用意し、ASGIアプリとログイン用Cookieを返す"""
+    database_url = f"sqlite:///{tmp_path / 'async.db'}"
+    engine = create_engine(database_url)
+    app_db.metadata.create_all(engine)
+    with Session(engine) as session:
+        role = Role(name='admin')
+        org, other_org = Organization(name='AsyncOrg'), Organization(name='OtherAsyncOrg')
+        user = User(username='asyncuser', password_hash=generate_password_hash('pw'), organization=org, role=role)
+        other = User(username='other', password_hash=generate_password_hash('pw'), organization=other_org, role=role)
+        session.add_all([
+            Ticket(title='Async Ticket A', requester=user, organization=org, priority=3),
+            Ticket(title='Async Ticket B', requester=user, assignee=user, organization=org, priority=1),
+            Ticket(title='Foreign Ticket', requester=other, organization=other_org),
+        ])
+        session.commit()
+        user_id, org_id = user.id, org.id
+        foreign_ticket_id = session.query(Ticket).filter_by(title='Foreign Ticket').one().id
+    engine.dispose()
+
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    cookie = f"session={serializer.dumps({'_user_id': f'{org_id}:{user_id}@default'})}"
+    asgi_app = AsyncReadApp(flask_app, database_url=database_url)
+    yield asgi_app, cookie, foreign_ticket_id
+    asyncio.run(asgi_app.engine.dispose())
+
+
+def test_to_async_url():
+    """同期URLが非同期ドライバのURLに変換されるか"""
+    assert to_async_url('postgresql://u:p@db:5432/x').drivername == 'postgresql+asyncpg'
+    assert to_async_url('sqlite:///:memory:').drivername == 'sqlite+aiosqlite'
+
+
+def test_async_ticket_list_scoped_and_sorted(async_env):
+    """JSON一覧が自組織のチケットのみを並び替え・検索付きで返すか"""
+    asgi_app, cookie, _ = async_env
+    status, _, body = call_asgi(asgi_app, '/api/tickets', b'sort_by=priority&sort_order=asc', cookie)
+    assert status == 200
+    titles = [t['title'] for t in json.loads(body)['tickets']]
+    assert titles == ['Async Ticket B', 'Async Ticket A']
+
+    status, _, body = call_asgi(asgi_app, '/api/tickets', b'search_term=Ticket+A', cookie)
+    assert [t['title'] for t in json.loads(body)['tickets']] == ['Async Ticket A']
+
+
+def test_async_requires_login(async_env):
+    """未認証のリクエストはAPIで401、ダッシュボードでログインページへリダイレクトされるか"""
+    asgi_app, _, _ = async_env
+    assert call_asgi(asgi_app, '/api/tickets')[0] == 401
+    status, headers, _ = call_asgi(asgi_app, '/')
+    assert status == 302
+    assert headers[b'location'] == b'/login'
+
+
+def test_async_ticket_detail_other_org(async_env):
+    """他組織のチケット詳細は404になるか"""
+    asgi_app, cookie, foreign_ticket_id = async_env
+    status, _, _ = call_asgi(asgi_app, f'/api/tickets/{foreign_ticket_id}', cookie=cookie)
+    assert status == 404
+
+
+def test_async_dashboard_renders(async_env):
+    """非同期ダッシュボードが共有テンプレートで描画されるか"""
+    asgi_app, cookie, _ = async_env
+    status, _, body = call_asgi(asgi_app, '/', cookie=cookie)
+    assert status == 200
+    assert "Ticket Dashboard".encode('utf-8') in body
+    assert "ようこそ, asyncuser さん".encode('utf-8') in body
+    assert b'Async Ticket A' in body
+    assert b'Foreign Ticket' not in body
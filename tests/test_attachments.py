@@ -0,0 +1,111 @@
+import hashlib
+import io
+import os
+import time
+
+import pytest
+
+from app import Attachment, Organization, Ticket, attachment_store
+from attachments import AttachmentStore
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """テストごとに空の保存先を使う"""
+    monkeypatch.setattr(attachment_store, 'root', str(tmp_path))
+    return attachment_store
+
+
+def _stored_files(root):
+    return sorted(os.path.relpath(os.path.join(directory, name), root)
+                  for directory, _, names in os.walk(root) for name in names)
+
+
+def _create_ticket(db, user):
+    ticket = Ticket(title='With files', requester_id=user.id, organization_id=user.organization_id)
+    db.session.add(ticket)
+    db.session.commit()
+    return ticket
+
+
+def test_upload_deduplicates_and_serves_ranges(logged_in_user, db, store):
+    user, client = logged_in_user
+    ticket = _create_ticket(db, user)
+    content = b'0123456789' * 1000
+    digest = hashlib.sha256(content).hexdigest()
+
+    response = client.post(f'/ticket/{ticket.id}/attachments', follow_redirects=True, data={
+        'file': [(io.BytesIO(content), 'log.txt'), (io.BytesIO(content), 'reports/報告書.txt')]})
+    assert "2件のファイルを添付しました。" in response.get_data(as_text=True)
+
+    attachments = Attachment.query.filter_by(ticket_id=ticket.id).order_by(Attachment.id).all()
+    assert [(a.filename, a.size, a.sha256) for a in attachments] == [('log.txt', 10000, digest),
+                                                                    ('報告書.txt', 10000, digest)]
+    # 同じ内容は組織に1つだけ保存し、一時ファイルは残らない
+    assert _stored_files(store.root) == [os.path.join(str(user.organization_id), digest[:2], digest)]
+
+    response = client.get(f'/attachment/{attachments[1].id}')
+    assert response.status_code == 200 and response.data == content
+    assert response.headers['Content-Disposition'].startswith('attachment;')
+    assert response.headers['X-Content-Type-Options'] == 'nosniff'
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    etag = response.headers['ETag']
+    response.close()
+
+    response = client.get(f'/attachment/{attachments[1].id}', headers={'Range': 'bytes=5-14'})
+    assert response.status_code == 206 and response.data == content[5:15]
+    assert response.headers['Content-Range'] == 'bytes 5-14/10000'
+    response.close()
+    assert client.get(f'/attachment/{attachments[1].id}', headers={'If-None-Match': etag}).status_code == 304
+
+    # 他の組織の添付ファイルは見えない
+    other = Organization(name='OtherAttachmentOrg')
+    db.session.add(other)
+    db.session.flush()
+    foreign = Attachment(organization_id=other.id, ticket_id=ticket.id, filename='x', content_type='text/plain',
+                         size=len(content), sha256=digest)
+    db.session.add(foreign)
+    db.session.commit()
+    assert client.get(f'/attachment/{foreign.id}').status_code == 404
+
+
+def test_too_large_upload_is_rejected_without_leftovers(logged_in_user, db, store, monkeypatch):
+    user, client = logged_in_user
+    ticket = _create_ticket(db, user)
+    monkeypatch.setattr(store, 'max_size', 1024 * 1024)
+
+    response = client.post(f'/ticket/{ticket.id}/attachments', follow_redirects=True,
+                           data={'file': (io.BytesIO(b'x' * (1024 * 1024 + 1)), 'big.bin')})
+    assert "添付ファイルは1件あたり1MBまでです。" in response.get_data(as_text=True)
+    assert Attachment.query.filter_by(ticket_id=ticket.id).count() == 0
+    assert _stored_files(store.root) == []
+
+
+def test_files_posted_to_other_endpoints_skip_attachment_store(client, db, store, monkeypatch):
+    monkeypatch.setattr(store, 'max_size', 10)
+    response = client.post('/login', data={'organization_name': 'NoSuchOrg', 'username': 'u', 'password': 'p',
+                                           'file': (io.BytesIO(b'x' * 100), 'note.txt')})
+    # ログインの失敗としてログイン画面へ戻す (添付ファイルの上限で500にしない)
+    assert response.status_code == 302 and response.headers['Location'].endswith('/login')
+    assert _stored_files(store.root) == []
+
+
+def test_prune_keeps_referenced_and_recent_files(tmp_path):
+    store = AttachmentStore(str(tmp_path), chunk_size=4)
+    kept = store.save(io.BytesIO(b'kept'), 1)
+    assert store.save(io.BytesIO(b'kept'), 1).deduplicated
+    orphan = store.save(io.BytesIO(b'orphan'), 1)
+    other_org = store.save(io.BytesIO(b'kept'), 2)
+    assert not other_org.deduplicated and (kept.sha256, kept.size) == (other_org.sha256, 4)
+    leftover = store.open_upload()
+    leftover.stored = True  # 中断したアップロードの一時ファイル
+
+    referenced = {1: {kept.sha256}, 2: set()}.get
+    assert store.prune(referenced, grace_seconds=60) == 0
+
+    old = time.time() - 120
+    for path in [store.path(1, kept.sha256), store.path(1, orphan.sha256), store.path(2, kept.sha256),
+                 leftover.path]:
+        os.utime(path, (old, old))
+    assert store.prune(referenced, grace_seconds=60) == 3
+    assert _stored_files(str(tmp_path)) == [os.path.join('1', kept.sha256[:2], kept.sha256)]
@@ -0,0 +1,139 @@
+from datetime import date
+
+import pytest
+from sqlalchemy import update
+from sqlalchemy.orm.exc import StaleDataError
+
+from werkzeug.security import generate_password_hash
+
+from app import Organization, OutboxEvent, SubTicket, Ticket, User
+
+
+def _create_ticket(db, user):
+    ticket = Ticket(title='Shared', requester_id=user.id, organization_id=user.organization_id, priority=1,
+                    status='新規')
+    db.session.add(ticket)
+    db.session.commit()
+    return ticket
+
+
+def _edit_form(ticket, **values):
+    """編集画面を表示したときの版数と値に、values の変更を重ねたフォーム"""
+    base = {'title': ticket.title, 'status': ticket.status, 'priority': str(ticket.priority),
+            'assignee_id': str(ticket.assignee_id or 0), 'due_date': ''}
+    form = {'version': str(ticket.version), **{f'base_{field}': value for field, value in base.items()}}
+    form.update(base, **values)
+    return form
+
+
+def test_stale_edit_form_merges_or_reports_conflict(logged_in_user, db):
+    user, client = logged_in_user
+    ticket = _create_ticket(db, user)
+    first = _edit_form(ticket, title='Renamed')
+    second = _edit_form(ticket, priority='3', due_date='2026-12-01')
+    third = _edit_form(ticket, title='Other name')
+
+    response = client.post(f'/ticket/{ticket.id}/edit', data=first, follow_redirects=True)
+    assert f"チケットID {ticket.id} を更新しました。".encode() in response.data
+
+    # 別の列の変更は、古い版数からでも統合される
+    response = client.post(f'/ticket/{ticket.id}/edit', data=second, follow_redirects=True)
+    assert "(他のユーザーの変更と統合しました)" in response.get_data(as_text=True)
+    db.session.expire_all()
+    ticket = db.session.get(Ticket, ticket.id)
+    assert (ticket.title, ticket.priority, ticket.due_date, ticket.version) == ('Renamed', 3, date(2026, 12, 1), 3)
+
+    # 同じ列を別の値に変えていれば上書きせず、衝突した項目を示して編集画面に戻す
+    response = client.post(f'/ticket/{ticket.id}/edit', data=third)
+    body = response.get_data(as_text=True)
+    assert response.status_code == 409
+    assert "タイトル: あなたの入力「Other name」/ 現在の値「Renamed」" in body
+    assert 'name="version" value="3"' in body
+    db.session.expire_all()
+    assert db.session.get(Ticket, ticket.id).title == 'Renamed'
+
+
+def test_patch_api_returns_current_ticket_on_conflict(logged_in_user, db):
+    user, client = logged_in_user
+    ticket = _create_ticket(db, user)
+
+    response = client.patch(f'/api/tickets/{ticket.id}',
+                            json={'version': 1, 'changes': {'status': ['新規', '対応中']}})
+    assert response.status_code == 200
+    assert response.json['merged'] is False and response.json['ticket']['version'] == 2
+
+    response = client.patch(f'/api/tickets/{ticket.id}',
+                            json={'version': 1, 'changes': {'priority': [1, 2]}})
+    assert response.status_code == 200 and response.json['merged'] is True
+    assert (response.json['ticket']['status'], response.json['ticket']['priority']) == ('対応中', 2)
+
+    response = client.patch(f'/api/tickets/{ticket.id}',
+                            json={'version': 1, 'changes': {'status': ['新規', '解決済み'], 'title': ['Shared', 'X']}})
+    assert response.status_code == 409
+    assert response.json['conflicts'] == {'status': {'yours': '解決済み', 'current': '対応中'}}
+    assert response.json['ticket']['version'] == 3 and response.json['ticket']['title'] == 'Shared'
+
+    assert client.patch(f'/api/tickets/{ticket.id}',
+                        json={'version': 3, 'changes': {'status': ['対応中', '保留?']}}).status_code == 400
+    # 版数の列だけの変化は外部へ通知しない
+    changed = [event.payload['changes'] for event in
+               OutboxEvent.query.filter_by(event_type='ticket.updated').order_by(OutboxEvent.id)]
+    assert all('version' not in changes for changes in changed)
+
+
+def test_assignee_must_belong_to_organization(logged_in_user, db):
+    user, client = logged_in_user
+    ticket = _create_ticket(db, user)
+    other = Organization(name='OtherAssigneeOrg')
+    outsider = User(username='outsider', password_hash=generate_password_hash('pw'), organization=other,
+                    role=user.role)
+    db.session.add_all([other, outsider])
+    db.session.commit()
+
+    for assignee_id in (outsider.id, 999999, True):
+        response = client.patch(f'/api/tickets/{ticket.id}',
+                                json={'version': 1, 'changes': {'assignee_id': [None, assignee_id]}})
+        assert response.status_code == 400
+    assert client.patch(f'/api/tickets/{ticket.id}',
+                        json={'version': 1, 'changes': {'priority': [1, True]}}).status_code == 400
+
+    response = client.post(f'/ticket/{ticket.id}/edit', data=_edit_form(ticket, assignee_id=str(outsider.id)))
+    assert response.status_code == 302 and response.headers['Location'].endswith(f'/ticket/{ticket.id}/edit')
+    response = client.post('/ticket/add', data={'title': 'Foreign assignee', 'assignee_id': str(outsider.id)})
+    assert response.status_code == 302
+    db.session.expire_all()
+    assert db.session.get(Ticket, ticket.id).assignee_id is None
+    assert Ticket.query.filter_by(title='Foreign assignee').count() == 0
+
+    response = client.patch(f'/api/tickets/{ticket.id}',
+                            json={'version': 1, 'changes': {'assignee_id': [None, user.id]}})
+    assert response.status_code == 200 and response.json['ticket']['assignee_id'] == user.id
+
+
+def test_concurrent_subticket_updates_are_detected(logged_in_user, db):
+    user, client = logged_in_user
+    ticket = _create_ticket(db, user)
+    subticket = SubTicket(title='check', ticket_id=ticket.id, position=1)
+    db.session.add(subticket)
+    db.session.commit()
+
+    rename = (update(SubTicket).where(SubTicket.id == subticket.id)
+              .values(title='renamed', version=SubTicket.version + 1)
+              .execution_options(synchronize_session=False))
+    db.session.execute(rename)
+    db.session.commit()
+
+    # 古い画面 (版数1) からの切り替えは、他の変更を元に戻さないよう拒否する
+    response = client.post(f'/subticket/toggle/{subticket.id}', data={'version': '1'}, follow_redirects=True)
+    assert "サブチケット「renamed」は他のユーザーが先に更新しました。" in response.get_data(as_text=True)
+    response = client.post(f'/subticket/toggle/{subticket.id}', data={'version': '2'}, follow_redirects=True)
+    assert "サブチケット「renamed」の状態を更新しました。" in response.get_data(as_text=True)
+    db.session.expire_all()
+    assert (subticket.completed, subticket.version) == (True, 3)
+
+    # 読み込んだあとに他の処理が行を更新すると、読み込んだ版数の行としては更新できない
+    db.session.execute(rename)
+    subticket.completed = False
+    with pytest.raises(StaleDataError):
+        db.session.commit()
+    db.session.rollback()
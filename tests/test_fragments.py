@@ -0,0 +1,78 @@
+from app import SubTicket, Ticket
+
+FRAGMENT = {'X-Fragment': '1'}
+
+
+def _create_ticket(db, user, title='Fragment ticket'):
+    ticket = Ticket(title=title, requester_id=user.id, organization_id=user.organization_id, status='新規')
+    db.session.add(ticket)
+    db.session.commit()
+    return ticket
+
+
+def test_add_and_delete_ticket_return_dashboard_rows(logged_in_user, db):
+    user, client = logged_in_user
+
+    # JSなしのフォームは従来どおりリダイレクトする
+    assert client.post('/ticket/add', data={'title': 'Plain'}).status_code == 302
+
+    response = client.post('/ticket/add', data={'title': 'Inline', 'priority': '3'}, headers=FRAGMENT)
+    body = response.get_data(as_text=True)
+    ticket = Ticket.query.filter_by(title='Inline').one()
+    assert response.status_code == 201 and response.headers['X-Fragment'] == '1'
+    assert 'X-Fragment' in response.headers['Vary']
+    assert '<html' not in body
+    assert f'<tr id="ticket-{ticket.id}" data-fragment-prepend="ticketRows">' in body
+    assert '<div id="ticketsEmpty" data-fragment-remove hidden></div>' in body
+    # リダイレクト時のフラッシュメッセージも部分更新で表示し、次の画面には残さない
+    assert "チケット「Plain」を追加しました。" in body and "チケット「Inline」を追加しました。" in body
+    assert "を追加しました。" not in client.get('/').get_data(as_text=True)
+
+    response = client.post('/ticket/add', data={'title': ''}, headers=FRAGMENT)
+    assert response.status_code == 400 and "チケットのタイトルを入力してください。" in response.get_data(as_text=True)
+
+    response = client.get(f'/ticket/{ticket.id}/delete', headers=FRAGMENT)
+    body = response.get_data(as_text=True)
+    assert response.status_code == 200
+    assert f'<div id="ticket-{ticket.id}" data-fragment-remove hidden></div>' in body
+    assert f"チケットID {ticket.id} を削除しました。" in body
+
+
+def test_edit_ticket_fragment_replaces_form_and_row(logged_in_user, db):
+    user, client = logged_in_user
+    ticket = _create_ticket(db, user)
+    form = {'version': '1', 'base_title': ticket.title, 'base_status': '新規', 'base_priority': '2',
+            'base_assignee_id': '0', 'base_due_date': '',
+            'title': 'Renamed inline', 'status': '対応中', 'priority': '2', 'assignee_id': '0', 'due_date': ''}
+
+    response = client.post(f'/ticket/{ticket.id}/edit', data=form, headers=FRAGMENT)
+    body = response.get_data(as_text=True)
+    assert response.status_code == 200
+    assert '<div id="ticketForm">' in body and 'name="version" value="2"' in body
+    assert f'<tr id="ticket-{ticket.id}">' in body and 'Renamed inline' in body
+    assert f"チケットID {ticket.id} を更新しました。" in body
+
+    # 同じ版数からの衝突はフォームだけを衝突の内容と合わせて返す
+    response = client.post(f'/ticket/{ticket.id}/edit', data={**form, 'status': '保留'}, headers=FRAGMENT)
+    body = response.get_data(as_text=True)
+    assert response.status_code == 409
+    assert "状態: あなたの入力「保留」/ 現在の値「対応中」" in body and f'id="ticket-{ticket.id}"' not in body
+
+
+def test_subticket_changes_return_subticket_section(logged_in_user, db):
+    user, client = logged_in_user
+    ticket = _create_ticket(db, user)
+
+    response = client.post(f'/subticket/add/{ticket.id}', data={'subticket_title': 'one\ntwo'}, headers=FRAGMENT)
+    body = response.get_data(as_text=True)
+    assert response.status_code == 200 and '<div id="subtickets"' in body
+    assert "2件のサブチケットをチケット「Fragment ticket」に追加しました。" in body
+    assert "サブチケット (0% 完了)" in body
+
+    one = SubTicket.query.filter_by(title='one').one()
+    response = client.post(f'/subticket/toggle/{one.id}', data={'version': '1'}, headers=FRAGMENT)
+    assert "サブチケット (50% 完了)" in response.get_data(as_text=True)
+
+    response = client.post(f'/ticket/{ticket.id}/subtickets/complete', data={'completed': '1'}, headers=FRAGMENT)
+    body = response.get_data(as_text=True)
+    assert "サブチケット (100% 完了)" in body and '<html' not in body
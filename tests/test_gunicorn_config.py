@@ -0,0 +1,66 @@
+import gc
+import importlib
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import text
+
+import app as app_module
+from sharding import ShardMap
+
+
+@pytest.fixture
+def config():
+    """gunicorn_config.py を読み込む (読み込むとGCが止まるため、終わったら元に戻す)"""
+    import gunicorn_config
+    yield importlib.reload(gunicorn_config)
+    gc.unfreeze()
+    gc.enable()
+
+
+def test_fork_hooks_freeze_gc_and_reset_pools(config, monkeypatch):
+    calls = []
+    monkeypatch.setattr(app_module, 'reset_connection_pools', lambda close=True: calls.append(close))
+    assert config.preload_app is True
+    assert not gc.isenabled()
+
+    # マスター: 接続を閉じ、読み込んだオブジェクトを凍結してからGCを戻す
+    config.when_ready(None)
+    assert calls == [True]
+    assert gc.isenabled()
+    assert gc.get_freeze_count() > 0
+
+    config.pre_fork(None, None)
+    # ワーカー: 親の接続には触れずにプールを作り直す
+    config.post_fork(None, None)
+    assert calls == [True, False]
+    assert gc.isenabled()
+
+
+def test_reset_pools_keeps_engines(tmp_path):
+    shards = ShardMap({'s1': f"sqlite:///{tmp_path / 's1.db'}"})
+    engine = shards.engine('s1')
+    with engine.connect() as conn:
+        conn.execute(text('SELECT 1'))
+    pool = engine.pool
+
+    shards.reset_pools(close=False)
+
+    assert shards.engine('s1') is engine
+    assert engine.pool is not pool
+    with engine.connect() as conn:
+        assert conn.scalar(text('SELECT 1')) == 1
+    shards.dispose()
+
+
+def test_multiple_workers_require_shared_login_throttle(config, monkeypatch):
+    """既定は1ワーカーで、ログイン試行の制限をワーカー間で共有していなければ複数ワーカーでは起動しないか"""
+    for name in ('WEB_CONCURRENCY', 'GUNICORN_THREADS', 'LOGIN_THROTTLE_STORAGE_URL', 'GUNICORN_ALLOW_PER_WORKER_STATE'):
+        monkeypatch.delenv(name, raising=False)
+    config = importlib.reload(config)
+    assert (config.workers, config.threads) == (1, 8)
+    config.check_shared_state(1, environ={})
+    config.check_shared_state(4, environ={'LOGIN_THROTTLE_STORAGE_URL': 'redis://cache:6379/0'})
+    config.check_shared_state(4, environ={'GUNICORN_ALLOW_PER_WORKER_STATE': '1'})
+    with pytest.raises(RuntimeError, match='LOGIN_THROTTLE_STORAGE_URL'):
+        config.on_starting(SimpleNamespace(cfg=SimpleNamespace(workers=4)))
@@ -0,0 +1,98 @@
+from contextlib import contextmanager
+
+import pytest
+import sqlalchemy as sa
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+
+import online_migrations as online
+from online_migrations import DryRun, PlanStep
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """25行の users だけを持つ一時ファイルのSQLite (アプリのデータベースとは別)"""
+    engine = sa.create_engine(f"sqlite:///{tmp_path / 'online.db'}")
+    with engine.begin() as connection:
+        connection.exec_driver_sql("CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR(80))")
+        connection.execute(sa.text("INSERT INTO users (id, username) VALUES (:id, :username)"),
+                           [{'id': i, 'username': f'user{i}'} for i in range(1, 26)])
+    yield engine
+    engine.dispose()
+
+
+@contextmanager
+def migration(engine):
+    """flask db upgrade と同じく、マイグレーション1つ分のトランザクションの中で op を使えるようにする"""
+    with engine.connect() as connection:
+        context = MigrationContext.configure(connection)
+        with context.begin_transaction(_per_migration=True), Operations.context(context):
+            yield
+
+
+def count_nulls(engine):
+    with engine.connect() as connection:
+        return connection.scalar(sa.text("SELECT count(*) FROM users WHERE timezone IS NULL"))
+
+
+def test_backfill_resumes_then_sets_constraint(engine):
+    with migration(engine):
+        online.add_column('users', sa.Column('timezone', sa.String(64), nullable=True))
+
+    def interrupt(message):
+        raise KeyboardInterrupt(message)
+
+    # 最初のチャンクをコミットした後に中断する
+    with pytest.raises(KeyboardInterrupt), migration(engine):
+        online.backfill('users', 'timezone', sa.literal('UTC'), batch_size=10, pause=0, log=interrupt, log_interval=0)
+    assert count_nulls(engine) == 15
+    with engine.connect() as connection:
+        progress = connection.execute(sa.select(online.progress_table)).one()
+    assert (progress.name, progress.last_key, progress.rows_done) == ('users.timezone', 10, 10)
+
+    messages = []
+    with migration(engine):
+        online.backfill('users', 'timezone', sa.literal('UTC'), batch_size=10, pause=0, log=messages.append)
+        online.set_not_null('users', 'timezone')
+        online.create_index('ix_users_timezone', 'users', ['timezone'])
+    assert messages[0] == "users.timezone: 前回の続き (id > 10) から再開します。"
+    assert messages[-1].startswith("users.timezone: 25行を埋めました")
+    assert count_nulls(engine) == 0
+
+    inspector = sa.inspect(engine)
+    assert 'online_migration_progress' not in inspector.get_table_names()
+    assert [column['nullable'] for column in inspector.get_columns('users') if column['name'] == 'timezone'] == [False]
+    assert 'ix_users_timezone' in [index['name'] for index in inspector.get_indexes('users')]
+
+
+def test_dry_run_estimates_without_changing_schema(engine):
+    with online.dry_run(engine) as plan, Operations.context(MigrationContext.configure(plan.connection)):
+        plan.revision = 'abc123 Add users.timezone'
+        online.add_column('users', sa.Column('timezone', sa.String(64), nullable=True))
+        online.backfill('users', 'timezone', sa.literal('UTC'), batch_size=10, pause=0)
+        online.set_not_null('users', 'timezone')
+        online.create_index('ix_users_timezone', 'users', ['timezone'])
+
+    executed = [step for step in plan.steps if not step.estimated]
+    estimated = [step.description for step in plan.steps if step.estimated]
+    assert executed[0].description.startswith('ALTER TABLE users ADD COLUMN timezone')
+    assert estimated[0] == "backfill users.timezone: 約25行を10行ずつ (3回コミット)"
+    assert estimated[-1] == "users: CREATE INDEX CONCURRENTLY ix_users_timezone (テーブルを2回読む)"
+    assert plan.report_lines()[0] == '[abc123 Add users.timezone]'
+    # 列の追加もロールバックされている
+    assert 'timezone' not in [column['name'] for column in sa.inspect(engine).get_columns('users')]
+
+
+def test_lock_holds_last_until_next_commit():
+    plan = DryRun(connection=None)
+    plan.steps = [
+        PlanStep('r1', 'ALTER TABLE users ...', [('users', 'AccessExclusiveLock')], 0.5, False),
+        PlanStep('r1', 'UPDATE users ...', [], 2.0, False),
+        # ヘルパーの手順の前にそれまでの変更をコミットするため、ロックはここで解放される
+        PlanStep('r1', 'backfill users.timezone', [('users', 'RowExclusiveLock')], 30.0, True),
+        PlanStep('r1', 'ALTER TABLE tickets ...', [('tickets', 'AccessExclusiveLock')], 0.1, False),
+        PlanStep('r2', 'SELECT 1', [], 5.0, False),
+    ]
+    assert sorted(plan.lock_holds()) == [('r1', 'tickets', 'AccessExclusiveLock', 0.1),
+                                         ('r1', 'users', 'AccessExclusiveLock', 2.5),
+                                         ('r1', 'users', 'RowExclusiveLock', 30.0)]
@@ -0,0 +1,183 @@
+import json
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from sqlalchemy import select
+from werkzeug.security import generate_password_hash
+
+from app import (User, Ticket, Organization, Role, OutboxEvent, WebhookSubscription, WebhookCursor,
+                 create_outbox_dispatcher)
+from outbox import ConnectionPool
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """受け取ったPOSTを記録し、server.statuses の先頭のステータス (なければ200) を返す"""
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.client_address, json.loads(body)))
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def webhook_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+    server.requests, server.statuses = [], []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/hooks"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_changes_write_outbox_events_in_same_commit(logged_in_user, db):
+    user, client = logged_in_user
+    client.post('/ticket/add', data={'title': 'Outbox Ticket', 'priority': 2, 'assignee_id': 0})
+    ticket = Ticket.query.filter_by(title='Outbox Ticket').one()
+    client.post(f'/ticket/{ticket.id}/edit', data={'title': 'Outbox Ticket', 'priority': 2, 'status': '対応中',
+                                                   'assignee_id': user.id})
+    client.post(f'/subticket/add/{ticket.id}', data={'subticket_title': 'step 1'})
+
+    events = db.session.scalars(select(OutboxEvent).where(OutboxEvent.organization_id == user.organization_id)
+                                .order_by(OutboxEvent.id)).all()
+    assert [event.event_type for event in events] == ['ticket.created', 'ticket.updated', 'subticket.created']
+    created, updated, subticket = events
+    assert created.aggregate_id == ticket.id and created.payload['data']['title'] == 'Outbox Ticket'
+    assert updated.payload['changes'] == {'status': ['新規', '対応中'], 'assignee_id': [None, user.id]}
+    assert subticket.payload['data']['ticket_id'] == ticket.id
+
+
+def _create_org_with_subscription(db, url, **options):
+    role = Role(name='admin')
+    org = Organization(name='OutboxOrg')
+    user = User(username='owner', password_hash=generate_password_hash('pw'), organization=org, role=role)
+    db.session.add_all([role, org, user])
+    db.session.flush()
+    subscription = WebhookSubscription(organization_id=org.id, url=url, **options)
+    db.session.add(subscription)
+    db.session.commit()
+    return org, user, subscription
+
+
+def _add_tickets(db, org, user, count):
+    db.session.add_all([Ticket(title=f'Ticket {i}', organization=org, requester=user) for i in range(count)])
+    db.session.commit()
+
+
+@pytest.mark.real_commits
+def test_dispatcher_batches_per_subscriber_and_reuses_connection(db, webhook_server):
+    org, user, subscription = _create_org_with_subscription(db, webhook_server.url)
+    # 購読しない種類のイベントは送らずに読み飛ばす
+    updates_only = WebhookSubscription(organization_id=org.id, url=webhook_server.url, event_types='ticket.updated')
+    db.session.add(updates_only)
+    db.session.commit()
+    _add_tickets(db, org, user, 3)
+
+    dispatcher = create_outbox_dispatcher(pool=ConnectionPool(timeout=5), batch_size=2, settle=timedelta(0))
+    try:
+        assert dispatcher.run_once() == 3
+        _add_tickets(db, org, user, 1)
+        assert dispatcher.run_once() == 1
+    finally:
+        dispatcher.close()
+
+    batches = [body['events'] for _, body in webhook_server.requests]
+    assert [len(events) for events in batches] == [2, 1, 1]
+    assert all(body['subscription_id'] == subscription.id for _, body in webhook_server.requests)
+    assert [event['type'] for events in batches for event in events] == ['ticket.created'] * 4
+    assert {event['shard'] for events in batches for event in events} == {'default'}
+    # 全てのPOSTを1本のkeep-aliveの接続で送る
+    assert dispatcher.pool.connections_opened == 1
+    assert len({address for address, _ in webhook_server.requests}) == 1
+
+    last_event_id = db.session.scalar(select(OutboxEvent.id).order_by(OutboxEvent.id.desc()).limit(1))
+    lags = {lag.subscription_id: lag for lag in dispatcher.lag()}
+    assert lags[subscription.id].pending == 0 and lags[subscription.id].last_event_id == last_event_id
+    assert lags[updates_only.id].pending == 0 and lags[updates_only.id].last_event_id == last_event_id
+
+
+@pytest.mark.real_commits
+def test_dispatcher_retries_failed_subscriber_with_backoff(db, webhook_server):
+    org, user, subscription = _create_org_with_subscription(db, webhook_server.url)
+    _add_tickets(db, org, user, 2)
+    webhook_server.statuses = [500]
+    now = [datetime.utcnow() + timedelta(seconds=1)]
+
+    dispatcher = create_outbox_dispatcher(pool=ConnectionPool(timeout=5), settle=timedelta(0),
+                                          backoff=lambda failures: 10 * failures, clock=lambda: now[0])
+    try:
+        assert dispatcher.run_once() == 0
+        cursor = db.session.get(WebhookCursor, (subscription.id, 'default'))
+        assert (cursor.last_event_id, cursor.failures, cursor.last_error) == (0, 1, 'HTTP 500')
+        assert cursor.next_attempt_at == now[0] + timedelta(seconds=10)
+        [lag] = dispatcher.lag()
+        assert (lag.pending, lag.failures) == (2, 1)
+
+        # バックオフ中は送らない
+        assert dispatcher.run_once() == 0
+        assert len(webhook_server.requests) == 1
+
+        now[0] += timedelta(seconds=11)
+        assert dispatcher.run_once() == 2
+    finally:
+        dispatcher.close()
+
+    db.session.expire_all()
+    cursor = db.session.get(WebhookCursor, (subscription.id, 'default'))
+    assert (cursor.failures, cursor.next_attempt_at, cursor.last_error) == (0, None, None)
+    assert cursor.last_delivered_at == now[0]
+    # 失敗したバッチと同じイベントを送り直す
+    assert webhook_server.requests[0][1] == webhook_server.requests[1][1]
+
+
+@pytest.mark.real_commits
+def test_dispatcher_delivers_events_committed_after_cursor_passed(db, webhook_server):
+    org, user, subscription = _create_org_with_subscription(db, webhook_server.url)
+    _add_tickets(db, org, user, 1)
+    first_id = db.session.scalar(select(OutboxEvent.id).order_by(OutboxEvent.id.desc()).limit(1))
+
+    def add_event(event_id):
+        db.session.add(OutboxEvent(id=event_id, organization_id=org.id, event_type='ticket.updated',
+                                   aggregate_id=1, payload={}))
+        db.session.commit()
+
+    # first_id + 1 と first_id + 3 を採番したトランザクションがまだコミットされていない
+    add_event(first_id + 2)
+    now = [datetime.utcnow() + timedelta(seconds=1)]
+    dispatcher = create_outbox_dispatcher(pool=ConnectionPool(timeout=5), settle=timedelta(0),
+                                          gap_timeout=timedelta(minutes=10), clock=lambda: now[0])
+    try:
+        assert dispatcher.run_once() == 2
+        cursor = db.session.get(WebhookCursor, (subscription.id, 'default'))
+        assert cursor.last_event_id == first_id + 2
+        assert sorted(cursor.pending_gaps) == [str(first_id + 1)]
+
+        add_event(first_id + 1)
+        add_event(first_id + 3)
+        assert dispatcher.run_once() == 2
+        db.session.expire_all()
+        cursor = db.session.get(WebhookCursor, (subscription.id, 'default'))
+        assert (cursor.last_event_id, cursor.pending_gaps) == (first_id + 3, None)
+
+        # gap_timeout を過ぎても現れない欠番はロールバックされたものとみなす
+        add_event(first_id + 5)
+        assert dispatcher.run_once() == 1
+        now[0] += timedelta(minutes=11)
+        assert dispatcher.run_once() == 0
+    finally:
+        dispatcher.close()
+
+    db.session.expire_all()
+    assert db.session.get(WebhookCursor, (subscription.id, 'default')).pending_gaps is None
+    delivered = [event['id'] for _, body in webhook_server.requests for event in body['events']]
+    assert delivered == [first_id, first_id + 2, first_id + 1, first_id + 3, first_id + 5]
@@ -0,0 +1,101 @@
+import json
+import os
+
+import pytest
+
+from app import request_profiler
+
+
+@pytest.fixture
+def profiler(tmp_path, monkeypatch):
+    monkeypatch.setattr(request_profiler, 'output_dir', str(tmp_path))
+    monkeypatch.setattr(request_profiler, 'interval', 0.001)
+    return request_profiler
+
+
+def read_profiles(directory):
+    request_profiler.flush()
+    names = sorted(os.path.splitext(name)[0] for name in os.listdir(directory) if name.endswith('.json'))
+    profiles = []
+    for name in names:
+        with open(os.path.join(directory, f'{name}.json'), encoding='utf-8') as f:
+            profiles.append(json.load(f))
+    return names, profiles
+
+
+def test_inactive_profiler_writes_nothing(profiler, logged_in_user):
+    """設定もヘッダーもなければプロファイルされないか"""
+    _, client = logged_in_user
+    assert client.get('/').status_code == 200
+    profiler.flush()
+    assert os.listdir(profiler.output_dir) == []
+
+
+def test_endpoint_profile_includes_sql_and_render_timeline(profiler, logged_in_user, monkeypatch):
+    """エンドポイント指定でダッシュボードがプロファイルされ、SQLと描画が記録されるか"""
+    monkeypatch.setattr(profiler, 'endpoints', {'index'})
+    _, client = logged_in_user
+    assert client.get('/').status_code == 200
+
+    names, profiles = read_profiles(profiler.output_dir)
+    assert len(profiles) == 1
+    profile = profiles[0]
+    assert profile['endpoint'] == 'index' and profile['trigger'] == 'endpoint'
+    assert profile['status_code'] == 200
+    kinds = {item['kind'] for item in profile['timeline']}
+    assert kinds == {'sql', 'render'}
+    assert any('FROM tickets' in item['detail'] for item in profile['timeline'] if item['kind'] == 'sql')
+    assert os.path.exists(os.path.join(profiler.output_dir, f'{names[0]}.folded'))
+
+
+def test_profile_header_only_for_admins(profiler, logged_in_user):
+    """X-Profile-Request ヘッダーは管理者のリクエストにだけ効くか"""
+    _, client = logged_in_user
+    client.get('/', headers={'X-Profile-Request': '1'})
+    client.get('/logout')
+    assert client.get('/login', headers={'X-Profile-Request': '1'}).status_code == 200
+
+    _, profiles = read_profiles(profiler.output_dir)
+    assert [profile['trigger'] for profile in profiles] == ['header']
+
+
+def test_retention_limit(profiler, logged_in_user, monkeypatch):
+    """保存件数の上限を超えた古いプロファイルが削除されるか"""
+    monkeypatch.setattr(profiler, 'sample_rate', 1.0)
+    monkeypatch.setattr(profiler, 'max_files', 2)
+    _, client = logged_in_user
+    for _ in range(4):
+        client.get('/')
+    profiler.flush()
+    assert len(os.listdir(profiler.output_dir)) == 4  # 2件 × (.folded + .json)
+
+
+class RecordingExecutor:
+    """裏のスレッドで実行する代わりに、投入された書き出しを記録する"""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, func, *args):
+        self.submitted.append((func, args))
+
+    def run_all(self):
+        for func, args in self.submitted:
+            func(*args)
+        self.submitted.clear()
+
+
+def test_profile_written_after_request(profiler, logged_in_user, monkeypatch):
+    """プロファイルのファイルは応答の前ではなく、投入した書き出しの中で書き出すか"""
+    executor = RecordingExecutor()
+    monkeypatch.setattr(profiler, 'executor', executor)
+    monkeypatch.setattr(profiler, 'endpoints', {'index'})
+    _, client = logged_in_user
+    assert client.get('/').status_code == 200
+    assert len(executor.submitted) == 1 and os.listdir(profiler.output_dir) == []
+
+    executor.run_all()
+    json_files = [name for name in os.listdir(profiler.output_dir) if name.endswith('.json')]
+    with open(os.path.join(profiler.output_dir, json_files[0]), encoding='utf-8') as f:
+        profile = json.load(f)
+    assert (profile['method'], profile['path'], profile['endpoint']) == ('GET', '/', 'index')
@@ -0,0 +1,78 @@
+from datetime import date
+
+from sqlalchemy.dialects import sqlite
+from werkzeug.security import generate_password_hash
+
+from app import User, Ticket, build_queue_query
+
+
+def _create_ticket(db, user, title, **columns):
+    ticket = Ticket(title=title, requester_id=user.id, organization_id=user.organization_id, **columns)
+    db.session.add(ticket)
+    db.session.commit()
+    return ticket.id
+
+
+def test_queue_order_and_keyset_pagination(logged_in_user, db):
+    """自分の未解決のチケットが優先度・期限日・古い順に並び、cursor で次のページへ進めるか"""
+    user, client = logged_in_user
+    other = User(username='other', password_hash=generate_password_hash('pw'),
+                 organization_id=user.organization_id, role_id=user.role_id)
+    db.session.add(other)
+    db.session.commit()
+
+    mine = {'assignee_id': user.id}
+    low = _create_ticket(db, user, 'low', priority=1, **mine)
+    high_no_due = _create_ticket(db, user, 'high, no due', priority=3, **mine)
+    high_later = _create_ticket(db, user, 'high, later', priority=3, due_date=date(2026, 3, 1), **mine)
+    high_sooner = _create_ticket(db, user, 'high, sooner', priority=3, due_date=date(2026, 2, 1), **mine)
+    high_sooner_newer = _create_ticket(db, user, 'high, sooner (newer)', priority=3, due_date=date(2026, 2, 1), **mine)
+    medium_no_due = _create_ticket(db, user, 'medium, no due', priority=2, **mine)
+    medium_no_due_newer = _create_ticket(db, user, 'medium, no due (newer)', priority=2, **mine)
+    _create_ticket(db, user, 'resolved', priority=3, status='解決済み', **mine)
+    _create_ticket(db, user, 'unassigned', priority=3)
+    _create_ticket(db, user, 'someone else', priority=3, assignee_id=other.id)
+
+    ids, cursor, pages = [], None, 0
+    while True:
+        response = client.get('/api/queue', query_string={'limit': 2, **({'cursor': cursor} if cursor else {})})
+        assert response.status_code == 200
+        payload = response.get_json()
+        ids += [ticket['id'] for ticket in payload['tickets']]
+        cursor, pages = payload['next_cursor'], pages + 1
+        if cursor is None:
+            break
+    assert ids == [high_sooner, high_sooner_newer, high_later, high_no_due, medium_no_due, medium_no_due_newer, low]
+    assert pages == 4
+
+    response = client.get('/queue')
+    assert response.status_code == 200
+    assert 'high, sooner' in response.data.decode('utf-8')
+    assert client.get('/api/queue?cursor=broken').status_code == 400
+
+
+def test_claim_next_ticket(logged_in_user, db):
+    """未割り当てのチケットを優先度の高い順に1件ずつ自分に割り当て、なくなれば404を返すか"""
+    user, client = logged_in_user
+    low = _create_ticket(db, user, 'low', priority=1)
+    high = _create_ticket(db, user, 'high', priority=3)
+    _create_ticket(db, user, 'closed', priority=3, status='クローズ')
+
+    first = client.post('/api/queue/claim').get_json()
+    second = client.post('/api/queue/claim').get_json()
+    assert (first['ticket']['id'], second['ticket']['id']) == (high, low)
+    assert first['ticket']['assignee'] == user.username
+    assert db.session.get(Ticket, low).assignee_id == user.id
+
+    response = client.post('/api/queue/claim')
+    assert response.status_code == 404
+    assert response.get_json()['status'] == 'empty'
+
+
+def test_queue_query_uses_partial_index(db):
+    """キューのクエリが部分インデックスを使うか (SQLiteの実行計画で確認する)"""
+    if db.engine.dialect.name != 'sqlite':
+        return
+    compiled = build_queue_query(1, 1).compile(dialect=sqlite.dialect(), compile_kwargs={'literal_binds': True})
+    plan = ' '.join(str(row[-1]) for row in db.session.execute(db.text(f'EXPLAIN QUERY PLAN {compiled}')))
+    assert 'ix_tickets_open_queue' in plan
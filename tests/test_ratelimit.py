@@ -0,0 +1,64 @@
+import app as app_module
+from ratelimit import LoginThrottle
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ip_bucket_refills_over_time():
+    """IPごとのバケットを使い切ると拒否され、時間経過で回復するか"""
+    clock = FakeClock()
+    throttle = LoginThrottle(limits={'ip': (3, 30)}, clock=clock)
+    assert all(throttle.check('10.0.0.1', f'user{i}', 'Org').allowed for i in range(3))
+
+    decision = throttle.check('10.0.0.1', 'user9', 'Org')
+    assert not decision.allowed
+    assert decision.reason == 'ip'
+    assert decision.retry_after == 10
+    # 別のIPは影響を受けない
+    assert throttle.check('10.0.0.2', 'user9', 'Org').allowed
+
+    clock.now += 10
+    assert throttle.check('10.0.0.1', 'user9', 'Org').allowed
+    assert throttle.metrics['rejected_ip'] == 1
+
+
+def test_progressive_lockout_and_reset_on_success():
+    """連続失敗でロックアウトが倍々に伸び、成功でリセットされるか"""
+    clock = FakeClock()
+    throttle = LoginThrottle(failure_threshold=3, base_delay=2, clock=clock)
+    for _ in range(2):
+        throttle.record_failure('alice', 'Org')
+    assert throttle.check('1.1.1.1', 'alice', 'Org').allowed
+
+    throttle.record_failure('alice', 'Org')  # 3回目: 2秒
+    assert throttle.check('1.1.1.1', 'alice', 'Org').reason == 'lockout'
+    clock.now += 2
+    throttle.record_failure('alice', 'Org')  # 4回目: 4秒
+    assert throttle.check('1.1.1.1', 'alice', 'Org').retry_after == 4
+
+    clock.now += 4
+    throttle.record_success('alice', 'Org')
+    throttle.record_failure('alice', 'Org')
+    assert throttle.check('1.1.1.1', 'alice', 'Org').allowed
+
+
+def test_login_rejected_before_password_check(client, db, monkeypatch):
+    """ロックアウト中のログインは、DB参照やハッシュ検証の前に429で拒否されるか"""
+    for _ in range(app_module.login_throttle.failure_threshold):
+        client.post('/login', data={'organization_name': 'NoSuchOrg', 'username': 'u', 'password': 'x'})
+
+    def fail_if_called(*args, **kwargs):
+        raise AssertionError("ロックアウト中にパスワードハッシュが検証されました")
+    monkeypatch.setattr(app_module, 'check_password_hash', fail_if_called)
+
+    response = client.post('/login', data={'organization_name': 'NoSuchOrg', 'username': 'u', 'password': 'x'})
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+    assert "ログイン試行が多すぎます。".encode('utf-8') in response.data
+    assert app_module.login_throttle.metrics['rejected_lockout'] == 1
@@ -0,0 +1,170 @@
+import pytest
+from flask import g
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+
+import app as app_module
+from app import dashboard_breaker, dashboard_cache, session_user_cache, shard_directory
+from resilience import CircuitBreaker, CircuitOpen, StaleCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RecordingExecutor:
+    """裏のスレッドで実行する代わりに、投入された読み直しを記録する"""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, func, *args):
+        self.submitted.append((func, args))
+
+    def run_all(self):
+        for func, args in self.submitted:
+            func(*args)
+        self.submitted.clear()
+
+
+def _fail():
+    raise ConnectionError("db down")
+
+
+def test_circuit_breaker_opens_and_recovers_through_half_open():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, failure_types=(ConnectionError,), clock=clock)
+
+    # 失敗として数えない例外では開かない
+    with pytest.raises(ValueError):
+        breaker.call(int, 'x')
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            breaker.call(_fail)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    calls = []
+    with pytest.raises(CircuitOpen) as excinfo:
+        breaker.call(calls.append, 1)
+    assert calls == [] and excinfo.value.retry_after == 30
+
+    # 時間が過ぎたら試しの1件だけを通し、失敗すればまた開く
+    clock.now += 30
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(ConnectionError):
+        breaker.call(_fail)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    clock.now += 30
+    assert breaker.call(lambda: 'ok') == 'ok'
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.snapshot() == {'state': 'closed', 'failures': 3, 'rejected': 1, 'opened': 2,
+                                  'successes': 1, 'closed': 1}
+
+
+def test_stale_cache_serves_last_good_value_and_refreshes_once():
+    executor = RecordingExecutor()
+    cache = StaleCache(max_entries=2, executor=executor, clock=FakeClock())
+
+    assert cache.serve('a', lambda: 1) == (1, False, 1000.0)
+    # 保持している値がなければ例外をそのまま送出する
+    with pytest.raises(ConnectionError):
+        cache.serve('b', _fail, failure_types=(ConnectionError,))
+    # 失敗として数えない例外は古い値で隠さない
+    with pytest.raises(ValueError):
+        cache.serve('a', lambda: int('x'), failure_types=(ConnectionError,))
+
+    for _ in range(2):
+        assert cache.serve('a', _fail, refresh=lambda: 2, failure_types=(ConnectionError,)) == (1, True, 1000.0)
+    assert len(executor.submitted) == 1  # 読み直し中の同じキーは重ねて投入しない
+    executor.run_all()
+    assert cache.get('a') == (2, 1000.0)
+
+    cache.put('b', 1)
+    cache.put('c', 1)
+    assert cache.get('a') is None  # 件数の上限を超えたら、最も使われていないキーから捨てる
+    assert cache.snapshot() == {'entries': 2, 'refreshing': 0, 'fresh': 1, 'unavailable': 1, 'stale': 2,
+                                'refreshes': 1}
+
+
+def test_dashboard_serves_stale_rows_while_database_is_unavailable(seeded_client, seeded_data, monkeypatch):
+    executor = RecordingExecutor()
+    monkeypatch.setattr(dashboard_cache, 'executor', executor)
+    monkeypatch.setattr(dashboard_breaker, 'failure_threshold', 2)
+
+    body = seeded_client.get('/?sort_by=due_date').get_data(as_text=True)
+    assert 'Seeded ticket 24' in body and 'staleNotice' not in body
+
+    queries = []
+
+    def timed_out(*args, **kwargs):
+        queries.append(args)
+        raise OperationalError('SELECT ...', {}, Exception('canceling statement due to statement timeout'))
+
+    monkeypatch.setattr(app_module, 'build_ticket_list_query', timed_out)
+
+    for _ in range(3):
+        response = seeded_client.get('/?sort_by=due_date')
+        body = response.get_data(as_text=True)
+        assert response.status_code == 200
+        assert 'id="staleNotice"' in body and 'Seeded ticket 24' in body
+        assert 'チケットの読み込み中にエラー' not in body
+    # 2回の失敗で回路が開き、3回目はDBに問い合わせない
+    assert len(queries) == 2
+    assert dashboard_breaker.state == 'open'
+    assert len(executor.submitted) == 1
+
+    # 読めたことのない条件は、従来どおりエラーを表示して空の一覧にする
+    body = seeded_client.get('/?sort_by=priority').get_data(as_text=True)
+    assert 'チケットの読み込み中にエラー' in body and 'Seeded ticket 24' not in body
+
+    metrics = seeded_client.get('/admin/metrics/dashboard').get_json()
+    assert metrics['breaker']['state'] == 'open' and metrics['breaker']['rejected'] == 2
+    assert metrics['stale_cache'] == {'entries': 1, 'refreshing': 1, 'fresh': 1, 'stale': 3, 'unavailable': 1,
+                                      'refreshes': 1}
+
+
+def test_dashboard_keeps_session_user_while_every_query_fails(seeded_client, seeded_data, monkeypatch):
+    executor = RecordingExecutor()
+    monkeypatch.setattr(dashboard_cache, 'executor', executor)
+    monkeypatch.setattr(session_user_cache, 'executor', executor)
+    monkeypatch.setattr(dashboard_breaker, 'failure_threshold', 2)
+
+    def get_dashboard():
+        g.pop('_login_user', None)  # リクエストごとにセッションのユーザーを読み込ませる
+        return seeded_client.get('/?sort_by=due_date')
+
+    assert 'Seeded ticket 24' in get_dashboard().get_data(as_text=True)
+
+    queries = []
+
+    def unavailable(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            queries.append(statement)
+            raise OperationalError(statement, parameters, Exception('server closed the connection unexpectedly'))
+
+    # ユーザー・組織・シャードディレクトリの読み込みも含め、全てのSELECTを失敗させる
+    shard_directory.invalidate()
+    event.listen(Engine, 'before_cursor_execute', unavailable)
+    try:
+        for _ in range(3):
+            response = get_dashboard()
+            body = response.get_data(as_text=True)
+            assert response.status_code == 200
+            assert 'id="staleNotice"' in body and 'Seeded ticket 24' in body
+            assert 'ようこそ, alice さん (admin)' in body and 'SeededReadOnlyOrg' in body
+        # ユーザーの読み込みとダッシュボードで2回失敗して回路が開き、その後はDBに問い合わせない
+        assert len(queries) == 2
+        assert dashboard_breaker.state == 'open'
+
+        # 読めたことのないセッションはDBを待たずに 503 にする
+        session_user_cache.reset()
+        assert get_dashboard().status_code == 503
+        assert len(queries) == 2
+    finally:
+        event.remove(Engine, 'before_cursor_execute', unavailable)
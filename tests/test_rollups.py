@@ -0,0 +1,95 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+from app import User, Ticket, Organization, Role, TicketDailyStat
+from rollups import aggregate_daily
+
+
+def test_aggregate_daily_counts():
+    """作成・解決・期限切れの件数が日ごと・担当者ごとに集計されるか"""
+    rows = aggregate_daily(
+        [1, 1, 1], [None, 5, 5],
+        [datetime(2026, 1, 1, 10), datetime(2026, 1, 2, 9), datetime(2026, 1, 1, 1)],
+        [None, datetime(2026, 1, 5, 3), None],
+        [date(2026, 1, 2), date(2026, 1, 2), None],
+        date(2026, 1, 1), date(2026, 1, 6)
+    )
+    by_key = {(assignee, day.day): (created, resolved, overdue) for _, assignee, day, created, resolved, overdue in rows}
+    # 未割り当て: 1日に作成、期限2日のまま未解決 → 3日以降は期限切れ
+    assert by_key[(0, 1)] == (1, 0, 0)
+    assert [by_key[(0, d)][2] for d in (3, 4, 5, 6)] == [1, 1, 1, 1]
+    # 担当者5: 1日と2日に1件ずつ作成、期限2日のチケットは5日に解決
+    assert by_key[(5, 2)] == (1, 0, 0)
+    assert by_key[(5, 3)][2] == 1 and by_key[(5, 4)][2] == 1
+    assert by_key[(5, 5)] == (0, 1, 0)
+    assert (5, 6) not in by_key
+
+
+def test_resolved_at_follows_status(logged_in_user, db):
+    """ステータスを解決済みにすると resolved_at が設定され、戻すと解除されるか"""
+    user, client = logged_in_user
+    ticket = Ticket(title='Resolve me', requester_id=user.id, organization_id=user.organization_id)
+    db.session.add(ticket)
+    db.session.commit()
+    assert ticket.resolved_at is None
+
+    form = {'title': 'Resolve me', 'priority': 2, 'assignee_id': 0, 'due_date': ''}
+    client.post(f'/ticket/{ticket.id}/edit', data=dict(form, status='解決済み'))
+    db.session.refresh(ticket)
+    resolved_at = ticket.resolved_at
+    assert resolved_at is not None
+
+    client.post(f'/ticket/{ticket.id}/edit', data=dict(form, status='クローズ'))
+    db.session.refresh(ticket)
+    assert ticket.resolved_at == resolved_at  # 解決済み → クローズでは変わらない
+
+    client.post(f'/ticket/{ticket.id}/edit', data=dict(form, status='対応中'))
+    db.session.refresh(ticket)
+    assert ticket.resolved_at is None
+
+
+@pytest.mark.real_commits
+def test_rollup_command_and_trend_api(client, db, runner):
+    """rollup-stats で集計した値が推移・担当者別のAPIで返され、定期実行で更新されるか"""
+    today = datetime.utcnow().date()
+    now = datetime.combine(today, datetime.min.time()) + timedelta(hours=1)
+    role = Role(name='admin')
+    org = Organization(name='StatsOrg')
+    alice = User(username='alice', password_hash=generate_password_hash('pw'), organization=org, role=role)
+    late = Ticket(title='late', requester=alice, assignee=alice, organization=org, status='対応中',
+                  created_at=now - timedelta(days=5), due_date=today - timedelta(days=3))
+    done = Ticket(title='done', requester=alice, assignee=alice, organization=org,
+                  created_at=now - timedelta(days=4))
+    db.session.add_all([org, alice, late, done,
+                        Ticket(title='new', requester=alice, organization=org, created_at=now)])
+    db.session.commit()
+    done.status = '解決済み'
+    done.resolved_at = now - timedelta(days=2)
+    db.session.commit()
+
+    result = runner.invoke(args=['rollup-stats', '--backfill'])
+    assert result.exit_code == 0, result.output
+    assert TicketDailyStat.query.filter_by(organization_id=org.id).count() > 0
+
+    client.post('/login', data={'organization_name': 'StatsOrg', 'username': 'alice', 'password': 'pw'})
+    trend = client.get('/api/stats/trend?days=6').get_json()
+    assert trend['days'][0] == (today - timedelta(days=5)).isoformat() and trend['days'][-1] == today.isoformat()
+    assert trend['created'] == [1, 1, 0, 0, 0, 1]
+    assert trend['resolved'] == [0, 0, 0, 1, 0, 0]
+    assert trend['overdue'] == [0, 0, 0, 1, 1, 1]
+
+    assignees = client.get('/api/stats/assignees?days=6').get_json()['assignees']
+    assert assignees == [
+        {'assignee_id': alice.id, 'username': 'alice', 'created': 2, 'resolved': 1, 'overdue': 1},
+        {'assignee_id': None, 'username': None, 'created': 1, 'resolved': 0, 'overdue': 0},
+    ]
+
+    # 期限切れのチケットを今日解決し、定期ジョブ (直近2日分) で反映する
+    client.post(f'/ticket/{late.id}/edit', data={'title': 'late', 'priority': 2, 'assignee_id': alice.id,
+                                                 'due_date': late.due_date.isoformat(), 'status': '解決済み'})
+    assert runner.invoke(args=['rollup-stats']).exit_code == 0
+    trend = client.get('/api/stats/trend?days=6').get_json()
+    assert trend['resolved'][-1] == 1
+    assert trend['overdue'] == [0, 0, 0, 1, 1, 0]
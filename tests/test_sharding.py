@@ -0,0 +1,132 @@
+import pytest
+from flask import g
+from sqlalchemy import func, select
+from werkzeug.security import generate_password_hash
+
+from app import (User, Ticket, SubTicket, Organization, OrganizationShard, Role, db as app_db,
+                 parse_user_id, shard_directory)
+
+# シャードのエンジンやCLIコマンドはテストのトランザクションの外で接続するため、実際にコミットする
+pytestmark = pytest.mark.real_commits
+
+
+def count_rows(engine, table, **filters):
+    with engine.connect() as conn:
+        return conn.scalar(select(func.count()).select_from(table).filter_by(**filters))
+
+
+def create_org_with_data(db, name):
+    role = Role.query.filter_by(name='admin').first() or Role(name='admin')
+    org = Organization(name=name)
+    user = User(username='owner', password_hash=generate_password_hash('pw'), organization=org, role=role)
+    ticket = Ticket(title='Sharded Ticket', requester=user, assignee=user, organization=org)
+    ticket.subtickets = [SubTicket(title='step 1'), SubTicket(title='step 2')]
+    db.session.add_all([org, user, ticket])
+    db.session.commit()
+    db.session.add(SubTicket(title='step 1.1', ticket_id=ticket.id, parent_id=ticket.subtickets[0].id))
+    db.session.commit()
+    return org
+
+
+def test_parse_user_id():
+    """組織ID・シャード付きのユーザーIDと、従来形式のユーザーIDを分解できるか"""
+    assert parse_user_id('3:42@shard2') == (3, 42, 'shard2')
+    assert parse_user_id('3:42') == (3, 42, None)
+    assert parse_user_id('42') == (None, 42, None)
+
+
+def test_tenant_queries_routed_to_org_shard(client, db, shard, app, monkeypatch):
+    """新しい組織がシャードに配置され、そのユーザー・チケットがシャードに書き込まれるか"""
+    monkeypatch.setitem(app.config, 'NEW_ORGANIZATION_SHARD', 'test_shard')
+    client.post('/signup', data={'organization_name': 'ShardedOrg', 'username': 'sharduser', 'password': 'pw'})
+    org = Organization.query.filter_by(name='ShardedOrg').one()
+    assert app_db.session.get(OrganizationShard, org.id).shard_key == 'test_shard'
+    assert count_rows(shard, User.__table__, username='sharduser') == 1
+    assert count_rows(app_db.engine, User.__table__, username='sharduser') == 0
+
+    response = client.post('/login', data={'organization_name': 'ShardedOrg', 'username': 'sharduser',
+                                           'password': 'pw'}, follow_redirects=True)
+    assert "ログインしました。".encode('utf-8') in response.data
+    client.post('/ticket/add', data={'title': 'Lives On Shard'}, follow_redirects=True)
+
+    assert count_rows(shard, Ticket.__table__, title='Lives On Shard') == 1
+    assert count_rows(app_db.engine, Ticket.__table__, title='Lives On Shard') == 0
+
+
+def test_move_org_command(client, db, runner, shard):
+    """move-org コマンドで組織のデータが移動先へコピーされ、切り替わるか"""
+    org = create_org_with_data(db, 'MovingOrg')
+    org_id = org.id
+
+    result = runner.invoke(args=['move-org', 'MovingOrg', 'test_shard', '--drain-seconds', '0'])
+    assert result.exit_code == 0, result.output
+
+    assert app_db.session.get(OrganizationShard, org_id).shard_key == 'test_shard'
+    assert count_rows(shard, User.__table__, organization_id=org_id) == 1
+    assert count_rows(shard, SubTicket.__table__) == 3
+    assert count_rows(app_db.engine, Ticket.__table__, organization_id=org_id) == 0
+    assert count_rows(app_db.engine, SubTicket.__table__) == 0
+
+    # 外部キーは移動先で採番されたIDに付け替えられている
+    with shard.connect() as conn:
+        ticket = conn.execute(select(Ticket.__table__)).mappings().one()
+        user_id = conn.scalar(select(User.__table__.c.id))
+        assert ticket['requester_id'] == ticket['assignee_id'] == user_id
+        assert set(conn.scalars(select(SubTicket.__table__.c.ticket_id))) == {ticket['id']}
+        parents = dict(conn.execute(select(SubTicket.__table__.c.title, SubTicket.__table__.c.parent_id)).all())
+        step1_id = conn.scalar(select(SubTicket.__table__.c.id).where(SubTicket.__table__.c.title == 'step 1'))
+        assert parents == {'step 1': None, 'step 2': None, 'step 1.1': step1_id}
+
+    shard_directory.invalidate()
+    response = client.post('/login', data={'organization_name': 'MovingOrg', 'username': 'owner',
+                                           'password': 'pw'}, follow_redirects=True)
+    assert "ログインしました。".encode('utf-8') in response.data
+    assert b'Sharded Ticket' in response.data
+
+
+def test_move_org_invalidates_sessions(client, db, runner, shard):
+    """組織を移動すると、移動前のセッションは (採番し直したIDの) 他の組織のユーザーにならないか"""
+    role = Role.query.filter_by(name='admin').first() or Role(name='admin')
+    victim_org = Organization(name='VictimOrg')
+    victim = User(username='victim', password_hash='x', organization=victim_org, role=role)
+    db.session.add_all([role, victim_org, victim])
+    db.session.commit()
+    # 被害者の組織をシャードに置き、シャード上のユーザーID 1 にする
+    runner.invoke(args=['move-org', 'VictimOrg', 'test_shard', '--drain-seconds', '0'])
+    db.session.expunge(victim)  # 移動元からは削除され、既定のデータベースのID 1 は次の組織のユーザーが使う
+    attacker_org = create_org_with_data(db, 'AttackerOrg')
+    client.post('/login', data={'organization_name': 'AttackerOrg', 'username': 'owner', 'password': 'pw'})
+    with client.session_transaction() as flask_session:
+        assert flask_session['_user_id'] == f'{attacker_org.id}:1@default'
+    assert count_rows(shard, User.__table__, id=1, username='victim') == 1
+
+    # シャードを含まない従来の形式のセッションは、組織が既定のデータベースにある間はそのまま使える
+    for legacy_user_id in (f'{attacker_org.id}:1', '1'):
+        with client.session_transaction() as flask_session:
+            flask_session['_user_id'] = legacy_user_id
+        g.pop('_login_user', None)  # テストのアプリケーションコンテキストに残ったログイン中のユーザーを捨てる
+        assert client.get('/').status_code == 200
+
+    result = runner.invoke(args=['move-org', 'AttackerOrg', 'test_shard', '--drain-seconds', '0'])
+    assert result.exit_code == 0, result.output
+    shard_directory.invalidate()
+
+    # 移動前のセッションも、シャードを書き換えたセッションも、他の組織のユーザーにはならない
+    stale_user_ids = [f'{attacker_org.id}:1@default', f'{attacker_org.id}:1', '1', f'{attacker_org.id}:1@test_shard']
+    for stale_user_id in stale_user_ids:
+        with client.session_transaction() as flask_session:
+            flask_session['_user_id'] = stale_user_id
+        g.pop('_login_user', None)
+        response = client.get('/')
+        assert response.status_code == 302 and '/login' in response.headers['Location']
+
+
+def test_writes_rejected_while_moving(logged_in_user, db):
+    """移動中 (読み取り専用) の組織への書き込みは503になるか"""
+    user, client = logged_in_user
+    db.session.add(OrganizationShard(organization_id=user.organization_id, read_only=True))
+    db.session.commit()
+    shard_directory.invalidate()
+
+    assert client.post('/ticket/add', data={'title': 'Blocked'}).status_code == 503
+    assert client.get('/').status_code == 200
@@ -0,0 +1,128 @@
+from app import Ticket
+from similarity import SimilarTicketIndex, TitleIndex
+
+FRAGMENT = {'X-Fragment': '1'}
+
+
+def test_title_index_finds_japanese_near_duplicates():
+    index = TitleIndex()
+    index.add_many([(1, 'ログインできない'), (2, '請求書のPDFがダウンロードできない'),
+                    (3, 'Login page returns 500 error'), (4, 'メール通知が届かない'), (5, '')])
+    assert len(index) == 4  # 2-gramのないタイトルは索引に入れない
+
+    # 全角・半角と大文字・小文字の違いは無視する
+    assert [(t.id, t.similarity) for t in index.similar('ﾛｸﾞｲﾝできない')] == [(1, 1.0)]
+    assert [t.id for t in index.similar('請求書PDFをダウンロードできません')] == [2]
+    assert [t.id for t in index.similar('LOGIN page returns error 500')] == [3]
+    assert index.similar('プリンターが壊れた') == []
+    assert index.similar('ログインできない', exclude=1) == []
+
+    # タイトルの変更・削除は索引の行を入れ替える (空いた行は次の追加で使う)
+    index.add(1, 'プリンターが動かない')
+    assert index.similar('ログインできない') == [] and [t.id for t in index.similar('プリンターが壊れた')] == [1]
+    index.remove(4)
+    index.add(6, 'メール通知が届かない')
+    assert [t.id for t in index.similar('メール通知が届かない')] == [6] and len(index) == 4
+
+    # 追加が一定数を超えると並べ直す。並べた後の追加・削除も同じように引ける
+    index.add_many((100 + i, f'定例作業 {i:04d}') for i in range(300))
+    index.add(7, '通知メールが届きません')
+    index.remove(6)
+    assert [t.id for t in index.similar('通知メールが届かない')] == [7]
+    assert [t.id for t in index.similar('ログインできない')] == []
+    assert len(index.similar('定例作業 0123', limit=3)) == 3
+
+
+class RecordingExecutor:
+    """裏のスレッドで実行する代わりに、投入された索引の読み込みを記録する"""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, func, *args):
+        self.submitted.append((func, args))
+
+    def run_all(self):
+        for func, args in self.submitted:
+            func(*args)
+        self.submitted.clear()
+
+
+def test_similar_ticket_index_loads_organizations_lazily_and_applies_changes():
+    now = [0.0]
+    loads = []
+
+    def loader(organization_id):
+        loads.append(organization_id)
+        return [(1, 'ログインできない')] if organization_id == 1 else []
+
+    index = SimilarTicketIndex(loader, reconcile_interval=60, clock=lambda: now[0])
+    assert [t.id for t in index.similar(1, 'ログインできません')] == [1]
+    # 読み込んでいない組織への変更は、最初に使われたときの読み込みに任せる
+    index.apply({(1, 2): 'ログインできません', (1, 1): None, (2, 3): 'ログインできません'})
+    assert [t.id for t in index.similar(1, 'ログインできません')] == [2]
+    assert loads == [1]
+
+
+def test_similar_ticket_index_rebuilds_in_background_once_per_organization():
+    now = [0.0]
+    loads = []
+    executor = RecordingExecutor()
+
+    def loader(organization_id):
+        loads.append(organization_id)
+        return [(1, 'ログインできない')]
+
+    index = SimilarTicketIndex(loader, reconcile_interval=60, first_load_timeout=0, executor=executor,
+                               clock=lambda: now[0])
+    # 最初の読み込みが間に合わなければ、似ているチケットなしとして待たずに返す
+    assert index.similar(1, 'ログインできません') == []
+    assert index.similar(1, 'ログインできません') == []
+    assert len(executor.submitted) == 1  # 同じ組織の読み込みは同時に1つだけ
+    executor.run_all()
+    assert [t.id for t in index.similar(1, 'ログインできません')] == [1]
+
+    index.apply({(1, 1): None, (1, 2): 'ログインできません'})
+    now[0] = 60
+    # 作り直しができるまでは前の索引を使う
+    assert [t.id for t in index.similar(1, 'ログインできません')] == [2]
+    assert [t.id for t in index.similar(1, 'ログインできません')] == [2]
+    assert len(executor.submitted) == 1
+    # 作り直しの途中にコミットされた変更も、新しい索引に反映する
+    index.apply({(1, 3): 'ログインできませんでした'})
+    executor.run_all()
+    assert sorted(t.id for t in index.similar(1, 'ログインできません')) == [1, 3]
+    assert loads == [1, 1]
+
+
+def test_add_ticket_asks_to_confirm_likely_duplicates(logged_in_user, db):
+    user, client = logged_in_user
+    ticket = Ticket(title='請求書のPDFがダウンロードできない', requester_id=user.id,
+                    organization_id=user.organization_id)
+    db.session.add(ticket)
+    db.session.commit()
+
+    # 入力中の問い合わせは、表示中のフラッシュメッセージを残すため似ているチケットの欄だけを返す
+    response = client.get('/tickets/similar?title=請求書PDFがダウンロードできません', headers=FRAGMENT)
+    body = response.get_data(as_text=True)
+    assert response.status_code == 200 and 'id="flashMessages"' not in body
+    assert f'#{ticket.id} 請求書のPDFがダウンロードできない' in body and 'name="allow_duplicate"' in body
+    assert client.get('/api/tickets/similar', query_string={'title': '請求書PDFがダウンロードできません',
+                                                            'exclude_id': ticket.id}).get_json() == {'similar': []}
+
+    form = {'title': '請求書PDFがダウンロードできません'}
+    response = client.post('/ticket/add', data=form, headers=FRAGMENT)
+    assert response.status_code == 409 and "似ているチケットがあります。" in response.get_data(as_text=True)
+    # JSが動かない場合は、タイトルを入れたままの作成フォームに似ているチケットを表示する
+    response = client.post('/ticket/add', data=form)
+    assert response.status_code == 302 and 'title=' in response.headers['Location']
+    body = client.get(response.headers['Location']).get_data(as_text=True)
+    assert 'value="請求書PDFがダウンロードできません"' in body and f'#{ticket.id} 請求書のPDF' in body
+    assert Ticket.query.filter_by(title=form['title']).count() == 0
+
+    response = client.post('/ticket/add', data={**form, 'allow_duplicate': '1'}, headers=FRAGMENT)
+    assert response.status_code == 201 and '<div id="similarTickets">' in response.get_data(as_text=True)
+    # コミットしたチケットはすぐに索引に反映される
+    created = Ticket.query.filter_by(title=form['title']).one()
+    similar = client.get('/api/tickets/similar', query_string={'title': form['title']}).get_json()['similar']
+    assert [t['id'] for t in similar] == [created.id, ticket.id] and similar[0]['similarity'] == 1.0
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+
+import pyarrow.parquet as pq
+import pytest
+from werkzeug.security import generate_password_hash
+
+from app import User, Ticket, SubTicket, Organization, Role
+from snapshot import read_table, snapshot
+
+pytestmark = pytest.mark.real_commits
+
+
+def _sources(db):
+    connection = db.engine.connect()
+    return connection, [('default', connection, Organization.__table__, False),
+                        ('default', connection, User.__table__, True),
+                        ('default', connection, Ticket.__table__, True),
+                        ('default', connection, SubTicket.__table__, True)]
+
+
+def test_incremental_snapshot_keeps_latest_rows(db, tmp_path):
+    """2回目は変更された行だけを書き出し、read_table が最新の行にまとめるか"""
+    started = datetime(2026, 1, 1, 9)
+    role = Role(name='admin')
+    org = Organization(name='SnapshotOrg', updated_at=started)
+    user = User(username='alice', password_hash=generate_password_hash('pw'), organization=org, role=role,
+                updated_at=started)
+    tickets = [Ticket(title=f'Ticket {i}', organization=org, requester=user, updated_at=started) for i in range(3)]
+    db.session.add_all([role, org, user] + tickets)
+    db.session.commit()
+
+    connection, sources = _sources(db)
+    with connection:
+        snapshot(sources, str(tmp_path), lag=timedelta(0), now=started + timedelta(hours=1))
+        changed = tickets[1]
+        changed.status = '対応中'
+        changed.updated_at = started + timedelta(hours=2)
+        db.session.commit()
+        connection.rollback()
+        snapshot(sources, str(tmp_path), lag=timedelta(0), now=started + timedelta(hours=3))
+
+    parts = sorted((tmp_path / 'tickets').glob('part-*.parquet'))
+    assert len(parts) == 1
+    assert pq.read_table(parts[0]).column('id').to_pylist() == [changed.id]
+    # 変更のないテーブルは差分のファイルを作らない
+    assert not list((tmp_path / 'users').glob('part-*.parquet'))
+
+    data = read_table(str(tmp_path), 'tickets')
+    assert data.num_rows == 3
+    statuses = dict(zip(data.column('id').to_pylist(), data.column('status').to_pylist()))
+    assert statuses[changed.id] == '対応中'
+    assert set(data.column('shard').to_pylist()) == {'default'}
+    assert read_table(str(tmp_path), 'organizations').column('name').to_pylist() == ['SnapshotOrg']
+
+
+def test_snapshot_command_full_drops_deleted_rows(db, runner, tmp_path):
+    """--full で書き出すと、削除された行が read_table の結果から消えるか"""
+    role = Role(name='admin')
+    org = Organization(name='SnapshotOrg')
+    user = User(username='alice', password_hash=generate_password_hash('pw'), organization=org, role=role)
+    keep = Ticket(title='Keep', organization=org, requester=user)
+    drop = Ticket(title='Drop', organization=org, requester=user)
+    db.session.add_all([role, org, user, keep, drop])
+    db.session.commit()
+
+    output = str(tmp_path)
+    result = runner.invoke(args=['snapshot', '--output', output, '--lag-minutes', '0'])
+    assert result.exit_code == 0, result.output
+    assert read_table(output, 'tickets').num_rows == 2
+
+    db.session.delete(drop)
+    db.session.commit()
+    result = runner.invoke(args=['snapshot', '--output', output, '--lag-minutes', '0', '--full'])
+    assert result.exit_code == 0, result.output
+    assert read_table(output, 'tickets').column('title').to_pylist() == ['Keep']
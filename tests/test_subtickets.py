@@ -0,0 +1,154 @@
+from contextlib import contextmanager
+
+from sqlalchemy import event, select
+
+from app import Ticket, SubTicket, OutboxEvent
+
+
+def _add(db, ticket, title, parent=None, completed=False):
+    subticket = SubTicket(title=title, ticket_id=ticket.id, parent_id=parent.id if parent else None,
+                          completed=completed)
+    db.session.add(subticket)
+    db.session.commit()
+    return subticket
+
+
+def _create_tree(db, user):
+    """epic ─┬ design ─┬ mockup (完了)
+                       │          └ review
+             │         └ build (完了)
+             └ release"""
+    ticket = Ticket(title='Epic', requester_id=user.id, organization_id=user.organization_id)
+    db.session.add(ticket)
+    db.session.commit()
+    design = _add(db, ticket, 'design')
+    mockup = _add(db, ticket, 'mockup', design, completed=True)
+    _add(db, ticket, 'review', design)
+    _add(db, ticket, 'build', completed=True)
+    release = _add(db, ticket, 'release')
+    # build をあとから design の下に入れても、深さ優先の順に並ぶ
+    build = SubTicket.query.filter_by(title='build').one()
+    build.parent_id = design.id
+    db.session.commit()
+    return ticket, design, mockup, release
+
+
+@contextmanager
+def _record_statements(db):
+    statements = []
+    record = lambda conn, cursor, statement, *args: statements.append(statement)  # noqa: E731
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+
+def _titles(client, ticket):
+    return [node['title'] for node in client.get(f'/api/ticket/{ticket.id}/subtickets').get_json()['subtickets']]
+
+
+def test_subticket_tree_and_progress(logged_in_user, db):
+    """入れ子のサブチケットが深さ優先の順に返り、完了率が末端から集計されるか (クエリは2回)"""
+    user, client = logged_in_user
+    ticket, design, mockup, release = _create_tree(db, user)
+
+    statements = []
+    record = lambda conn, cursor, statement, *args: statements.append(statement)  # noqa: E731
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        payload = client.get(f'/api/ticket/{ticket.id}/subtickets').get_json()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    assert sum('RECURSIVE' in statement for statement in statements) == 2
+
+    nodes = {node['title']: node for node in payload['subtickets']}
+    assert [node['title'] for node in payload['subtickets']] == ['design', 'mockup', 'review', 'build', 'release']
+    assert [node['depth'] for node in payload['subtickets']] == [0, 1, 1, 1, 0]
+    assert (nodes['design']['leaf_count'], nodes['design']['completed_count'], nodes['design']['progress']) == (3, 2, 67)
+    assert not nodes['design']['is_leaf'] and nodes['mockup']['is_leaf']
+    assert (payload['leaf_count'], payload['completed_count'], payload['progress']) == (4, 2, 50)
+
+    subtree = client.get(f'/api/ticket/{ticket.id}/subtickets', query_string={'root_id': design.id}).get_json()
+    assert [node['title'] for node in subtree['subtickets']] == ['design', 'mockup', 'review', 'build']
+    assert subtree['progress'] == 67
+
+
+def test_add_nested_subticket(logged_in_user, db):
+    """親を指定してサブチケットを追加でき、別のチケットのサブチケットは親にできないか"""
+    user, client = logged_in_user
+    ticket, design, _, _ = _create_tree(db, user)
+    other = Ticket(title='Other', requester_id=user.id, organization_id=user.organization_id)
+    db.session.add(other)
+    db.session.commit()
+
+    response = client.post(f'/subticket/add/{ticket.id}', data={'subticket_title': 'polish', 'parent_id': design.id})
+    assert response.status_code == 302
+    assert SubTicket.query.filter_by(title='polish').one().parent_id == design.id
+    assert client.post(f'/subticket/add/{other.id}',
+                       data={'subticket_title': 'stray', 'parent_id': design.id}).status_code == 404
+
+    page = client.get(f'/ticket/{ticket.id}/edit').data.decode('utf-8')
+    assert 'polish' in page and '40% 完了' in page
+
+    # 親を削除すると子孫もDBのカスケードで削除される
+    db.session.delete(db.session.get(SubTicket, design.id))
+    db.session.commit()
+    assert [s.title for s in SubTicket.query.filter_by(ticket_id=ticket.id)] == ['release']
+
+
+def test_batch_add_and_reorder_subtickets(logged_in_user, db):
+    """複数行の件名を1回のINSERTで追加し、ドラッグでの並べ替えを1回のUPDATEで反映するか"""
+    user, client = logged_in_user
+    ticket, design, _, release = _create_tree(db, user)
+
+    with _record_statements(db) as statements:
+        response = client.post(f'/subticket/add/{ticket.id}', follow_redirects=True,
+                               data={'subticket_title': 'deploy\n\n  verify \nannounce\n'})
+    assert "3件のサブチケットをチケット「Epic」に追加しました。" in response.get_data(as_text=True)
+    assert sum(statement.startswith('INSERT INTO subtickets') for statement in statements) == 1
+    assert _titles(client, ticket) == ['design', 'mockup', 'review', 'build', 'release', 'deploy', 'verify',
+                                       'announce']
+    created = db.session.scalars(select(OutboxEvent).where(OutboxEvent.event_type == 'subticket.created')
+                                 .order_by(OutboxEvent.id.desc()).limit(3)).all()
+    assert [event.payload['data']['title'] for event in reversed(created)] == ['deploy', 'verify', 'announce']
+
+    response = client.post(f'/api/ticket/{ticket.id}/subtickets', json={'titles': ['sketch'], 'parent_id': design.id})
+    assert response.status_code == 201 and response.get_json()['subtickets'][0]['parent_id'] == design.id
+
+    top_ids = [node['id'] for node in client.get(f'/api/ticket/{ticket.id}/subtickets').get_json()['subtickets']
+               if node['depth'] == 0]
+    new_order = [top_ids[-1]] + top_ids[:-1]
+    with _record_statements(db) as statements:
+        response = client.post(f'/api/ticket/{ticket.id}/subtickets/order', json={'parent_id': None, 'ids': new_order})
+    assert response.get_json() == {'status': 'success', 'moved': 5}
+    assert sum(statement.startswith('UPDATE subtickets') for statement in statements) == 1
+    assert _titles(client, ticket) == ['announce', 'design', 'mockup', 'review', 'build', 'sketch', 'release',
+                                       'deploy', 'verify']
+
+    # 親の子の一部だけ、または別の親の子を指定した場合は並べ替えない
+    assert client.post(f'/api/ticket/{ticket.id}/subtickets/order',
+                       json={'parent_id': None, 'ids': new_order[:-1]}).status_code == 400
+    assert client.post(f'/api/ticket/{ticket.id}/subtickets/order',
+                       json={'parent_id': design.id, 'ids': [release.id]}).status_code == 400
+
+
+def test_bulk_complete_subtickets(logged_in_user, db):
+    """末端のサブチケットだけをまとめて完了・未完了にし、変更をアウトボックスに書くか"""
+    user, client = logged_in_user
+    ticket, design, _, release = _create_tree(db, user)
+
+    response = client.post(f'/ticket/{ticket.id}/subtickets/complete', data={'completed': '1'}, follow_redirects=True)
+    assert "2件のサブチケットを完了にしました。" in response.get_data(as_text=True)
+    payload = client.get(f'/api/ticket/{ticket.id}/subtickets').get_json()
+    assert payload['progress'] == 100
+    assert not db.session.get(SubTicket, design.id).completed  # 子を持つサブチケットは変更しない
+
+    updates = db.session.scalars(select(OutboxEvent).where(OutboxEvent.event_type == 'subticket.updated')
+                                 .order_by(OutboxEvent.id.desc()).limit(2)).all()
+    assert sorted(event.aggregate_id for event in updates) == sorted(
+        node['id'] for node in payload['subtickets'] if node['title'] in ('review', 'release'))
+    assert all(event.payload['changes'] == {'completed': [False, True]} for event in updates)
+
+    client.post(f'/ticket/{ticket.id}/subtickets/complete', data={'completed': '0'})
+    assert client.get(f'/api/ticket/{ticket.id}/subtickets').get_json()['progress'] == 0